@@ -12,6 +12,7 @@
         typer
         xxhash
         toml
+        pytest
       ];
 
       systemDeps = with pkgs; [
@@ -1,6 +1,7 @@
 import toml
 import os
 import pwd
+import functools
 
 def resolve_path(path):
     if path.startswith("~"):
@@ -15,7 +16,9 @@ def resolve_path(path):
         raise ValueError(f"Path must be absolute or start with ~: {path}")
     return os.path.abspath(path)
 
+@functools.lru_cache(maxsize=None)
 def get_config():
+    """Loads config.toml on first use; later calls share the parsed result."""
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     config_path = os.path.join(base_dir, "config.toml")
     
@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+from core import chunker, nbd_server
+from core.io import VirtualDisk
+
+# Bump when the result layout changes, so compare() can refuse mismatched files
+RESULT_VERSION = 1
+DEFAULT_RUNTIME = 3.0
+TARGETS = ("direct", "nbd")
+
+class Workload:
+    """
+    One fio-style job. rw is read, write, randread, randwrite or randrw; for
+    randrw, read_pct of the requests are reads. A FLUSH is issued after every
+    flush_every writes (0 = never).
+    """
+    def __init__(self, name, rw, bs, iodepth=1, read_pct=100, flush_every=0):
+        self.name = name
+        self.rw = rw
+        self.bs = bs
+        self.iodepth = iodepth
+        self.read_pct = {"read": 100, "randread": 100, "write": 0, "randwrite": 0}.get(rw, read_pct)
+        self.flush_every = flush_every
+
+    @property
+    def random(self):
+        return self.rw.startswith("rand")
+
+    def as_dict(self):
+        return {"name": self.name, "rw": self.rw, "bs": self.bs, "iodepth": self.iodepth,
+                "read_pct": self.read_pct, "flush_every": self.flush_every}
+
+DEFAULT_WORKLOADS = [
+    Workload("seqread-1m", "read", 1024 * 1024, iodepth=4),
+    Workload("seqwrite-1m", "write", 1024 * 1024, iodepth=4),
+    Workload("randread-4k", "randread", 4096, iodepth=16),
+    Workload("randread-64k", "randread", 64 * 1024, iodepth=8),
+    Workload("randwrite-4k", "randwrite", 4096, iodepth=16),
+    Workload("randrw-70-4k", "randrw", 4096, iodepth=16, read_pct=70),
+    Workload("randwrite-4k-flush64", "randwrite", 4096, iodepth=16, flush_every=64),
+]
+
+def get_workloads(names=None):
+    if not names:
+        return list(DEFAULT_WORKLOADS)
+    by_name = {w.name: w for w in DEFAULT_WORKLOADS}
+    unknown = [n for n in names if n not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown workloads: {', '.join(unknown)}")
+    return [by_name[n] for n in names]
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class Recorder:
+    """Collects per-request latencies and counts from all submitters of one run."""
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.flushes = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency, nbytes):
+        with self._lock:
+            self.latencies.append(latency)
+            self.bytes += nbytes
+
+    def add_flush(self):
+        with self._lock:
+            self.flushes += 1
+
+    def result(self, workload, target, seconds):
+        lat = sorted(self.latencies)
+        ops = len(lat)
+        return {
+            "workload": workload.as_dict(), "target": target, "ops": ops, "bytes": self.bytes,
+            "seconds": round(seconds, 3), "flushes": self.flushes,
+            "iops": round(ops / seconds, 1) if seconds else 0.0,
+            "mb_s": round(self.bytes / (1024 * 1024) / seconds, 1) if seconds else 0.0,
+            "lat_us": {
+                "p50": round(percentile(lat, 0.50) * 1e6, 1),
+                "p99": round(percentile(lat, 0.99) * 1e6, 1),
+                "p999": round(percentile(lat, 0.999) * 1e6, 1),
+                "max": round(lat[-1] * 1e6, 1) if lat else 0.0,
+            },
+        }
+
+class OpSource:
+    """Hands out (is_read, offset) per request, shared by all submitters of a run."""
+    def __init__(self, workload, total_size, seed=0):
+        self.w = workload
+        self.slots = max(1, total_size // workload.bs)
+        self.next_slot = 0
+        self.writes = 0
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next(self):
+        """Returns (is_read, offset, flush_after)."""
+        with self._lock:
+            if self.w.random:
+                slot = self.rng.randrange(self.slots)
+            else:
+                slot = self.next_slot
+                self.next_slot = (self.next_slot + 1) % self.slots
+            is_read = self.rng.randrange(100) < self.w.read_pct
+            flush = False
+            if not is_read:
+                self.writes += 1
+                flush = bool(self.w.flush_every) and self.writes % self.w.flush_every == 0
+            return is_read, slot * self.w.bs, flush
+
+def run_direct(vdisk, workload, runtime, seed=0):
+    """Drives VirtualDisk from iodepth threads, each with one request in flight."""
+    ops = OpSource(workload, vdisk.total_size, seed)
+    rec = Recorder()
+    payload = os.urandom(workload.bs)
+    deadline = time.perf_counter() + runtime
+
+    def submitter():
+        buf = memoryview(bytearray(workload.bs))
+        while time.perf_counter() < deadline:
+            is_read, offset, flush = ops.next()
+            t = time.perf_counter()
+            if is_read:
+                vdisk.read_into(buf, offset)
+            else:
+                vdisk.write(offset, payload)
+            rec.add(time.perf_counter() - t, workload.bs)
+            if flush:
+                vdisk.sync()
+                rec.add_flush()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=submitter) for _ in range(workload.iodepth)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return rec.result(workload, "direct", time.perf_counter() - started)
+
+def _recv_exact(sock, view):
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n:
+            raise EOFError("Server closed the connection")
+        got += n
+
+class NBDClient:
+    """
+    Minimal pipelined NBD client over a socketpair into NBDServer._handle_request.
+    Up to iodepth requests are in flight; a reader thread matches replies by handle.
+    """
+    def __init__(self, vdisk, iodepth, read_mode="sendfile"):
+        self.server = nbd_server.NBDServer(None, vdisk, workers=max(1, iodepth), read_mode=read_mode)
+        self.server.running = True
+        server_sock, self.sock = self.server.sock_pairs[0]
+        self.thread = threading.Thread(target=self.server._handle_request, args=(server_sock,), daemon=True)
+        self.thread.start()
+        self.slots = threading.Semaphore(iodepth)
+        self.pending = {}
+        self.handles = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def submit(self, cmd, offset, length, data=None, on_done=None):
+        self.slots.acquire()
+        with self._lock:
+            self.handles += 1
+            handle = self.handles
+            self.pending[handle] = (cmd, length, time.perf_counter(), on_done)
+        header = struct.pack(">LLQQL", nbd_server.NBD_REQUEST_MAGIC, cmd, handle, offset, length)
+        with self._send_lock:
+            self.sock.sendall(header)
+            if data is not None:
+                self.sock.sendall(data)
+
+    def read_replies(self, stop):
+        header = bytearray(16)
+        payload = bytearray()
+        while not (stop.is_set() and not self.pending):
+            try:
+                _recv_exact(self.sock, memoryview(header))
+            except (EOFError, OSError):
+                return
+            magic, error, handle = struct.unpack(">LLQ", header)
+            with self._lock:
+                cmd, length, started, on_done = self.pending.pop(handle)
+            if cmd == nbd_server.NBD_CMD_READ and not error:
+                if len(payload) < length:
+                    payload = bytearray(length)
+                _recv_exact(self.sock, memoryview(payload)[:length])
+            if error:
+                self.errors += 1
+            if on_done:
+                on_done(time.perf_counter() - started)
+            self.slots.release()
+
+    def close(self):
+        header = struct.pack(">LLQQL", nbd_server.NBD_REQUEST_MAGIC, nbd_server.NBD_CMD_DISC, 0, 0, 0)
+        with self._send_lock:
+            self.sock.sendall(header)
+        self.thread.join()
+        # Wakes the reply reader if it is still blocked in recv
+        self.sock.shutdown(socket.SHUT_RDWR)
+        for a, b in self.server.sock_pairs:
+            a.close()
+            b.close()
+
+def run_nbd(vdisk, workload, runtime, seed=0, read_mode="sendfile"):
+    """Drives the NBD request handler through the wire protocol, pipelined to iodepth."""
+    ops = OpSource(workload, vdisk.total_size, seed)
+    rec = Recorder()
+    payload = os.urandom(workload.bs)
+    client = NBDClient(vdisk, workload.iodepth, read_mode)
+    stop = threading.Event()
+    reader = threading.Thread(target=client.read_replies, args=(stop,))
+    reader.start()
+
+    def done(latency):
+        rec.add(latency, workload.bs)
+
+    def flushed(latency):
+        rec.add_flush()
+
+    started = time.perf_counter()
+    deadline = started + runtime
+    while time.perf_counter() < deadline:
+        is_read, offset, flush = ops.next()
+        if is_read:
+            client.submit(nbd_server.NBD_CMD_READ, offset, workload.bs, on_done=done)
+        else:
+            client.submit(nbd_server.NBD_CMD_WRITE, offset, workload.bs, payload, on_done=done)
+        if flush:
+            client.submit(nbd_server.NBD_CMD_FLUSH, 0, 0, on_done=flushed)
+    stop.set()
+    # Wait for the last replies before stopping the clock
+    for _ in range(workload.iodepth):
+        client.slots.acquire()
+    elapsed = time.perf_counter() - started
+    client.close()
+    reader.join()
+    result = rec.result(workload, "nbd", elapsed)
+    result["errors"] = client.errors
+    return result
+
+def make_drive(root, size_mb, chunk_mb, name="bench"):
+    """Creates a throwaway drive folder of sparse chunks (no DB needed by VirtualDisk)."""
+    total_chunks = -(-size_mb // chunk_mb)
+    padding = chunker.get_padding(total_chunks)
+    for i in range(total_chunks):
+        with open(os.path.join(root, chunker.format_name(name, i, "0", padding)), "wb") as f:
+            f.truncate(chunk_mb * 1024 * 1024)
+    return total_chunks
+
+def prefill(vdisk, block=4 * 1024 * 1024):
+    """Writes random data over the whole device, so reads do not just hit holes."""
+    data = os.urandom(block)
+    for offset in range(0, vdisk.total_size, block):
+        vdisk.write(offset, data[: min(block, vdisk.total_size - offset)])
+    vdisk.sync()
+
+def run(size_mb=256, chunk_mb=64, workloads=None, targets=TARGETS, runtime=DEFAULT_RUNTIME,
+        cache_mb=0, readahead_mb=0, read_mode="sendfile", directory=None, log=print):
+    """Runs every workload against every target on a fresh drive. Returns the result document."""
+    root = tempfile.mkdtemp(prefix="tgfs-bench-", dir=directory)
+    try:
+        total_chunks = make_drive(root, size_mb, chunk_mb)
+        workloads = workloads or DEFAULT_WORKLOADS
+        if any(w.read_pct for w in workloads):
+            vdisk = VirtualDisk(root, "bench", chunk_mb, total_chunks)
+            prefill(vdisk)
+            vdisk.close()
+
+        results = []
+        for w in workloads:
+            for target in targets:
+                # A fresh VirtualDisk per job, so caches do not carry over
+                vdisk = VirtualDisk(root, "bench", chunk_mb, total_chunks,
+                                    cache_mb=cache_mb, readahead_mb=readahead_mb)
+                try:
+                    if target == "direct":
+                        res = run_direct(vdisk, w, runtime)
+                    else:
+                        res = run_nbd(vdisk, w, runtime, read_mode=read_mode)
+                finally:
+                    vdisk.close()
+                results.append(res)
+                log(format_result(res))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "version": RESULT_VERSION,
+        "config": {"size_mb": size_mb, "chunk_mb": chunk_mb, "runtime": runtime, "cache_mb": cache_mb,
+                   "readahead_mb": readahead_mb, "read_mode": read_mode, "cpus": os.cpu_count()},
+        "results": results,
+    }
+
+def format_result(res):
+    lat = res["lat_us"]
+    return (f"{res['workload']['name']:<22} {res['target']:<6} {res['iops']:>10.0f} IOPS {res['mb_s']:>8.1f} MB/s  "
+            f"p50 {lat['p50']:>8.0f}us  p99 {lat['p99']:>8.0f}us  p999 {lat['p999']:>8.0f}us")
+
+def save(doc, path):
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare(base, new, threshold=0.10, log=print):
+    """
+    Prints per-job changes between two result documents and returns the jobs
+    whose IOPS dropped, or p99 latency grew, by more than `threshold`.
+    """
+    if base.get("version") != new.get("version"):
+        raise ValueError("Result files come from different bench versions")
+    key = lambda r: (r["workload"]["name"], r["target"])
+    old = {key(r): r for r in base["results"]}
+    regressions = []
+    for r in new["results"]:
+        b = old.get(key(r))
+        if not b:
+            continue
+        d_iops = (r["iops"] - b["iops"]) / b["iops"] if b["iops"] else 0.0
+        d_p99 = (r["lat_us"]["p99"] - b["lat_us"]["p99"]) / b["lat_us"]["p99"] if b["lat_us"]["p99"] else 0.0
+        bad = d_iops < -threshold or d_p99 > threshold
+        if bad:
+            regressions.append(key(r))
+        log(f"{r['workload']['name']:<22} {r['target']:<6} IOPS {d_iops:+7.1%}  p99 {d_p99:+7.1%}"
+            f"{'  REGRESSION' if bad else ''}")
+    return regressions
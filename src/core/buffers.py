@@ -0,0 +1,39 @@
+import threading
+import collections
+
+class BufferPool:
+    """
+    Bounded pool of reusable bytearrays for request payloads.
+    Buffers are bucketed by power-of-two size so a 128K write and a 32M write
+    never fight over the same slot. Buffers beyond the byte budget are dropped
+    and left to the garbage collector.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, min_size=4096):
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.pooled_bytes = 0
+        self._free = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _bucket(self, size):
+        bucket = self.min_size
+        while bucket < size:
+            bucket <<= 1
+        return bucket
+
+    def acquire(self, size):
+        """Returns a bytearray of at least `size` bytes."""
+        bucket = self._bucket(size)
+        with self._lock:
+            free = self._free[bucket]
+            if free:
+                self.pooled_bytes -= bucket
+                return free.pop()
+        return bytearray(bucket)
+
+    def release(self, buf):
+        bucket = len(buf)
+        with self._lock:
+            if self.pooled_bytes + bucket <= self.max_bytes:
+                self._free[bucket].append(buf)
+                self.pooled_bytes += bucket
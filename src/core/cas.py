@@ -0,0 +1,165 @@
+import os
+import time
+from core import chunker, hasher
+from core.io import VirtualDisk
+from core.database import DBManager
+
+# Shared block store under storage_root, used by every drive with layout "cas"
+CAS_DIR = ".cas"
+# Per-drive folder of blocks written since the last publish (copy-on-write targets)
+PRIVATE_DIR = "blocks"
+
+def get_cas_root(storage_root):
+    return os.path.join(storage_root, CAS_DIR)
+
+def get_refs_db(cas_root):
+    """Reference counts for stored blocks, shared across drives."""
+    os.makedirs(cas_root, exist_ok=True)
+    return DBManager(cas_root, "refs")
+
+def block_name(h):
+    return f"{h}.blk"
+
+def get_zero_block(cas_root, block_size):
+    """A sparse all-zero block that unmapped blocks are read from."""
+    os.makedirs(cas_root, exist_ok=True)
+    path = os.path.join(cas_root, f"zero-{block_size}.blk")
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.truncate(block_size)
+        os.rename(tmp, path)
+    return path
+
+def private_name(block_no):
+    return os.path.join(PRIVATE_DIR, f"{block_no}.blk")
+
+class CASDisk(VirtualDisk):
+    """
+    VirtualDisk over the content-addressed layout. Every block (the drive's Merkle
+    leaf size) is addressed by its leaf hash and stored once in the shared store,
+    however many chunks or drives map to it. VirtualDisk's per-chunk machinery runs
+    at block granularity here: its "chunk" index is the global block number.
+    Shared blocks are read-only; the first write copies the block into the drive's
+    private folder (copy-on-write) and publish() folds it back into the store.
+    """
+    def __init__(self, drive_path, drive_name, chunk_size_mb, total_chunks, block_size_mb, cas_root,
+                 read_only=False, **kwargs):
+        self.cas_root = cas_root
+        self.blocks_per_chunk = chunk_size_mb // block_size_mb
+        self.block_size = block_size_mb * 1024 * 1024
+        self.db = kwargs.setdefault("db", DBManager(drive_path, drive_name))
+        self.private = set()
+        os.makedirs(os.path.join(drive_path, PRIVATE_DIR), exist_ok=True)
+
+        super().__init__(drive_path, drive_name, block_size_mb, total_chunks * self.blocks_per_chunk,
+                         read_only=read_only, **kwargs)
+        # Handles are per block, so keep more of them open
+        self.max_open_files = 512
+
+    def _scan_chunks(self):
+        """Maps block number -> shared block file, overridden by private copies."""
+        for chunk_idx, block_idx, h in self.db.get_all_block_hashes():
+            self.chunk_map[chunk_idx * self.blocks_per_chunk + block_idx] = os.path.relpath(
+                os.path.join(self.cas_root, block_name(h)), self.root
+            )
+        for f in os.listdir(os.path.join(self.root, PRIVATE_DIR)):
+            if not f.endswith(".blk"): continue
+            try:
+                self.private.add(int(f.split('.')[0]))
+            except ValueError:
+                continue
+        self.zero_path = os.path.relpath(get_zero_block(self.cas_root, self.block_size), self.root)
+
+    def _chunk_path(self, block_no):
+        if block_no in self.private:
+            return private_name(block_no)
+        return self.chunk_map.get(block_no, self.zero_path)
+
+    def _writable(self, block_no):
+        return not self.read_only and block_no in self.private
+
+    def _before_write(self, block_no):
+        """Copy-on-write: gives the block a private file before it is modified."""
+        if self.read_only: raise IOError("Read-only mode")
+        if block_no in self.private:
+            return
+
+        dst = os.path.join(self.root, private_name(block_no))
+        tmp = f"{dst}.tmp"
+        with open(tmp, "wb") as out:
+            shared = self.chunk_map.get(block_no)
+            if shared:
+                # copy_file_range stays in the kernel (and reflinks where supported)
+                with open(os.path.join(self.root, shared), "rb") as src:
+                    left = self.block_size
+                    while left > 0:
+                        n = os.copy_file_range(src.fileno(), out.fileno(), left)
+                        if not n: break
+                        left -= n
+            out.truncate(self.block_size)
+        os.rename(tmp, dst)
+        self._renamed(dst)
+
+        with self._table_lock:
+            self.private.add(block_no)
+            # The cached handle points at the shared (read-only) file
+            old = self.open_files.pop(block_no, None)
+            if old:
+                self._retire(old)
+
+def publish(drive_path, drive_name, cas_root, workers=hasher.DEFAULT_WORKERS, log=print):
+    """
+    Folds a drive's private blocks into the shared store: hashes them, stores each
+    unique block once (or drops the copy if the store already has it), moves the
+    references in the refs DB and recomputes the chunk roots. The drive must not be
+    served while this runs. Returns the number of chunks whose root changed.
+    """
+    db = DBManager(drive_path, drive_name)
+    refs = get_refs_db(cas_root)
+    algo = db.get_meta("hash_algo") or hasher.DEFAULT_ALGO
+    chunk_size = int(db.get_meta("chunk_size_mb")) * 1024 * 1024
+    block_size = int(db.get_meta("block_size_mb")) * 1024 * 1024
+    blocks_per_chunk = chunk_size // block_size
+    padding = chunker.get_padding(int(db.get_meta("total_chunks")))
+    zero_leaf = chunker.get_zero_hash(block_size, algo)
+
+    private_dir = os.path.join(drive_path, PRIVATE_DIR)
+    paths = {}
+    for f in os.listdir(private_dir) if os.path.isdir(private_dir) else []:
+        if f.endswith(".blk"):
+            paths[os.path.join(private_dir, f)] = int(f.split('.')[0])
+    if not paths:
+        return 0
+
+    mapped = {(c, b): h for c, b, h in db.get_all_block_hashes()}
+    updates = {}
+
+    def on_hashed(path, new_h):
+        chunk_idx, block_idx = divmod(paths[path], blocks_per_chunk)
+        old_h = mapped.get((chunk_idx, block_idx), zero_leaf)
+        if new_h == old_h:
+            os.remove(path)
+            return
+
+        if new_h == zero_leaf:
+            os.remove(path)
+        elif refs.incref(new_h) == 1:
+            os.rename(path, os.path.join(cas_root, block_name(new_h)))
+        else:
+            # Already stored by some drive: this copy is a duplicate
+            os.remove(path)
+
+        if old_h != zero_leaf and refs.decref(old_h) == 0:
+            os.remove(os.path.join(cas_root, block_name(old_h)))
+        updates.setdefault(chunk_idx, {})[block_idx] = new_h
+
+    _, stats = hasher.hash_files(list(paths), algo, workers, on_done=on_hashed)
+    log(f"[*] Hashed {stats}")
+
+    with db.transaction():
+        for chunk_idx, leaves in updates.items():
+            db.update_block_hashes(chunk_idx, leaves, zero_leaf)
+            root = chunker.get_root(db.get_block_hashes(chunk_idx), chunk_size, block_size, algo)
+            db.update_chunk(chunk_idx, root, chunker.format_name(drive_name, chunk_idx, root, padding), chunk_size, time.time())
+    return len(updates)
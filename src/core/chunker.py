@@ -1,15 +1,41 @@
 import os
-import xxhash
-from utils import shell
-
-def get_hash(path):
-    """Calculates xxh64 hash using native python library for speed and reliability."""
-    hasher = xxhash.xxh64()
-    with open(path, "rb") as f:
-        # Read in 128KB blocks to stay memory efficient
-        for chunk in iter(lambda: f.read(128 * 1024), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+import functools
+from core import sparse, hasher
+
+# Chunk identity is a Merkle root over per-block hashes of this size
+DEFAULT_BLOCK_MB = 4
+
+def get_hash(path, algo=hasher.DEFAULT_ALGO):
+    """Calculates a chunk hash (xxh64 by default) via the mmap-based hashing engine."""
+    return hasher.hash_file(path, algo)[0]
+
+@functools.lru_cache(maxsize=None)
+def get_zero_hash(size, algo=hasher.DEFAULT_ALGO):
+    """Hash of `size` zero bytes, computed once per size from the shared zero buffer."""
+    h = hasher.new_hasher(algo)
+    full, rest = divmod(size, sparse.ZERO_BLOCK_SIZE)
+    for _ in range(full):
+        h.update(sparse.ZEROES)
+    h.update(sparse.ZEROES[:rest])
+    return h.hexdigest()
+
+def get_block_size_mb(chunk_size_mb):
+    """Merkle leaf size: 4MB when it divides the chunk evenly, else 1MB (always does)."""
+    return DEFAULT_BLOCK_MB if chunk_size_mb % DEFAULT_BLOCK_MB == 0 else 1
+
+def get_block_range(start, end, block_size):
+    """Block indices covering the byte range [start, end) of a chunk."""
+    return range(start // block_size, -(-end // block_size))
+
+@functools.lru_cache(maxsize=None)
+def get_zero_root(chunk_size, block_size, algo=hasher.DEFAULT_ALGO):
+    """Merkle root of an all-zero chunk."""
+    return hasher.merkle_root([get_zero_hash(block_size, algo)] * (chunk_size // block_size), algo)
+
+def get_root(leaves, chunk_size, block_size, algo=hasher.DEFAULT_ALGO):
+    """Merkle root from stored leaves; blocks without a leaf are all zeroes."""
+    zero = get_zero_hash(block_size, algo)
+    return hasher.merkle_root([leaves.get(bi, zero) for bi in range(chunk_size // block_size)], algo)
 
 def get_padding(total_chunks):
     """Calculates padding based on total chunks, minimum 3 digits."""
@@ -20,22 +46,21 @@ def format_name(drive_name, index, h, padding):
     idx_str = str(index).zfill(padding)
     return f"{drive_name}.{idx_str}.{h}.img"
 
-def create_initial_chunks(drive_path, drive_name, total_chunks, chunk_size_mb):
+def create_initial_chunks(drive_path, drive_name, total_chunks, chunk_size_mb, algo=hasher.DEFAULT_ALGO):
     chunks = []
     padding = get_padding(total_chunks)
+    chunk_size = chunk_size_mb * 1024 * 1024
+    block_size = get_block_size_mb(chunk_size_mb) * 1024 * 1024
+
+    # Every fresh chunk is all zeroes, so they share one root and store no leaves
+    h = get_zero_root(chunk_size, block_size, algo)
     
     for i in range(total_chunks):
-        # Create temp file
-        temp_name = f"{drive_name}.{str(i).zfill(padding)}.tmp"
-        path = os.path.join(drive_path, temp_name)
-        
-        # Allocate space (Note: fallocate makes it non-sparse, truncate makes it sparse)
-        shell.run(["fallocate", "-l", f"{chunk_size_mb}M", path])
-        
-        # Hash and rename
-        h = get_hash(path)
         final_name = format_name(drive_name, i, h, padding)
-        os.rename(path, os.path.join(drive_path, final_name))
+        
+        # Sparse allocation: truncate reserves no blocks until data is written
+        with open(os.path.join(drive_path, final_name), "wb") as f:
+            f.truncate(chunk_size)
         
         chunks.append({"index": i, "hash": h, "filename": final_name})
     return chunks
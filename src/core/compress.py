@@ -0,0 +1,459 @@
+import os
+import time
+import zlib
+import lzma
+import struct
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from core import sparse
+
+try:
+    import zstandard
+except ImportError:
+    # Optional: zstd is only offered when the zstandard package is installed
+    zstandard = None
+
+# Packed chunks sit next to raw ones under the same name with this extension
+PACKED_EXT = ".pack"
+RAW_EXT = ".img"
+# A packed chunk being unpacked after a write: the raw file under construction,
+# and the map of which of its blocks have been copied out of the pack
+PART_EXT = ".part"
+MAP_EXT = ".map"
+
+# Blocks are compressed one by one, so a random read inflates at most a few of them
+PACK_BLOCK = 128 * 1024
+MAGIC = b"TGZ1"
+# magic, codec id, block size, raw size, block count; followed by count + 1 offsets
+HEADER = struct.Struct(">4sB3xIQI")
+
+CODECS = {"zlib": 1, "lzma": 2, "zstd": 3}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+# Decompressed blocks kept per open packed chunk, for reads that walk a block
+READER_CACHE_BLOCKS = 8
+
+def available():
+    return [c for c in CODECS if c != "zstd" or zstandard]
+
+def _compress(codec, data):
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "lzma":
+        return lzma.compress(data, preset=1)
+    if codec == "zstd" and zstandard:
+        # Compressor objects are not thread-safe; they are cheap to create
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unsupported codec: {codec}")
+
+def _decompress(codec, data, size):
+    if codec == "zlib":
+        return zlib.decompress(data, bufsize=size)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "zstd" and zstandard:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    raise ValueError(f"Unsupported codec: {codec}")
+
+def is_packed(filename):
+    return filename.endswith(PACKED_EXT)
+
+def packed_name(filename):
+    return filename[: -len(RAW_EXT)] + PACKED_EXT
+
+def raw_name(filename):
+    return filename[: -len(PACKED_EXT)] + RAW_EXT
+
+def part_name(path):
+    return raw_name(path) + PART_EXT
+
+def map_name(path):
+    return part_name(path) + MAP_EXT
+
+def resolve(drive_path, filename):
+    """Path of a chunk file, in whichever form (raw or packed) it currently exists."""
+    path = os.path.join(drive_path, filename)
+    if os.path.exists(path):
+        return path
+    other = raw_name(filename) if is_packed(filename) else packed_name(filename)
+    other = os.path.join(drive_path, other)
+    return other if os.path.exists(other) else path
+
+class PackStats:
+    """Size and CPU counters for one packing run."""
+    def __init__(self):
+        self.files = 0
+        self.raw_bytes = 0
+        self.packed_bytes = 0
+        self.cpu = 0.0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+        return self
+
+    @property
+    def ratio(self):
+        return self.packed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def __str__(self):
+        mb = 1024 * 1024
+        rate = (self.raw_bytes / mb) / self.cpu if self.cpu else 0.0
+        return (f"{self.files} files, {self.raw_bytes / mb:.0f} MB -> {self.packed_bytes / mb:.0f} MB "
+                f"({self.ratio:.0%}), {self.cpu:.2f}s CPU ({rate:.0f} MB/s per core) in {self.elapsed:.2f}s")
+
+def pack_file(src, dst, codec, block_size=PACK_BLOCK):
+    """
+    Writes a packed copy of a raw chunk: header, offset index, then each block
+    compressed on its own. All-zero blocks take no space; blocks that do not
+    shrink are stored as-is. Returns (raw_size, packed_size).
+    """
+    tmp = f"{dst}.tmp"
+    with open(src, "rb", buffering=0) as f_in, open(tmp, "wb", buffering=0) as f_out:
+        raw_size = os.fstat(f_in.fileno()).st_size
+        count = -(-raw_size // block_size)
+        data_start = HEADER.size + (count + 1) * 8
+        offsets = [data_start]
+        pos = data_start
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        zero = bytes(block_size)
+
+        for bi in range(count):
+            n = os.preadv(f_in.fileno(), [view], bi * block_size)
+            block = view[:n]
+            # bytearray == bytes is a memcmp; comparing memoryviews goes item by item
+            if (buf if n == block_size else buf[:n]) == zero[:n]:
+                out = b""
+            else:
+                out = _compress(codec, block)
+                if len(out) >= n:
+                    out = block
+            if out:
+                done = 0
+                while done < len(out):
+                    done += os.pwrite(f_out.fileno(), out[done:], pos + done)
+                pos += len(out)
+            offsets.append(pos)
+
+        head = HEADER.pack(MAGIC, CODECS[codec], block_size, raw_size, count)
+        os.pwrite(f_out.fileno(), head + struct.pack(f">{count + 1}Q", *offsets), 0)
+        os.fsync(f_out.fileno())
+    os.rename(tmp, dst)
+    return raw_size, pos
+
+def unpack_file(src, dst):
+    """Restores a packed chunk to a sparse raw file. Zero blocks stay holes."""
+    tmp = f"{dst}.tmp"
+    reader = PackedReader(src)
+    try:
+        with open(tmp, "wb", buffering=0) as f_out:
+            f_out.truncate(reader.raw_size)
+            for bi in range(reader.count):
+                block = reader.block(bi)
+                if block is not None:
+                    done = 0
+                    while done < len(block):
+                        done += os.pwrite(f_out.fileno(), block[done:], bi * reader.block_size + done)
+            os.fsync(f_out.fileno())
+    finally:
+        reader.close()
+    os.rename(tmp, dst)
+
+class PackedReader:
+    """
+    Random-access reads from a packed chunk. Used by VirtualDisk in place of a
+    raw file handle; the caller serializes access (VirtualDisk's chunk lock).
+    """
+    def __init__(self, path):
+        self.f = open(path, "rb", buffering=0)
+        head = os.pread(self.f.fileno(), HEADER.size, 0)
+        magic, codec_id, self.block_size, self.raw_size, self.count = HEADER.unpack(head)
+        if magic != MAGIC or codec_id not in CODEC_NAMES:
+            self.f.close()
+            raise IOError(f"Not a packed chunk: {path}")
+        self.codec = CODEC_NAMES[codec_id]
+        index = os.pread(self.f.fileno(), (self.count + 1) * 8, HEADER.size)
+        self.offsets = struct.unpack(f">{self.count + 1}Q", index)
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+    def block(self, bi):
+        """Decompressed block `bi`, or None if it is all zeroes."""
+        with self._lock:
+            if bi in self._cache:
+                self._cache.move_to_end(bi)
+                return self._cache[bi]
+
+        start, end = self.offsets[bi], self.offsets[bi + 1]
+        if start == end:
+            return None
+        size = min(self.block_size, self.raw_size - bi * self.block_size)
+        data = os.pread(self.f.fileno(), end - start, start)
+        if len(data) < end - start:
+            raise IOError("Packed chunk is truncated")
+        if len(data) != size:
+            data = _decompress(self.codec, data, size)
+
+        with self._lock:
+            self._cache[bi] = data
+            while len(self._cache) > READER_CACHE_BLOCKS:
+                self._cache.popitem(last=False)
+        return data
+
+    def read_into(self, view, offset):
+        """Fills view from chunk offset `offset`. Returns bytes filled."""
+        end = min(offset + len(view), self.raw_size)
+        pos = 0
+        while offset < end:
+            bi = offset // self.block_size
+            lo = offset - bi * self.block_size
+            n = min(end - offset, self.block_size - lo)
+            block = self.block(bi)
+            if block is None:
+                view[pos : pos + n] = sparse.ZEROES[:n]
+            else:
+                view[pos : pos + n] = block[lo : lo + n]
+            pos += n
+            offset += n
+        return pos
+
+    def extents(self, offset, end):
+        """(length, hole) runs of the raw range offset..end; all-zero blocks and the tail past raw_size are holes."""
+        runs = []
+        pos = offset
+        while pos < end:
+            bi = pos // self.block_size
+            stop = min(end, (bi + 1) * self.block_size)
+            hole = bi >= self.count or self.offsets[bi] == self.offsets[bi + 1]
+            if runs and runs[-1][1] == hole:
+                runs[-1] = (runs[-1][0] + stop - pos, hole)
+            else:
+                runs.append((stop - pos, hole))
+            pos = stop
+        return runs
+
+class Unpacking(PackedReader):
+    """
+    A packed chunk on its way back to a raw file, so a write never waits for the
+    whole chunk to inflate. The raw file (part_name) starts sparse; a block is
+    copied into it out of the pack when a write first touches it (copy), or by
+    a background pass (fill), and reads take each block from whichever side
+    holds it. sync() makes the map of copied blocks durable only after the data
+    it covers, so after a crash the pair still reads as the chunk. finish()
+    renames the raw file into place once every block is copied. The caller
+    serializes copy, fill and finish (VirtualDisk's chunk lock).
+    """
+    def __init__(self, path, writable=True):
+        super().__init__(path)
+        self.path = path
+        self.writable = writable
+        self.raw = self._map = None
+        self.copied = self._saved = b""
+        try:
+            part = part_name(path)
+            if writable and not os.path.exists(part):
+                with open(part, "wb") as f:
+                    f.truncate(self.raw_size)
+            self.raw = open(part, "r+b" if writable else "rb", buffering=0)
+            if writable:
+                self._map = open(os.open(map_name(path), os.O_RDWR | os.O_CREAT, 0o644), "r+b", buffering=0)
+            elif os.path.exists(map_name(path)):
+                self._map = open(map_name(path), "rb", buffering=0)
+        except BaseException:
+            self.close()
+            raise
+        saved = os.pread(self._map.fileno(), self.count, 0) if self._map else b""
+        # A short map was never synced: no copied block is durable yet
+        self.copied = bytearray(saved) if len(saved) == self.count else bytearray(self.count)
+        self._saved = bytes(self.copied)
+        self._map_lock = threading.Lock()
+        # Map writes go out in order, so the map on disk only ever gains blocks
+        self._sync_lock = threading.Lock()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        try:
+            if self.writable and self.raw and self._map and bytes(self.copied) != self._saved:
+                # Reopened handles trust the map on disk
+                self.sync()
+        finally:
+            for f in (self.raw, self._map):
+                if f:
+                    f.close()
+            super().close()
+
+    @property
+    def complete(self):
+        return 0 not in self.copied
+
+    def _copy(self, bi):
+        block = self.block(bi)
+        base = bi * self.block_size
+        fd = self.raw.fileno()
+        if block is None:
+            # The raw file can hold an unsynced earlier copy from before a crash
+            sparse.punch_hole(fd, base, min(self.block_size, self.raw_size - base))
+        else:
+            done = 0
+            while done < len(block):
+                done += os.pwrite(fd, block[done:], base + done)
+        with self._map_lock:
+            self.copied[bi] = 1
+
+    def copy(self, offset, length):
+        """Copies the blocks under a range out of the pack, ahead of a write to it."""
+        end = min(offset + length, self.raw_size)
+        for bi in range(offset // self.block_size, -(-end // self.block_size)):
+            if not self.copied[bi]:
+                self._copy(bi)
+
+    def fill(self, limit=None):
+        """Copies up to `limit` of the blocks still in the pack (all by default). Returns blocks copied."""
+        done = 0
+        while limit is None or done < limit:
+            bi = self.copied.find(0)
+            if bi < 0:
+                break
+            self._copy(bi)
+            done += 1
+        return done
+
+    def sync(self):
+        """fdatasync of the raw file, then of the map of the blocks copied before it."""
+        with self._sync_lock:
+            with self._map_lock:
+                copied = bytes(self.copied)
+            os.fdatasync(self.raw.fileno())
+            if copied != self._saved:
+                # Marks only ever go from 0 to 1, so a torn write still leaves a valid map
+                os.pwrite(self._map.fileno(), copied, 0)
+                os.fdatasync(self._map.fileno())
+                self._saved = copied
+
+    def finish(self):
+        """Renames the raw file into place, then drops the pack and the map. Returns the raw path."""
+        if not self.complete:
+            raise IOError(f"Unpack of {self.path} is not complete")
+        self.sync()
+        raw = raw_name(self.path)
+        os.rename(part_name(self.path), raw)
+        # Past the rename the raw file is the chunk; recover() tidies up after a crash here
+        os.remove(self.path)
+        os.remove(map_name(self.path))
+        return raw
+
+    def read_into(self, view, offset):
+        end = min(offset + len(view), self.raw_size)
+        pos = 0
+        while offset < end:
+            bi = offset // self.block_size
+            n = min(end - offset, (bi + 1) * self.block_size - offset)
+            if self.copied[bi]:
+                got = 0
+                while got < n:
+                    r = os.preadv(self.raw.fileno(), [view[pos + got : pos + n]], offset + got)
+                    if not r: break
+                    got += r
+                view[pos + got : pos + n] = sparse.ZEROES[: n - got]
+            else:
+                super().read_into(view[pos : pos + n], offset)
+            pos += n
+            offset += n
+        return pos
+
+    def extents(self, offset, end):
+        runs = []
+        pos = offset
+        while pos < end:
+            bi = pos // self.block_size
+            stop = min(end, (bi + 1) * self.block_size)
+            if bi < self.count and self.copied[bi]:
+                part = sparse.extents(self.raw.fileno(), pos, stop)
+            else:
+                part = super().extents(pos, stop)
+            for n, hole in part:
+                if runs and runs[-1][1] == hole:
+                    runs[-1] = (runs[-1][0] + n, hole)
+                else:
+                    runs.append((n, hole))
+            pos = stop
+        return runs
+
+def recover(path):
+    """
+    Tidies up a packed chunk whose unpack was interrupted right after its raw
+    file was renamed into place: removes the stale pack and map. Returns the
+    path that holds the chunk, the raw one in that case and `path` otherwise.
+    """
+    raw = raw_name(path)
+    if os.path.exists(part_name(path)) or not os.path.exists(map_name(path)) or not os.path.exists(raw):
+        return path
+    for stale in (path, map_name(path)):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stale)
+    return raw
+
+def finish_unpacks(drive_path):
+    """
+    Completes the unpacks a served drive left behind when it did not close:
+    copies the blocks still in each pack and renames the raw file into place.
+    For stopped drives only. Returns the number of chunks unpacked.
+    """
+    done = 0
+    for f in sorted(os.listdir(drive_path)):
+        if f.endswith(PART_EXT + MAP_EXT):
+            recover(os.path.join(drive_path, packed_name(f[: -len(PART_EXT + MAP_EXT)])))
+            continue
+        if not f.endswith(RAW_EXT + PART_EXT):
+            continue
+        path = os.path.join(drive_path, packed_name(f[: -len(PART_EXT)]))
+        if not os.path.exists(path):
+            continue
+        u = Unpacking(path)
+        try:
+            u.fill()
+            u.finish()
+        finally:
+            u.close()
+        done += 1
+    return done
+
+def pack_many(paths, codec, workers=DEFAULT_WORKERS, on_done=None):
+    """
+    Packs raw chunk files in parallel (the codecs release the GIL). Each file is
+    replaced by its packed form. Returns PackStats; on_done(raw_path, packed_path)
+    runs in the caller's thread as files complete.
+    """
+    stats = PackStats()
+
+    def job(path):
+        cpu = time.thread_time()
+        dst = packed_name(path)
+        sizes = pack_file(path, dst, codec)
+        os.remove(path)
+        return dst, sizes, time.thread_time() - cpu
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="packer") as pool:
+        futures = {pool.submit(job, p): p for p in paths}
+        for fut in as_completed(futures):
+            dst, (raw, packed), cpu = fut.result()
+            stats.files += 1
+            stats.raw_bytes += raw
+            stats.packed_bytes += packed
+            stats.cpu += cpu
+            if on_done:
+                on_done(futures[fut], dst)
+    return stats.finish()
@@ -0,0 +1,88 @@
+import os
+import json
+import socket
+import threading
+
+def get_control_socket(storage_root, name):
+    """Unix socket a running daemon takes requests on, next to its pid file."""
+    return os.path.join(storage_root, f".{name}.ctl.sock")
+
+class ControlServer:
+    """
+    Request/reply channel between the CLI and a running daemon. Each connection
+    carries one JSON request {"op": ..., **args} and gets one JSON reply, from the
+    handler registered for op. Runs in its own thread, off the request path;
+    requests are served one at a time.
+    """
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self._serve, daemon=True, name="control")
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.sendall(json.dumps(self._dispatch(_recv_all(conn))).encode())
+                except OSError:
+                    pass
+
+    def _dispatch(self, data):
+        try:
+            args = json.loads(data)
+            handler = self.handlers.get(args.pop("op", None))
+            if handler is None:
+                return {"ok": False, "error": "Unknown request"}
+            return {"ok": True, "result": handler(**args)}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def stop(self):
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.thread.join()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def _recv_all(sock):
+    parts = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        parts.append(data)
+    return b"".join(parts)
+
+def call(path, op, timeout=2.0, **args):
+    """
+    Sends one request to a daemon and returns the handler's result. Raises
+    OSError if the daemon cannot be reached, RuntimeError if the handler failed.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(dict(args, op=op)).encode())
+        # End of request: the daemon reads until EOF
+        s.shutdown(socket.SHUT_WR)
+        reply = json.loads(_recv_all(s))
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
@@ -1,43 +1,434 @@
 import sqlite3
 import os
+import threading
+import contextlib
+
+# Applied in order on first connect; PRAGMA user_version records how many ran.
+# Append new steps at the end, never edit old ones. Every step tolerates the
+# tables already existing, since drives from before versioning have some of them.
+MIGRATIONS = [
+    # 1: drive metadata and chunk table
+    """
+    CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS chunks (
+        chunk_index INTEGER PRIMARY KEY,
+        hash TEXT,
+        filename TEXT,
+        size INTEGER,
+        mtime REAL
+    );
+    """,
+    # 2: dirty range journal
+    """
+    CREATE TABLE IF NOT EXISTS dirty_ranges (
+        chunk_index INTEGER,
+        start INTEGER,
+        end INTEGER
+    );
+    """,
+    # 3: Merkle leaves per chunk; a missing row means the block is all zeroes
+    """
+    CREATE TABLE IF NOT EXISTS blocks (
+        chunk_index INTEGER,
+        block_index INTEGER,
+        hash TEXT,
+        PRIMARY KEY (chunk_index, block_index)
+    );
+    """,
+    # 4: reference counts (only filled in the shared content-addressed store's DB)
+    """
+    CREATE TABLE IF NOT EXISTS refs (hash TEXT PRIMARY KEY, refcount INTEGER);
+    """,
+    # 5: one row per chunk for the object last sent (or being sent) to the remote
+    """
+    CREATE TABLE IF NOT EXISTS uploads (
+        chunk_index INTEGER PRIMARY KEY,
+        key TEXT,
+        upload_id TEXT,
+        size INTEGER,
+        mtime REAL,
+        done INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS upload_parts (
+        upload_id TEXT,
+        part_no INTEGER,
+        size INTEGER,
+        PRIMARY KEY (upload_id, part_no)
+    );
+    """,
+    # 6: fetch units of remote chunks present in the local tier cache
+    """
+    CREATE TABLE IF NOT EXISTS tier_units (
+        chunk_index INTEGER,
+        unit INTEGER,
+        PRIMARY KEY (chunk_index, unit)
+    );
+    """,
+    # 7: clear_dirty deletes per chunk; without this each delete scans the table
+    """
+    CREATE INDEX IF NOT EXISTS dirty_ranges_chunk ON dirty_ranges (chunk_index);
+    """,
+    # 8: point-in-time chunk maps; the files live under .snapshots/<name>/
+    """
+    CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, created REAL);
+    CREATE TABLE IF NOT EXISTS snapshot_chunks (
+        snapshot TEXT,
+        chunk_index INTEGER,
+        hash TEXT,
+        filename TEXT,
+        size INTEGER,
+        mtime REAL,
+        PRIMARY KEY (snapshot, chunk_index)
+    );
+    """,
+    # 9: block signature of each chunk's last published version, for deltas
+    """
+    CREATE TABLE IF NOT EXISTS signatures (
+        chunk_index INTEGER PRIMARY KEY,
+        key TEXT,
+        block_size INTEGER,
+        size INTEGER,
+        data BLOB
+    );
+    """,
+    # 10: signatures of versions written as deltas but not yet confirmed applied
+    """
+    CREATE TABLE IF NOT EXISTS pending_signatures (
+        chunk_index INTEGER PRIMARY KEY,
+        key TEXT,
+        block_size INTEGER,
+        size INTEGER,
+        data BLOB
+    );
+    """,
+]
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    # In WAL mode NORMAL only risks the last commits on power loss, never corruption
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    # The daemon and the CLI share the file; wait for each other's commits
+    "PRAGMA busy_timeout=5000",
+]
+
+class Connection:
+    """
+    One long-lived sqlite connection shared by every DBManager (and thread) of a
+    process for the same file. sqlite3 keeps prepared statements per connection,
+    so repeated queries skip parsing. Writes commit when the outermost
+    transaction() block exits, which lets callers batch many calls into one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self.inode = os.stat(path).st_ino
+        self.lock = threading.RLock()
+        self.depth = 0
+        self._migrate()
+
+    def _migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            # executescript commits first and runs the step in its own transaction
+            self.conn.executescript(f"BEGIN; {script} PRAGMA user_version = {i}; COMMIT;")
+
+    def stale(self):
+        """True if the file was deleted or replaced since we opened it."""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self.depth -= 1
+                if not self.depth:
+                    self.conn.rollback()
+                raise
+            self.depth -= 1
+            if not self.depth:
+                self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(path):
+    """Returns this process's connection to `path`, opening it on first use."""
+    key = (os.getpid(), os.path.abspath(path))
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None or conn.stale():
+            if conn is not None:
+                conn.close()
+            conn = _connections[key] = Connection(path)
+        return conn
 
 class DBManager:
     def __init__(self, drive_path, drive_name):
         self.db_path = os.path.join(drive_path, f"{drive_name}.db")
+        self._conn = None
 
     def _get_conn(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("PRAGMA journal_mode=WAL;")
-        return conn
+        if self._conn is None:
+            self._conn = get_connection(self.db_path)
+        return self._conn.transaction()
+
+    def transaction(self):
+        """Groups several calls into one commit: `with db.transaction(): ...`."""
+        return self._get_conn()
 
     def initialize(self, metadata):
         with self._get_conn() as conn:
-            conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS chunks (
-                    chunk_index INTEGER PRIMARY KEY, 
-                    hash TEXT, 
-                    filename TEXT,
-                    size INTEGER,
-                    mtime REAL
-                )
-            """)
-            for k, v in metadata.items():
-                conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (k, str(v)))
+            conn.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)", [(k, str(v)) for k, v in metadata.items()]
+            )
+            conn.execute("INSERT OR REPLACE INTO metadata VALUES ('journal_clean', '1')")
 
     def update_chunk(self, index, h, filename, size, mtime):
+        self.update_chunks([(index, h, filename, size, mtime)])
+
+    def update_chunks(self, rows):
+        """Upserts many (index, hash, filename, size, mtime) rows in one transaction."""
         with self._get_conn() as conn:
-            conn.execute(
-                "INSERT OR REPLACE INTO chunks (chunk_index, hash, filename, size, mtime) VALUES (?, ?, ?, ?, ?)", 
-                (index, h, filename, size, mtime)
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (chunk_index, hash, filename, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                rows
             )
 
+    def get_chunk_files(self):
+        """Returns {chunk_index: filename}, the map VirtualDisk serves from."""
+        with self._get_conn() as conn:
+            return dict(conn.execute("SELECT chunk_index, filename FROM chunks").fetchall())
+
+    def rename_chunk(self, index, filename):
+        with self._get_conn() as conn:
+            conn.execute("UPDATE chunks SET filename = ? WHERE chunk_index = ?", (filename, index))
+
+    def get_chunk(self, index):
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            row = cur.execute("SELECT * FROM chunks WHERE chunk_index = ?", (index,)).fetchone()
+            return dict(row) if row else None
+
     def get_chunks(self):
         with self._get_conn() as conn:
-            conn.row_factory = sqlite3.Row
-            return [dict(r) for r in conn.execute("SELECT * FROM chunks ORDER BY chunk_index ASC").fetchall()]
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            return [dict(r) for r in cur.execute("SELECT * FROM chunks ORDER BY chunk_index ASC").fetchall()]
+
+    def get_block_hashes(self, index):
+        """Returns {block_index: hash} for the non-zero blocks of a chunk."""
+        with self._get_conn() as conn:
+            rows = conn.execute("SELECT block_index, hash FROM blocks WHERE chunk_index = ?", (index,))
+            return dict(rows.fetchall())
+
+    def update_block_hashes(self, index, leaves, zero_hash, replace=False):
+        """Upserts leaf hashes for a chunk; zero leaves are stored as absent rows."""
+        with self._get_conn() as conn:
+            if replace:
+                conn.execute("DELETE FROM blocks WHERE chunk_index = ?", (index,))
+            conn.executemany(
+                "DELETE FROM blocks WHERE chunk_index = ? AND block_index = ?",
+                [(index, bi) for bi, h in leaves.items() if h == zero_hash]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO blocks (chunk_index, block_index, hash) VALUES (?, ?, ?)",
+                [(index, bi, h) for bi, h in leaves.items() if h != zero_hash]
+            )
+
+    def get_all_block_hashes(self):
+        """Returns [(chunk_index, block_index, hash)] for every non-zero block of the drive."""
+        with self._get_conn() as conn:
+            return conn.execute("SELECT chunk_index, block_index, hash FROM blocks").fetchall()
+
+    def incref(self, h):
+        """Adds a reference to a stored block. Returns the new count (1 = first owner)."""
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT INTO refs VALUES (?, 1) ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1", (h,)
+            )
+            return conn.execute("SELECT refcount FROM refs WHERE hash = ?", (h,)).fetchone()[0]
+
+    def decref(self, h):
+        """Drops a reference. Returns the remaining count; the row is gone at 0."""
+        with self._get_conn() as conn:
+            conn.execute("UPDATE refs SET refcount = refcount - 1 WHERE hash = ?", (h,))
+            res = conn.execute("SELECT refcount FROM refs WHERE hash = ?", (h,)).fetchone()
+            if res and res[0] <= 0:
+                conn.execute("DELETE FROM refs WHERE hash = ?", (h,))
+            return max(0, res[0]) if res else 0
+
+    def get_uploads(self):
+        """Returns {chunk_index: upload row} for every chunk ever pushed."""
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            return {r['chunk_index']: dict(r) for r in cur.execute("SELECT * FROM uploads")}
+
+    def begin_upload(self, index, key, upload_id, size, mtime):
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, 0)", (index, key, upload_id, size, mtime)
+            )
+
+    def record_part(self, upload_id, part_no, size):
+        with self._get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO upload_parts VALUES (?, ?, ?)", (upload_id, part_no, size))
+
+    def get_parts(self, upload_id):
+        """Returns {part_no: size} of the parts already sent for an upload."""
+        with self._get_conn() as conn:
+            rows = conn.execute("SELECT part_no, size FROM upload_parts WHERE upload_id = ?", (upload_id,))
+            return dict(rows.fetchall())
+
+    def finish_upload(self, index, upload_id):
+        with self._get_conn() as conn:
+            conn.execute("UPDATE uploads SET done = 1 WHERE chunk_index = ?", (index,))
+            conn.execute("DELETE FROM upload_parts WHERE upload_id = ?", (upload_id,))
+
+    def drop_upload(self, index, upload_id):
+        """Forgets an abandoned upload so the chunk is sent from scratch next time."""
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM uploads WHERE chunk_index = ?", (index,))
+            conn.execute("DELETE FROM upload_parts WHERE upload_id = ?", (upload_id,))
+
+    def get_tier_units(self):
+        """Returns {chunk_index: set(units)} held in the local tier cache."""
+        with self._get_conn() as conn:
+            units = {}
+            for idx, u in conn.execute("SELECT chunk_index, unit FROM tier_units"):
+                units.setdefault(idx, set()).add(u)
+            return units
+
+    def add_tier_units(self, index, units):
+        with self._get_conn() as conn:
+            conn.executemany("INSERT OR IGNORE INTO tier_units VALUES (?, ?)", [(index, u) for u in units])
+
+    def clear_tier_units(self, index):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM tier_units WHERE chunk_index = ?", (index,))
+
+    def get_signatures(self):
+        """Returns {chunk_index: key} of the versions that have a signature."""
+        with self._get_conn() as conn:
+            return dict(conn.execute("SELECT chunk_index, key FROM signatures").fetchall())
+
+    def get_signature(self, index):
+        """Returns the signature row of a chunk (key, block_size, size, data), or None."""
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            row = cur.execute("SELECT * FROM signatures WHERE chunk_index = ?", (index,)).fetchone()
+            return dict(row) if row else None
+
+    def set_signature(self, index, key, block_size, size, data):
+        # A confirmed version supersedes one still waiting for its delta to be applied
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)", (index, key, block_size, size, data)
+            )
+            conn.execute("DELETE FROM pending_signatures WHERE chunk_index = ?", (index,))
+
+    def get_pending_signatures(self):
+        """Returns {chunk_index: key} of the versions sent as deltas and not yet acknowledged."""
+        with self._get_conn() as conn:
+            return dict(conn.execute("SELECT chunk_index, key FROM pending_signatures").fetchall())
+
+    def set_pending_signature(self, index, key, block_size, size, data):
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_signatures VALUES (?, ?, ?, ?, ?)", (index, key, block_size, size, data)
+            )
+
+    def ack_pending_signatures(self):
+        """Makes every pending version the base of its chunk's next delta. Returns how many."""
+        with self._get_conn() as conn:
+            n = conn.execute("INSERT OR REPLACE INTO signatures SELECT * FROM pending_signatures").rowcount
+            conn.execute("DELETE FROM pending_signatures")
+            return n
+
+    def get_snapshots(self):
+        """Returns {name: created} of every snapshot, oldest first."""
+        with self._get_conn() as conn:
+            return dict(conn.execute("SELECT name, created FROM snapshots ORDER BY created").fetchall())
+
+    def add_snapshot(self, name, created, rows):
+        """Records a snapshot from (chunk_index, hash, filename, size, mtime) rows."""
+        with self._get_conn() as conn:
+            conn.execute("INSERT INTO snapshots VALUES (?, ?)", (name, created))
+            conn.executemany(
+                "INSERT INTO snapshot_chunks VALUES (?, ?, ?, ?, ?, ?)", [(name, *row) for row in rows]
+            )
+
+    def get_snapshot_chunks(self, name):
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            return [dict(r) for r in cur.execute(
+                "SELECT chunk_index, hash, filename, size, mtime FROM snapshot_chunks WHERE snapshot = ? "
+                "ORDER BY chunk_index ASC", (name,)
+            )]
+
+    def drop_snapshot(self, name):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            conn.execute("DELETE FROM snapshot_chunks WHERE snapshot = ?", (name,))
+
+    def open_journal(self):
+        """Marks the journal as in use. It is only trusted again after close_journal."""
+        self.set_meta("journal_clean", 0)
+
+    def close_journal(self):
+        self.set_meta("journal_clean", 1)
+
+    def journal_is_clean(self):
+        return self.get_meta("journal_clean") == "1"
+
+    def record_dirty(self, ranges):
+        """Appends dirty byte ranges, given as {chunk_index: [(start, end), ...]}."""
+        rows = [(idx, s, e) for idx, spans in ranges.items() for s, e in spans]
+        with self._get_conn() as conn:
+            conn.executemany("INSERT INTO dirty_ranges VALUES (?, ?, ?)", rows)
+
+    def get_dirty(self):
+        """Returns {chunk_index: [(start, end), ...]} exactly as recorded (unmerged)."""
+        with self._get_conn() as conn:
+            dirty = {}
+            for idx, s, e in conn.execute("SELECT chunk_index, start, end FROM dirty_ranges"):
+                dirty.setdefault(idx, []).append((s, e))
+            return dirty
+
+    def clear_dirty(self, indices=None):
+        with self._get_conn() as conn:
+            if indices is None:
+                conn.execute("DELETE FROM dirty_ranges")
+            else:
+                conn.executemany("DELETE FROM dirty_ranges WHERE chunk_index = ?", [(i,) for i in indices])
+
+    def set_meta(self, key, value):
+        with self._get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (key, str(value)))
 
     def get_meta(self, key):
         with self._get_conn() as conn:
             res = conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
             return res[0] if res else None
+
+    def get_all_meta(self):
+        with self._get_conn() as conn:
+            return dict(conn.execute("SELECT key, value FROM metadata").fetchall())
@@ -0,0 +1,273 @@
+import os
+import mmap
+import zlib
+import struct
+import tempfile
+import contextlib
+import xxhash
+from core import compress
+
+# A signature holds one (weak, strong) pair per block of the signed version
+DEFAULT_BLOCK_SIZE = 64 * 1024
+# Offsets tried for a match. Writes through the NBD device are 4 KiB aligned,
+# so data inside a chunk can only move in steps of that.
+SEARCH_STEP = 4096
+# Unmatched data is sent in DATA records of at most this size
+MAX_LITERAL = 1024 * 1024
+
+# Adler-32 (the rsync rolling checksum) and xxh3_128 of one block
+ENTRY = struct.Struct(">I16s")
+ADLER_MOD = 65521
+
+# Delta stream: header, base and target key, then records up to END
+MAGIC = b"TGD1"
+HEADER = struct.Struct(">4sIQHH")  # magic, block size, target size, base key length, target key length
+OP_COPY = b"C"  # start block, block count: that run of the base
+OP_DATA = b"D"  # length, then that many literal bytes
+OP_END = b"E"   # xxh3_128 of the whole target, checked by apply()
+COPY = struct.Struct(">II")
+DATA = struct.Struct(">I")
+
+DELTA_EXT = ".delta"
+
+class DeltaStats:
+    def __init__(self):
+        self.chunks = 0
+        self.bytes = 0
+        self.literal = 0
+        self.delta = 0
+
+    def add(self, other):
+        self.chunks += other.chunks
+        self.bytes += other.bytes
+        self.literal += other.literal
+        self.delta += other.delta
+
+    def __str__(self):
+        mb = lambda n: n / (1024 * 1024)
+        return (f"{self.chunks} chunks, {mb(self.bytes):.0f} MB -> {mb(self.delta):.1f} MB of delta "
+                f"({mb(self.literal):.1f} MB literal)")
+
+@contextlib.contextmanager
+def _mapped(path):
+    """Read-only buffer over a chunk's content; a packed chunk is unpacked to a temp file first."""
+    tmp = None
+    if compress.is_packed(path):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".unpacked")
+        os.close(fd)
+        compress.unpack_file(path, tmp)
+        path = tmp
+    try:
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                yield mm
+    finally:
+        if tmp:
+            os.remove(tmp)
+
+def _roll(weak, n, out, inc):
+    """
+    Adler-32 of an n-byte window moved forward by len(out) bytes, given the
+    sum weak of the old window: out leaves at the front and inc (as long)
+    enters at the back. Costs the checksums of the two slices, not of n bytes.
+    """
+    k = len(out)
+    mod = ADLER_MOD
+    a, b = weak & 0xFFFF, weak >> 16
+    # adler32 of a k-byte slice is (k + sum((k - i) * x_i), 1 + sum(x_i))
+    oa, ia = zlib.adler32(out), zlib.adler32(inc)
+    s_out, t_out = (oa & 0xFFFF) - 1, (oa >> 16) - k
+    s_in, t_in = (ia & 0xFFFF) - 1, (ia >> 16) - k
+    a2 = (a - s_out + s_in) % mod
+    b2 = (b + k * (a - 1 - s_out) - (n - k) * s_out - t_out + t_in) % mod
+    return (b2 << 16) | a2
+
+def _entry(block):
+    return ENTRY.pack(zlib.adler32(block), xxhash.xxh3_128_digest(block))
+
+def signature(path, block_size=DEFAULT_BLOCK_SIZE):
+    """Signature of a chunk's content. Returns (size, blob of one ENTRY per block)."""
+    with _mapped(path) as buf:
+        view = memoryview(buf)
+        try:
+            out = bytearray()
+            for pos in range(0, len(buf), block_size):
+                with view[pos : pos + block_size] as block:
+                    out += _entry(block)
+            return len(buf), bytes(out)
+        finally:
+            view.release()
+
+def _index(sig):
+    """
+    Returns (entries, weak set, {(weak, strong): first block}) of a signature
+    blob. Repeated blocks (zero runs above all) share one index entry, so a
+    lookup costs the same however often a block occurs.
+    """
+    entries = [ENTRY.unpack_from(sig, bi * ENTRY.size) for bi in range(len(sig) // ENTRY.size)]
+    index = {}
+    for bi, entry in enumerate(entries):
+        index.setdefault(entry, bi)
+    return entries, {weak for weak, _ in entries}, index
+
+def make(path, out, target_key, base_key=None, sig=b"", block_size=DEFAULT_BLOCK_SIZE, stats=None):
+    """
+    Writes to the file object out a delta that rebuilds the chunk at path from
+    the version signed by sig (named base_key). Blocks of the base are looked
+    for at every SEARCH_STEP offset, so data moved by whole device blocks is
+    still found; the rest goes out as literal bytes. Without a signature the
+    delta is the whole chunk. Returns the bytes written.
+    """
+    entries, weaks, index = _index(sig)
+    base_key, target_key = (base_key or "").encode(), target_key.encode()
+    written = 0
+
+    def emit(*parts):
+        nonlocal written
+        for p in parts:
+            out.write(p)
+            written += len(p)
+
+    with _mapped(path) as buf:
+        size = len(buf)
+        view = memoryview(buf)
+        try:
+            emit(HEADER.pack(MAGIC, block_size, size, len(base_key), len(target_key)), base_key, target_key)
+            digest = xxhash.xxh3_128()
+            run = None  # (start block, count) of base blocks waiting to be sent
+            lit = pos = 0
+            rolled = None  # (offset, weak sum) of the next window, when carried over
+            while pos < size:
+                with view[pos : pos + block_size] as window:
+                    hit = None
+                    weak = rolled[1] if rolled and rolled[0] == pos else zlib.adler32(window)
+                    if weak in weaks:
+                        entry = (weak, xxhash.xxh3_128_digest(window))
+                        # Prefer the block that continues the current run
+                        nxt = run[0] + run[1] if run else None
+                        if nxt is not None and nxt < len(entries) and entries[nxt] == entry:
+                            hit = nxt
+                        else:
+                            hit = index.get(entry)
+                    if hit is None:
+                        nxt = min(pos + SEARCH_STEP, size)
+                        # Slide the sum over the step instead of summing the next window afresh
+                        if SEARCH_STEP < block_size and nxt + block_size <= size:
+                            rolled = (nxt, _roll(weak, block_size, view[pos:nxt],
+                                                 view[pos + block_size : nxt + block_size]))
+                        pos = nxt
+                        if pos - lit >= MAX_LITERAL:
+                            if run:
+                                emit(OP_COPY, COPY.pack(*run))
+                                run = None
+                            emit(OP_DATA, DATA.pack(pos - lit), view[lit:pos])
+                            digest.update(view[lit:pos])
+                            if stats is not None: stats.literal += pos - lit
+                            lit = pos
+                        continue
+                    if lit < pos:
+                        if run:
+                            emit(OP_COPY, COPY.pack(*run))
+                            run = None
+                        emit(OP_DATA, DATA.pack(pos - lit), view[lit:pos])
+                        digest.update(view[lit:pos])
+                        if stats is not None: stats.literal += pos - lit
+                    if run and hit == run[0] + run[1]:
+                        run = (run[0], run[1] + 1)
+                    else:
+                        if run:
+                            emit(OP_COPY, COPY.pack(*run))
+                        run = (hit, 1)
+                    digest.update(window)
+                    pos += len(window)
+                    lit = pos
+            if run:
+                emit(OP_COPY, COPY.pack(*run))
+            if lit < size:
+                emit(OP_DATA, DATA.pack(size - lit), view[lit:size])
+                digest.update(view[lit:size])
+                if stats is not None: stats.literal += size - lit
+            emit(OP_END, digest.digest())
+        finally:
+            view.release()
+    if stats is not None:
+        stats.chunks += 1
+        stats.bytes += size
+        stats.delta += written
+    return written
+
+def _read_exact(src, n):
+    data = src.read(n)
+    if len(data) != n:
+        raise IOError("Delta is truncated")
+    return data
+
+def read_header(src):
+    """Returns (block size, target size, base key or None, target key) from the start of a delta."""
+    magic, block_size, size, base_len, target_len = HEADER.unpack(_read_exact(src, HEADER.size))
+    if magic != MAGIC:
+        raise IOError("Not a tgfs delta")
+    base_key = _read_exact(src, base_len).decode() or None
+    return block_size, size, base_key, _read_exact(src, target_len).decode()
+
+def apply(src, base_dir, dst_dir):
+    """
+    Rebuilds the target chunk of the delta read from file object src, taking
+    copied runs from its base chunk in base_dir, as dst_dir/<target key>. All-zero
+    ranges are left as holes. The result is checked against the digest the delta
+    ends with before it is renamed into place. Returns the target key.
+    """
+    block_size, size, base_key, target_key = read_header(src)
+    dst = os.path.join(dst_dir, target_key)
+    tmp = f"{dst}.tmp"
+    try:
+        if not _rebuild(src, base_dir, base_key, tmp, block_size, size):
+            raise IOError(f"{target_key} does not match its delta")
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.rename(tmp, dst)
+    return target_key
+
+def _rebuild(src, base_dir, base_key, tmp, block_size, size):
+    """Writes the target to tmp. Returns whether it matches the digest the delta ends with."""
+    with contextlib.ExitStack() as stack:
+        base = stack.enter_context(_mapped(os.path.join(base_dir, base_key))) if base_key else b""
+        f_out = stack.enter_context(open(tmp, "wb", buffering=0))
+        f_out.truncate(size)
+        digest = xxhash.xxh3_128()
+        pos = 0
+
+        def put(data):
+            nonlocal pos
+            digest.update(data)
+            if data.count(0) != len(data):
+                done = 0
+                while done < len(data):
+                    done += os.pwrite(f_out.fileno(), data[done:], pos + done)
+            pos += len(data)
+
+        while True:
+            op = _read_exact(src, 1)
+            if op == OP_END:
+                break
+            if op == OP_COPY:
+                start, count = COPY.unpack(_read_exact(src, COPY.size))
+                lo = start * block_size
+                hi = min(lo + count * block_size, len(base))
+                if hi <= lo:
+                    raise IOError(f"Delta copies blocks past the end of {base_key}")
+                for off in range(lo, hi, MAX_LITERAL):
+                    put(base[off : min(off + MAX_LITERAL, hi)])
+            elif op == OP_DATA:
+                (n,) = DATA.unpack(_read_exact(src, DATA.size))
+                put(_read_exact(src, n))
+            else:
+                raise IOError(f"Bad delta record {op!r}")
+        os.fsync(f_out.fileno())
+        return pos == size and _read_exact(src, 16) == digest.digest()
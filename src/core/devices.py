@@ -0,0 +1,32 @@
+import os
+import fcntl
+import contextlib
+from utils import shell
+
+# /dev/nbd0 .. nbd{N-1} are considered; the module is loaded with this many
+DEFAULT_DEVICES = 16
+# Serializes allocation between concurrent mounts and creates
+LOCK_FILE = ".nbd.lock"
+
+def is_connected(device):
+    """True while a server is attached to the device (the kernel then exposes its pid)."""
+    return os.path.exists(f"/sys/block/{os.path.basename(device)}/pid")
+
+@contextlib.contextmanager
+def claim(storage_root, taken, count=DEFAULT_DEVICES):
+    """
+    Yields a free /dev/nbdN. taken() returns the devices recorded by running
+    drives. The allocation lock is held until the block exits, so the caller
+    connects the device (or records it) before anyone else can pick it.
+    """
+    shell.run(["modprobe", "nbd", f"nbds_max={count}"], check=False)
+    with open(os.path.join(storage_root, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        busy = taken()
+        for i in range(count):
+            device = f"/dev/nbd{i}"
+            if os.path.exists(device) and device not in busy and not is_connected(device):
+                break
+        else:
+            raise IOError(f"No free NBD device among /dev/nbd0-{count - 1}.")
+        yield device
@@ -0,0 +1,120 @@
+import os
+import mmap
+import time
+import xxhash
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# xxhash drops the GIL while digesting, so a thread pool scales across cores
+ALGORITHMS = {
+    "xxh64": xxhash.xxh64,
+    "xxh3_128": xxhash.xxh3_128,
+}
+DEFAULT_ALGO = "xxh64"
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+# Feed the hasher in large slices so page faults and digesting overlap
+SLICE_SIZE = 64 * 1024 * 1024
+
+class HashStats:
+    """Throughput counters for one hashing run."""
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+        return self
+
+    @property
+    def mb_per_s(self):
+        return (self.bytes / (1024 * 1024)) / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return f"{self.files} files, {self.bytes / (1024 * 1024):.0f} MB in {self.elapsed:.2f}s ({self.mb_per_s:.0f} MB/s)"
+
+def new_hasher(algo=DEFAULT_ALGO):
+    if algo not in ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {algo}")
+    return ALGORITHMS[algo]()
+
+def hash_file(path, algo=DEFAULT_ALGO):
+    """Hashes a whole file through a read-only mmap. Returns (hexdigest, size)."""
+    hasher = new_hasher(algo)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for pos in range(0, size, SLICE_SIZE):
+                        hasher.update(view[pos : pos + SLICE_SIZE])
+                finally:
+                    view.release()
+    return hasher.hexdigest(), size
+
+def hash_blocks(path, block_size, indices=None, algo=DEFAULT_ALGO):
+    """
+    Hashes fixed-size blocks of a file (all of them, or only `indices`).
+    Returns ({block_index: hexdigest}, bytes_hashed).
+    """
+    leaves = {}
+    hashed = 0
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        count = -(-size // block_size)
+        if indices is None:
+            indices = range(count)
+        if not size:
+            return leaves, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for bi in sorted(indices):
+                    if bi >= count: continue
+                    with view[bi * block_size : (bi + 1) * block_size] as block:
+                        h = new_hasher(algo)
+                        h.update(block)
+                        leaves[bi] = h.hexdigest()
+                        hashed += len(block)
+            finally:
+                view.release()
+    return leaves, hashed
+
+def merkle_root(leaves, algo=DEFAULT_ALGO):
+    """Root hash over an ordered list of leaf hexdigests."""
+    h = new_hasher(algo)
+    for leaf in leaves:
+        h.update(bytes.fromhex(leaf))
+    return h.hexdigest()
+
+def _run(jobs, fn, workers, on_done):
+    stats = HashStats()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hasher") as pool:
+        futures = {pool.submit(fn, job): job for job in jobs}
+        for fut in as_completed(futures):
+            job = futures[fut]
+            result, size = fut.result()
+            results[job] = result
+            stats.files += 1
+            stats.bytes += size
+            if on_done:
+                on_done(job, result)
+    return results, stats.finish()
+
+def hash_files(paths, algo=DEFAULT_ALGO, workers=DEFAULT_WORKERS, on_done=None):
+    """
+    Hashes many files in parallel. Returns ({path: hexdigest}, HashStats).
+    on_done(path, hexdigest) is called from the caller's thread as results arrive.
+    """
+    return _run(paths, lambda p: hash_file(p, algo), workers, on_done)
+
+def hash_blocks_many(jobs, block_size, algo=DEFAULT_ALGO, workers=DEFAULT_WORKERS, on_done=None):
+    """
+    Parallel hash_blocks over {path: indices or None}. Returns ({path: leaves}, HashStats),
+    calling on_done(path, leaves) from the caller's thread as each file completes.
+    """
+    return _run(list(jobs), lambda p: hash_blocks(p, block_size, jobs[p], algo), workers, on_done)
@@ -0,0 +1,296 @@
+import os
+import stat
+import time
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from core import chunker, hasher, sparse, compress, tiered
+
+# Zero detection granularity: all-zero runs of whole pages are left as holes
+PAGE = 4096
+# Export reads ahead in units of this many bytes
+EXPORT_UNIT = 4 * 1024 * 1024
+
+IMPORT_EXT = ".import"
+
+class ImageStats:
+    """Throughput counters for one import or export."""
+    def __init__(self):
+        self.bytes = 0
+        self.written = 0
+        self.chunks = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+        return self
+
+    def __str__(self):
+        mb = lambda n: n / (1024 * 1024)
+        rate = mb(self.bytes) / self.elapsed if self.elapsed else 0.0
+        return (f"{mb(self.bytes):.0f} MB in {self.elapsed:.2f}s ({rate:.0f} MB/s), "
+                f"{mb(self.written):.0f} MB of data, {self.chunks} chunks")
+
+def data_runs(buf, start, end, zero):
+    """
+    (start, end) runs of buf[start:end] that are not all zero, at PAGE
+    granularity. zero is a bytes of zeroes at least end - start long;
+    bytearray.startswith compares in place with memcmp.
+    """
+    if buf.startswith(zero[: end - start], start):
+        return []
+    runs = []
+    for pos in range(start, end, PAGE):
+        n = min(PAGE, end - pos)
+        if buf.startswith(zero[:n], pos):
+            continue
+        if runs and runs[-1][1] == pos:
+            runs[-1] = (runs[-1][0], pos + n)
+        else:
+            runs.append((pos, pos + n))
+    return runs
+
+def _pwrite_all(fd, view, offset):
+    done = 0
+    while done < len(view):
+        done += os.pwrite(fd, view[done:], offset + done)
+
+def _read_full(src, view):
+    """Fills view from a file or pipe; short only at end of input. Returns bytes read."""
+    got = 0
+    while got < len(view):
+        n = src.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+class Importer:
+    """
+    Streams a raw image into a stopped drive's chunk files in one pass.
+    The input is read sequentially one Merkle block at a time; worker threads
+    write each block's non-zero pages into a new sparse file for its chunk and
+    hash the block, so blocks of the current and previous chunks are stored in
+    parallel. Once all blocks of a chunk are in, its root names the file
+    (chunker.format_name) and the DB gets the chunk and leaf rows, exactly as
+    check_drive would leave them. Chunks past the end of the image are reset
+    to zeroes.
+    """
+    def __init__(self, drive_path, drive_name, db, workers=hasher.DEFAULT_WORKERS):
+        self.root = drive_path
+        self.name = drive_name
+        self.db = db
+        self.workers = max(1, workers)
+
+        meta = db.get_all_meta()
+        self.algo = meta.get("hash_algo") or hasher.DEFAULT_ALGO
+        self.total_chunks = int(meta["total_chunks"])
+        self.chunk_size = int(meta["chunk_size_mb"]) * 1024 * 1024
+        self.block_size = int(meta["block_size_mb"]) * 1024 * 1024
+        self.total_size = self.total_chunks * self.chunk_size
+        self.padding = chunker.get_padding(self.total_chunks)
+        self.zero_leaf = chunker.get_zero_hash(self.block_size, self.algo)
+        self.zero_root = chunker.get_zero_root(self.chunk_size, self.block_size, self.algo)
+        self.zero = bytes(self.block_size)
+        self.rows = {c['chunk_index']: c for c in db.get_chunks()}
+        self.stats = ImageStats()
+        # Set by run() if the input went on past the end of the drive
+        self.overflow = False
+
+    def _store(self, fd, buf, n, chunk_offset, free):
+        """Worker: writes the data pages of one block. Returns (leaf hash, bytes written)."""
+        try:
+            runs = data_runs(buf, 0, n, self.zero)
+            if not runs:
+                return self.zero_leaf, 0
+            view = memoryview(buf)
+            try:
+                for lo, hi in runs:
+                    _pwrite_all(fd, view[lo:hi], chunk_offset + lo)
+                h = hasher.new_hasher(self.algo)
+                h.update(view[:n])
+                # The rest of the last block is file hole, i.e. zeroes
+                h.update(self.zero[n:])
+            finally:
+                view.release()
+            return h.hexdigest(), sum(hi - lo for lo, hi in runs)
+        finally:
+            free.put(buf)
+
+    def _open_chunk(self, chunk_idx):
+        tmp = os.path.join(self.root, f"{self.name}.{chunk_idx}{IMPORT_EXT}")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, self.chunk_size)
+        return tmp, fd
+
+    def _finish(self, chunk_idx, tmp, fd, futures):
+        """Names a fully written chunk by its root and records it, replacing the old file."""
+        try:
+            leaves = {}
+            for bi, f in futures.items():
+                leaves[bi], written = f.result()
+                self.stats.written += written
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        h = chunker.get_root(leaves, self.chunk_size, self.block_size, self.algo)
+        new_name = chunker.format_name(self.name, chunk_idx, h, self.padding)
+        os.rename(tmp, os.path.join(self.root, new_name))
+        st = os.stat(os.path.join(self.root, new_name))
+
+        old = self.rows.get(chunk_idx)
+        with self.db.transaction():
+            self.db.update_block_hashes(chunk_idx, leaves, self.zero_leaf, replace=True)
+            self.db.update_chunk(chunk_idx, h, new_name, st.st_size, st.st_mtime)
+            self.db.clear_dirty([chunk_idx])
+            self.db.clear_tier_units(chunk_idx)
+        if old:
+            # The old file in either form, or in the tier; snapshots and clones
+            # keep their own hard links to it
+            raw = compress.raw_name(old['filename']) if compress.is_packed(old['filename']) else old['filename']
+            stale = [os.path.join(self.root, f) for f in {raw, compress.packed_name(raw)} - {new_name}]
+            # An unpack a mount left unfinished
+            pack = os.path.join(self.root, compress.packed_name(raw))
+            stale += [compress.part_name(pack), compress.map_name(pack)]
+            stale.append(os.path.join(self.root, tiered.TIER_DIR, old['filename']))
+            for path in stale:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.stats.chunks += 1
+
+    def _reset(self, chunk_idx):
+        """Gives a chunk past the end of the image an all-zero file, unless it has one."""
+        old = self.rows.get(chunk_idx)
+        if old and old['hash'] == self.zero_root and os.path.exists(os.path.join(self.root, old['filename'])):
+            return
+        tmp, fd = self._open_chunk(chunk_idx)
+        self._finish(chunk_idx, tmp, fd, {})
+
+    def run(self, src):
+        """Imports from the binary file object src. Returns ImageStats."""
+        blocks_per_chunk = self.chunk_size // self.block_size
+        # Two buffers per worker: one being stored while the next is read
+        free = queue.Queue()
+        for _ in range(self.workers * 2):
+            free.put(bytearray(self.block_size))
+
+        pending = collections.deque()
+        eof = False
+        chunk_idx = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="import") as pool:
+                while chunk_idx < self.total_chunks and not eof:
+                    tmp, fd = self._open_chunk(chunk_idx)
+                    futures = {}
+                    pending.append((chunk_idx, tmp, fd, futures))
+                    for bi in range(blocks_per_chunk):
+                        buf = free.get()
+                        n = _read_full(src, memoryview(buf))
+                        if not n:
+                            free.put(buf)
+                            eof = True
+                            break
+                        self.stats.bytes += n
+                        futures[bi] = pool.submit(self._store, fd, buf, n, bi * self.block_size, free)
+                        if n < self.block_size:
+                            eof = True
+                            break
+                    chunk_idx += 1
+                    # The previous chunk's blocks are done or nearly so
+                    while len(pending) > 1:
+                        self._finish(*pending.popleft())
+
+                self.overflow = not eof and bool(src.read(1))
+                while pending:
+                    self._finish(*pending.popleft())
+        finally:
+            for _, tmp, fd, _ in pending:
+                os.close(fd)
+                os.remove(tmp)
+
+        for idx in range(chunk_idx, self.total_chunks):
+            self._reset(idx)
+        dir_fd = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return self.stats.finish()
+
+def export(vdisk, dst, workers=hasher.DEFAULT_WORKERS):
+    """
+    Streams the whole disk to the file descriptor dst in order. Units are read
+    through the VirtualDisk ahead of the writer by a worker pool; holes (per
+    block status, or all-zero pages) are skipped with a seek when dst is a
+    regular file, so the copy stays sparse, and sent as zeroes to a pipe.
+    Returns ImageStats.
+    """
+    stats = ImageStats()
+    # Only a regular file reads back zeroes where nothing was written
+    seekable = stat.S_ISREG(os.fstat(dst).st_mode)
+    base = os.lseek(dst, 0, os.SEEK_CUR) if seekable else 0
+    zero = bytes(EXPORT_UNIT)
+
+    def read(offset):
+        n = min(EXPORT_UNIT, vdisk.total_size - offset)
+        buf = bytearray(n)
+        runs = []
+        pos = 0
+        for length, hole in vdisk.extents(offset, n):
+            if not hole:
+                vdisk.read_into(memoryview(buf)[pos : pos + length], offset + pos)
+                runs.extend(data_runs(buf, pos, pos + length, zero) if seekable else [(pos, pos + length)])
+            pos += length
+        return buf, runs
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="export") as pool:
+        window = collections.deque()
+        offsets = iter(range(0, vdisk.total_size, EXPORT_UNIT))
+        for offset in offsets:
+            window.append((offset, pool.submit(read, offset)))
+            if len(window) >= workers * 2:
+                break
+        while window:
+            offset, fut = window.popleft()
+            buf, runs = fut.result()
+            nxt = next(offsets, None)
+            if nxt is not None:
+                window.append((nxt, pool.submit(read, nxt)))
+
+            view = memoryview(buf)
+            try:
+                pos = 0
+                for lo, hi in runs:
+                    if lo > pos and not seekable:
+                        _write_all(dst, sparse.ZEROES, lo - pos)
+                    if seekable:
+                        _pwrite_all(dst, view[lo:hi], base + offset + lo)
+                    else:
+                        _write_all(dst, view[lo:hi])
+                    stats.written += hi - lo
+                    pos = hi
+                if pos < len(buf) and not seekable:
+                    _write_all(dst, sparse.ZEROES, len(buf) - pos)
+            finally:
+                view.release()
+            stats.bytes += len(buf)
+
+    if seekable:
+        # Trailing holes still count towards the size
+        os.ftruncate(dst, base + vdisk.total_size)
+        os.lseek(dst, base + vdisk.total_size, os.SEEK_SET)
+    stats.chunks = vdisk.total_chunks
+    return stats.finish()
+
+def _write_all(fd, data, length=None):
+    """Writes data to fd in full; with length, writes that many bytes of repeated data instead."""
+    if length is None:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        return
+    while length > 0:
+        n = min(length, len(data))
+        _write_all(fd, data[:n])
+        length -= n
@@ -1,38 +1,261 @@
 import os
 import collections
-from core import chunker
+import contextlib
+import queue
+import threading
+from core import sparse, compress
+from core.prefetch import ReadAhead
+
+CACHE_BLOCK = 4096
+# Linux IOV_MAX: the most buffers a single pwritev accepts
+IOV_MAX = 1024
+# Pack blocks the background unpack copies per hold of the chunk lock
+UNPACK_BATCH = 8
+
+def _datasync(f):
+    """fdatasync of a chunk handle; an unpacking chunk also persists its map of copied blocks."""
+    if isinstance(f, compress.Unpacking):
+        f.sync()
+    else:
+        os.fdatasync(f.fileno())
+
+class WriteBackCache:
+    """
+    Memory-bounded write-back cache of dirty 4K blocks, keyed by chunk.
+    Repeated writes to a block (filesystem metadata hot spots) are absorbed in
+    memory, and contiguous dirty blocks go out as one pwritev on flush.
+    A chunk's block dict is only touched under that chunk's VirtualDisk lock;
+    _lock guards the outer map and the byte count.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.dirty_bytes = 0
+        # chunk_idx -> {block_no: bytearray}, oldest-dirtied chunk first
+        self.chunks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def put(self, chunk_idx, fd, offset, data):
+        """Copies `data` into cached blocks, reading in the rest of partial blocks."""
+        with self._lock:
+            blocks = self.chunks.setdefault(chunk_idx, {})
+        end = offset + len(data)
+        pos = 0
+        added = touched = 0
+        while offset < end:
+            block_no = offset // CACHE_BLOCK
+            base = block_no * CACHE_BLOCK
+            lo, hi = offset - base, min(end - base, CACHE_BLOCK)
+
+            buf = blocks.get(block_no)
+            if buf is None:
+                buf = bytearray(CACHE_BLOCK)
+                if lo or hi < CACHE_BLOCK:
+                    os.preadv(fd, [buf], base)
+                blocks[block_no] = buf
+                added += 1
+            touched += 1
+
+            buf[lo:hi] = data[pos : pos + hi - lo]
+            pos += hi - lo
+            offset = base + hi
+
+        with self._lock:
+            self.dirty_bytes += added * CACHE_BLOCK
+            self.stats["writes"] += 1
+            # Blocks that were already dirty: writes that never reach the disk
+            self.stats["absorbed"] += touched - added
+
+    def overlay(self, chunk_idx, view, offset):
+        """Patches dirty blocks over data just read from disk for [offset, offset + len(view))."""
+        blocks = self.chunks.get(chunk_idx)
+        if not blocks:
+            return
+        end = offset + len(view)
+        hits = 0
+        for block_no in range(offset // CACHE_BLOCK, -(-end // CACHE_BLOCK)):
+            buf = blocks.get(block_no)
+            if buf is None: continue
+            base = block_no * CACHE_BLOCK
+            lo, hi = max(offset, base), min(end, base + CACHE_BLOCK)
+            view[lo - offset : hi - offset] = buf[lo - base : hi - base]
+            hits += 1
+        with self._lock:
+            self.stats["read_hits"] += hits
+
+    def has_dirty(self, chunk_idx, offset, length):
+        # Called without the chunk lock (read path), so a put may be adding
+        # blocks: iterate a copy of the keys, taken in one step under the GIL
+        blocks = self.chunks.get(chunk_idx)
+        if not blocks:
+            return False
+        first, last = offset // CACHE_BLOCK, -(-(offset + length) // CACHE_BLOCK)
+        if last - first > len(blocks):
+            return any(first <= b < last for b in list(blocks))
+        return any(b in blocks for b in range(first, last))
+
+    def dirty_ranges(self, chunk_idx, offset, length):
+        """Merged (start, end) ranges of dirty blocks within [offset, offset + length), in order."""
+        blocks = self.chunks.get(chunk_idx)
+        if not blocks:
+            return []
+        end = offset + length
+        first, last = offset // CACHE_BLOCK, -(-end // CACHE_BLOCK)
+        ranges = []
+        for block_no in sorted(b for b in list(blocks) if first <= b < last):
+            lo, hi = max(offset, block_no * CACHE_BLOCK), min(end, (block_no + 1) * CACHE_BLOCK)
+            if ranges and ranges[-1][1] == lo:
+                ranges[-1] = (ranges[-1][0], hi)
+            else:
+                ranges.append((lo, hi))
+        return ranges
+
+    def flush_chunk(self, chunk_idx, fd):
+        """Writes out a chunk's dirty blocks, merging contiguous runs into pwritev calls."""
+        with self._lock:
+            blocks = self.chunks.pop(chunk_idx, None)
+        if not blocks:
+            return
+
+        runs = []
+        for block_no in sorted(blocks):
+            run_start, run = runs[-1] if runs else (None, None)
+            if run is None or block_no != run_start + len(run) or len(run) == IOV_MAX:
+                runs.append((block_no, [blocks[block_no]]))
+            else:
+                run.append(blocks[block_no])
+
+        syscalls = 0
+        try:
+            for run_start, run in runs:
+                syscalls += self._write_run(fd, run_start, run)
+        except OSError:
+            # Keep the data: put the blocks back so a later flush can retry
+            with self._lock:
+                self.chunks[chunk_idx] = blocks
+            raise
+
+        with self._lock:
+            self.dirty_bytes -= len(blocks) * CACHE_BLOCK
+            self.stats["syscalls"] += syscalls
+            self.stats["flushed_bytes"] += len(blocks) * CACHE_BLOCK
+
+    def _write_run(self, fd, block_no, bufs):
+        """Writes one contiguous run of blocks. Returns the syscall count."""
+        offset = block_no * CACHE_BLOCK
+        total = len(bufs) * CACHE_BLOCK
+        done = os.pwritev(fd, bufs, offset)
+        syscalls = 1
+        if done < total:
+            # Short vectored write: finish the tail with plain pwrite
+            tail = memoryview(b"".join(bufs))
+            while done < total:
+                done += os.pwrite(fd, tail[done:], offset + done)
+                syscalls += 1
+        return syscalls
+
+    def over_budget(self):
+        return self.dirty_bytes > self.max_bytes
+
+    def oldest(self):
+        with self._lock:
+            return next(iter(self.chunks), None)
+
+    def dirty_chunks(self):
+        with self._lock:
+            return list(self.chunks)
 
 class VirtualDisk:
     """
     The abstraction layer that treats a folder of chunk files as a single block device.
     Implements an LRU cache for file handles to support unlimited chunks.
+    Thread-safe: I/O on a chunk is serialized by a per-chunk lock, so requests
+    touching different chunks run in parallel.
     """
-    def __init__(self, drive_path, drive_name, chunk_size_mb, total_chunks, read_only=False):
+    def __init__(self, drive_path, drive_name, chunk_size_mb, total_chunks, read_only=False, journal=None,
+                 cache_mb=0, cache_flush_interval=5.0, readahead_mb=0, db=None):
         self.root = drive_path
         self.name = drive_name
         self.chunk_size = chunk_size_mb * 1024 * 1024
         self.total_chunks = total_chunks
         self.total_size = total_chunks * self.chunk_size
         self.read_only = read_only
+        # Optional DirtyJournal recording every modified range for check_drive
+        self.journal = journal
+        # Drive DB: source of the chunk map, kept current when a chunk file is renamed
+        self.db = db
         
-        # Maps chunk_index -> {filename, handle}
-        # We assume initial filenames from a scan or DB. 
-        # For MVP speed, we just look for files matching the pattern on demand? 
-        # No, that's too slow. We need a fast index.
+        # Maps chunk_index -> filename
         self.chunk_map = {} 
         self._scan_chunks()
+        # Chunks whose file was checked to have no other hard links (snapshots,
+        # clones), so writing it in place is safe; see _own
+        self.owned = set()
 
         # LRU Cache for open file descriptors
         self.open_files = collections.OrderedDict() 
         self.max_open_files = 64
+        # fd cache hits/misses/evictions, updated under _table_lock
+        self.stats = collections.Counter()
+
+        # _table_lock guards open_files and handle refcounts. It is never held
+        # while waiting on a chunk lock, so lock order is always chunk -> table.
+        self._table_lock = threading.Lock()
+        self._chunk_locks = collections.defaultdict(threading.Lock)
+        self._users = collections.Counter()
+        self._retired = set()
+
+        # Chunks written since the last sync and folders whose entries changed
+        # (renamed chunk files): all that FLUSH has to make durable
+        self._unsynced = set()
+        self._unsynced_dirs = set()
+        self._unsynced_lock = threading.Lock()
+        # Group commit: a FLUSH waits for the first sync round that starts after
+        # it arrived, so concurrent FLUSHes share one round
+        self._sync_cond = threading.Condition()
+        self._sync_running = False
+        self._sync_started = 0
+        self._sync_done = 0
+        # Failed round -> its error, kept until every FLUSH waiting on it has seen it
+        self._sync_errors = {}
+        self._sync_waiters = collections.Counter()
+        # FLUSH requests, rounds run for them and chunks synced, under _sync_cond
+        self.sync_stats = collections.Counter()
+
+        # Optional write-back cache, drained by FLUSH, memory pressure and a timer
+        self.cache = None
+        if cache_mb and not read_only:
+            self.cache = WriteBackCache(cache_mb * 1024 * 1024)
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(
+                target=self._flush_loop, args=(cache_flush_interval,), daemon=True, name="wb-flush"
+            )
+            self._flusher.start()
+
+        # chunk_idx -> compress.Unpacking of packed chunks being unpacked after a
+        # write; one thread copies the rest of each. _unpack_lock nests inside
+        # _table_lock (handles are opened under it)
+        self._unpacking = {}
+        self._unpack_lock = threading.Lock()
+        self._unpack_queue = None
+        self._unpacker = None
+
+        # Optional sequential read-ahead, filled from disk by background threads
+        self.readahead = None
+        if readahead_mb:
+            self.readahead = ReadAhead(self._read_disk, self.total_size, readahead_mb * 1024 * 1024)
 
     def _scan_chunks(self):
-        """Builds an in-memory map of index -> filename."""
-        padding = chunker.get_padding(self.total_chunks)
-        # Scan dir
+        """
+        Builds the in-memory map of index -> filename: one query against the
+        drive DB, or a scan of the folder when there is none (snapshots, bench).
+        """
+        if self.db:
+            self.chunk_map.update(self.db.get_chunk_files())
+            return
         for f in os.listdir(self.root):
             if not f.startswith(f"{self.name}."): continue
-            if not f.endswith(".img"): continue
+            if not f.endswith(compress.RAW_EXT) and not compress.is_packed(f): continue
             
             parts = f.split('.')
             if len(parts) < 4: continue
@@ -43,82 +266,690 @@ class VirtualDisk:
             except ValueError:
                 continue
 
-    def _get_file_handle(self, chunk_idx):
-        """Returns an open file object for the chunk, managing LRU cache."""
+    def _relocate(self, chunk_idx):
+        """
+        Finds the file of a chunk whose mapped name is gone. The DB filename is
+        only refreshed by check, so after a crash it can still name the packed
+        form of a chunk that was unpacked (or the reverse). Lists the folder, so
+        only done on that miss. Must be called with _table_lock held.
+        """
+        for f in os.listdir(self.root):
+            if not f.startswith(f"{self.name}."): continue
+            if not f.endswith(compress.RAW_EXT) and not compress.is_packed(f): continue
+            parts = f.split('.')
+            if len(parts) >= 4 and parts[1].isdigit() and int(parts[1]) == chunk_idx:
+                self.chunk_map[chunk_idx] = f
+                if self.db:
+                    self.db.rename_chunk(chunk_idx, f)
+                return f
+        raise IOError(f"Chunk {chunk_idx} missing on disk.")
+
+    def _chunk_path(self, chunk_idx):
+        """Path of the file backing a chunk, relative to the drive folder."""
         if chunk_idx not in self.chunk_map:
             # Chunk file missing? Should not happen if initialized correctly.
             # In a real scenario, we might create it if it's sparse?
             # For now, raise error.
             raise IOError(f"Chunk {chunk_idx} missing on disk.")
+        return self.chunk_map[chunk_idx]
+
+    def _writable(self, chunk_idx):
+        return not self.read_only
+
+    def _written(self, chunk_idx):
+        """Called under the chunk lock by every write, so the next sync covers it."""
+        with self._unsynced_lock:
+            self._unsynced.add(chunk_idx)
+
+    def _renamed(self, path):
+        """Called after a chunk file is renamed into place, so the next sync covers the folder entry."""
+        with self._unsynced_lock:
+            self._unsynced_dirs.add(os.path.dirname(path))
+
+    def _before_write(self, chunk_idx):
+        """Hook run under the chunk lock before any modification of the chunk."""
+        filename = self.chunk_map.get(chunk_idx)
+        if filename and chunk_idx not in self.owned and not os.path.exists(os.path.join(self.root, filename)):
+            with self._table_lock:
+                filename = self._relocate(chunk_idx)
+        if filename and compress.is_packed(filename):
+            self._begin_unpack(chunk_idx, filename)
+        if chunk_idx not in self.owned:
+            self._own(chunk_idx)
+
+    def _own(self, chunk_idx):
+        """
+        Copy-on-write for chunks shared with a snapshot or clone by hard link: the
+        first write gives the drive its own copy, so the other names keep the old
+        data. Costs one stat per chunk after mount or snapshot, and a copy of the
+        chunk's data extents when it is shared.
+        """
+        path = os.path.join(self.root, self._chunk_path(chunk_idx))
+        st = os.stat(path)
+        # An unpack writes a new raw file and never the pack
+        if st.st_nlink > 1 and not compress.is_packed(path):
+            tmp = f"{path}.cow"
+            with open(path, "rb", buffering=0) as src, open(tmp, "wb", buffering=0) as dst:
+                sparse.copy_sparse(src.fileno(), dst.fileno(), st.st_size)
+            os.rename(tmp, path)
+            self._renamed(path)
+            with self._table_lock:
+                # The cached handle is the shared inode
+                old = self.open_files.pop(chunk_idx, None)
+                if old:
+                    self._retire(old)
+        self.owned.add(chunk_idx)
+
+    def _begin_unpack(self, chunk_idx, filename):
+        """
+        Packed chunks are read-only; the first write swaps the handle for a
+        compress.Unpacking, which copies out of the pack only the blocks each
+        write touches. A background thread copies the rest, then renames the
+        raw file into place (_unpack_step).
+        """
+        with self._unpack_lock:
+            if chunk_idx in self._unpacking:
+                return
+        path = os.path.join(self.root, filename)
+        self._track_unpack(chunk_idx, compress.Unpacking(path))
+        # New folder entries: the raw file and the map
+        self._renamed(path)
+        with self._table_lock:
+            # The packed reader; the next _pin opens the Unpacking
+            old = self.open_files.pop(chunk_idx, None)
+            if old:
+                self._retire(old)
 
-        filename = self.chunk_map[chunk_idx]
+    def _track_unpack(self, chunk_idx, f):
+        """Keeps the chunk's Unpacking until it finishes and queues it for the background copy."""
+        with self._unpack_lock:
+            self._unpacking[chunk_idx] = f
+            if not self._unpacker:
+                self._unpack_queue = queue.Queue()
+                self._unpacker = threading.Thread(target=self._unpack_loop, daemon=True, name="unpack")
+                self._unpacker.start()
+        self._unpack_queue.put(chunk_idx)
+
+    def _unpack_loop(self):
+        while True:
+            chunk_idx = self._unpack_queue.get()
+            if chunk_idx is None:
+                return
+            while self._unpack_step(chunk_idx, UNPACK_BATCH):
+                pass
+
+    def _unpack_step(self, chunk_idx, batch=None):
+        """
+        Copies the next `batch` blocks (all by default) of an unpacking chunk
+        under its lock, so requests interleave; after the last one, renames the
+        raw file into place. Returns True while blocks remain.
+        """
+        with self._chunk(chunk_idx) as f:
+            return self._advance_unpack(chunk_idx, f, batch)
+
+    def _advance_unpack(self, chunk_idx, f, batch):
+        """_unpack_step with the chunk lock held and its handle pinned."""
+        if not isinstance(f, compress.Unpacking):
+            return False
+        f.fill(batch)
+        if not f.complete:
+            return True
+        raw = f.finish()
+        self._renamed(raw)
+        name = os.path.basename(raw)
+        with self._unpack_lock:
+            del self._unpacking[chunk_idx]
+        with self._table_lock:
+            self.chunk_map[chunk_idx] = name
+            if self.open_files.get(chunk_idx) is f:
+                del self.open_files[chunk_idx]
+            self._retire(f)
+        if self.db:
+            self.db.rename_chunk(chunk_idx, name)
+        return False
+
+    def _resident(self, chunk_idx, chunk_offset, length):
+        """
+        Hook wrapped around every read of a chunk range, outside the chunk lock:
+        makes the range available locally and keeps it there until the block exits.
+        """
+        return contextlib.nullcontext()
+
+    def _get_file_handle(self, chunk_idx):
+        """
+        Returns an open file object for the chunk, managing LRU cache.
+        Must be called with _table_lock held; the caller pins the handle.
+        """
+        filename = self._chunk_path(chunk_idx)
         
         # If already open, move to end (MRU)
         if chunk_idx in self.open_files:
             self.open_files.move_to_end(chunk_idx)
+            self.stats["fd_hits"] += 1
             return self.open_files[chunk_idx]
+        self.stats["fd_misses"] += 1
 
-        # If cache full, pop oldest (LRU)
-        if len(self.open_files) >= self.max_open_files:
+        # If cache full, pop oldest (LRU); resize() may have lowered the limit
+        while self.open_files and len(self.open_files) >= self.max_open_files:
             old_idx, old_f = self.open_files.popitem(last=False)
-            old_f.close()
+            self._retire(old_f)
+            self.stats["fd_evictions"] += 1
 
-        # Open new
-        path = os.path.join(self.root, filename)
-        mode = "rb" if self.read_only else "r+b"
-        f = open(path, mode)
+        try:
+            f = self._open(chunk_idx, filename)
+        except FileNotFoundError:
+            f = self._open(chunk_idx, self._relocate(chunk_idx))
         self.open_files[chunk_idx] = f
         return f
 
-    def read(self, offset, length):
+    def _open(self, chunk_idx, filename):
+        # Unbuffered, so the fd always reflects every write and can feed
+        # sendfile directly; all I/O goes through pread/pwrite on it.
+        path = os.path.join(self.root, filename)
+        if compress.is_packed(filename):
+            with self._unpack_lock:
+                f = self._unpacking.get(chunk_idx)
+            if f:
+                return f
+            if os.path.exists(compress.part_name(path)):
+                # Left by a daemon that did not close: carry on with the unpack
+                f = compress.Unpacking(path, writable=self._writable(chunk_idx))
+                if f.writable:
+                    self._track_unpack(chunk_idx, f)
+                return f
+            if compress.recover(path) != path:
+                # The unpack was done but for tidying up: _relocate finds the raw file
+                raise FileNotFoundError(path)
+            return compress.PackedReader(path)
+        mode = "r+b" if self._writable(chunk_idx) else "rb"
+        return open(path, mode, buffering=0)
+
+    def _retire(self, f):
+        """Closes an evicted handle now, or once its last user releases it."""
+        if isinstance(f, compress.Unpacking):
+            with self._unpack_lock:
+                # Lives until the unpack finishes: its map of copied blocks is the only current one
+                if any(u is f for u in self._unpacking.values()):
+                    return
+        if self._users[f]:
+            self._retired.add(f)
+        else:
+            f.close()
+
+    def _release(self, f):
+        with self._table_lock:
+            self._users[f] -= 1
+            if not self._users[f]:
+                del self._users[f]
+                if f in self._retired:
+                    self._retired.discard(f)
+                    f.close()
+
+    def _pin(self, chunk_idx):
+        """Returns the chunk's handle with a reference held; pair with _release."""
+        with self._table_lock:
+            f = self._get_file_handle(chunk_idx)
+            self._users[f] += 1
+            return f
+
+    @contextlib.contextmanager
+    def _chunk(self, chunk_idx, write=False):
+        """Locks a chunk and yields its pinned file handle."""
+        with self._table_lock:
+            lock = self._chunk_locks[chunk_idx]
+        with lock:
+            if write:
+                self._before_write(chunk_idx)
+            f = self._pin(chunk_idx)
+            try:
+                yield f
+            finally:
+                self._release(f)
+
+    def _segments(self, offset, length):
+        """Splits a device range into (chunk_idx, chunk_offset, length) pieces."""
         if offset + length > self.total_size:
             length = self.total_size - offset
-        
-        result = bytearray()
+
         while length > 0:
             chunk_idx = offset // self.chunk_size
             chunk_offset = offset % self.chunk_size
-            to_read = min(length, self.chunk_size - chunk_offset)
+            n = min(length, self.chunk_size - chunk_offset)
+            yield chunk_idx, chunk_offset, n
+            length -= n
+            offset += n
+
+    def read_into(self, view, offset):
+        """Reads into a caller-owned buffer, from read-ahead or disk. Returns bytes filled."""
+        if not self.readahead:
+            return self._read_disk(view, offset)
+
+        view = view[:max(0, min(len(view), self.total_size - offset))]
+        hit = bool(view) and self.readahead.serve(view, offset)
+        if not hit:
+            self._read_disk(view, offset)
+        self.readahead.observe(offset, len(view), hit)
+        return len(view)
+
+    def _read_disk(self, view, offset):
+        """Reads straight into a caller-owned buffer with preadv. Returns bytes filled."""
+        pos = 0
+        for chunk_idx, chunk_offset, n in self._segments(offset, len(view)):
+            with self._resident(chunk_idx, chunk_offset, n), self._chunk(chunk_idx) as f:
+                got = 0
+                if isinstance(f, compress.PackedReader):
+                    got = f.read_into(view[pos : pos + n], chunk_offset)
+                else:
+                    while got < n:
+                        r = os.preadv(f.fileno(), [view[pos + got : pos + n]], chunk_offset + got)
+                        if not r: break
+                        got += r
 
-            f = self._get_file_handle(chunk_idx)
-            f.seek(chunk_offset)
-            data = f.read(to_read)
-            
-            if len(data) < to_read:
                 # Pad with zeros if file is shorter than expected (sparse)
-                data += b'\x00' * (to_read - len(data))
-            
-            result.extend(data)
-            length -= len(data)
-            offset += len(data)
+                while got < n:
+                    z = min(n - got, sparse.ZERO_BLOCK_SIZE)
+                    view[pos + got : pos + got + z] = sparse.ZEROES[:z]
+                    got += z
+
+                if self.cache:
+                    self.cache.overlay(chunk_idx, view[pos : pos + n], chunk_offset)
+            pos += n
+        return pos
+
+    def read(self, offset, length):
+        if offset + length > self.total_size:
+            length = self.total_size - offset
         
-        return bytes(result)
+        result = bytearray(length)
+        self.read_into(memoryview(result), offset)
+        return result
+
+    def in_memory(self, offset, length):
+        """
+        True if the range is better served from memory than from the chunk files:
+        part of it is only in the write-back cache or in a packed chunk (which has
+        to be decompressed), or read-ahead holds all of it.
+        """
+        if self.readahead and self.readahead.has(offset, length):
+            return True
+        segments = list(self._segments(offset, length))
+        if any(compress.is_packed(self.chunk_map.get(i, "")) for i, _, _ in segments):
+            return True
+        if not self.cache:
+            return False
+        return any(self.cache.has_dirty(i, o, n) for i, o, n in segments)
+
+    @contextlib.contextmanager
+    def pinned(self, offset, length):
+        """
+        Pins every chunk handle a range touches and yields (file, chunk_offset, length)
+        segments, so a caller can commit to a reply before streaming it with sendfile.
+        """
+        if self.readahead:
+            self.readahead.observe(offset, length, False)
+        segments = []
+        try:
+            for chunk_idx, chunk_offset, n in self._segments(offset, length):
+                # Once pinned, the open handle keeps the data readable on its own
+                with self._resident(chunk_idx, chunk_offset, n):
+                    segments.append((self._pin(chunk_idx), chunk_offset, n))
+            yield segments
+        finally:
+            for f, _, _ in segments:
+                self._release(f)
+
+    def sendfile(self, sock, segments):
+        """Streams pinned segments from the chunk files to a socket without copying."""
+        out_fd = sock.fileno()
+        for f, chunk_offset, n in segments:
+            sent = 0
+            while sent < n:
+                r = os.sendfile(out_fd, f.fileno(), chunk_offset + sent, n - sent)
+                if not r: break
+                sent += r
+
+            # Short file (sparse tail): fill from the shared zero buffer
+            while sent < n:
+                z = min(n - sent, sparse.ZERO_BLOCK_SIZE)
+                sock.sendall(sparse.ZEROES[:z])
+                sent += z
+
+    def _extents(self, chunk_idx, chunk_offset, length):
+        """(length, hole) runs of one chunk range, from the allocation of its file."""
+        try:
+            self._chunk_path(chunk_idx)
+        except IOError:
+            # No file at all: nothing is stored for the chunk
+            return [(length, True)]
+        f = self._pin(chunk_idx)
+        try:
+            if isinstance(f, compress.PackedReader):
+                return f.extents(chunk_offset, chunk_offset + length)
+            return sparse.extents(f.fileno(), chunk_offset, chunk_offset + length)
+        finally:
+            self._release(f)
+
+    def extents(self, offset, length):
+        """
+        Allocation map of a device range as (length, hole) runs, merged across
+        chunks, for NBD block status. Holes (never written, trimmed, all-zero
+        packed blocks, missing chunks) read as zeroes; blocks waiting in the
+        write-back cache count as data.
+        """
+        runs = []
 
-    def write(self, offset, data):
+        def add(n, hole):
+            if runs and runs[-1][1] == hole:
+                runs[-1] = (runs[-1][0] + n, hole)
+            elif n:
+                runs.append((n, hole))
+
+        for chunk_idx, chunk_offset, n in self._segments(offset, length):
+            pos = chunk_offset
+            for run, hole in self._extents(chunk_idx, chunk_offset, n):
+                end = pos + run
+                if hole and self.cache:
+                    for lo, hi in self.cache.dirty_ranges(chunk_idx, pos, run):
+                        add(lo - pos, True)
+                        add(hi - lo, False)
+                        pos = hi
+                add(end - pos, hole)
+                pos = end
+        return runs
+
+    def write(self, offset, data, fua=False):
+        """Writes data at offset. With fua the data is durable on return (NBD FUA), without a full sync."""
         if self.read_only: raise IOError("Read-only mode")
         
-        length = len(data)
-        data_offset = 0
+        # Slicing a memoryview is free; slicing bytes copies every segment
+        data = memoryview(data)
+        pos = 0
         
-        while length > 0:
-            chunk_idx = offset // self.chunk_size
-            chunk_offset = offset % self.chunk_size
-            to_write = min(length, self.chunk_size - chunk_offset)
+        for chunk_idx, chunk_offset, n in self._segments(offset, len(data)):
+            with self._chunk(chunk_idx, write=True) as f:
+                if isinstance(f, compress.Unpacking):
+                    f.copy(chunk_offset, n)
+                if self.cache:
+                    self.cache.put(chunk_idx, f.fileno(), chunk_offset, data[pos : pos + n])
+                    if fua:
+                        # Older cached blocks must not land on top later
+                        self.cache.flush_chunk(chunk_idx, f.fileno())
+                else:
+                    done = 0
+                    while done < n:
+                        done += os.pwrite(f.fileno(), data[pos + done : pos + n], chunk_offset + done)
+                # Under the chunk lock, so rename_hashed sees every write that landed
+                if self.journal:
+                    self.journal.mark(chunk_idx, chunk_offset, chunk_offset + n)
+                self._written(chunk_idx)
+                if fua:
+                    _datasync(f)
+            pos += n
+        if fua:
+            self._sync_dirs()
+        if self.readahead:
+            self.readahead.invalidate(offset, len(data))
 
-            f = self._get_file_handle(chunk_idx)
-            f.seek(chunk_offset)
-            f.write(data[data_offset : data_offset + to_write])
-            
-            length -= to_write
-            offset += to_write
-            data_offset += to_write
+        # Evict under memory pressure only after our own chunk lock is released
+        while self.cache and self.cache.over_budget():
+            victim = self.cache.oldest()
+            if victim is None: break
+            self._flush_cached(victim)
     
+    def _deallocate(self, offset, length, op, fua=False):
+        """Applies a sparse.* range operation to every chunk segment in the range."""
+        if self.read_only: raise IOError("Read-only mode")
+
+        for chunk_idx, chunk_offset, n in self._segments(offset, length):
+            with self._chunk(chunk_idx, write=True) as f:
+                if isinstance(f, compress.Unpacking):
+                    f.copy(chunk_offset, n)
+                # Cached blocks must not land on top of the hole later
+                if self.cache:
+                    self.cache.flush_chunk(chunk_idx, f.fileno())
+                op(f.fileno(), chunk_offset, n)
+                if self.journal:
+                    self.journal.mark(chunk_idx, chunk_offset, chunk_offset + n)
+                self._written(chunk_idx)
+                if fua:
+                    _datasync(f)
+        if fua:
+            self._sync_dirs()
+        if self.readahead:
+            self.readahead.invalidate(offset, length)
+
+    def trim(self, offset, length, fua=False):
+        """Discards a range by punching holes in the chunk files."""
+        self._deallocate(offset, length, sparse.punch_hole, fua)
+
+    def write_zeroes(self, offset, length, may_trim=True, fua=False):
+        """Zeroes a range without moving payload; keeps blocks allocated unless may_trim."""
+        self._deallocate(offset, length, sparse.punch_hole if may_trim else sparse.zero_range, fua)
+
+    def settle(self, chunk_idx):
+        """
+        First half of a background rehash: writes back the chunk's cached blocks,
+        so its file holds every write so far. Returns (filename, journal version),
+        or None unless the chunk is a raw local file.
+        """
+        with self._table_lock:
+            lock = self._chunk_locks[chunk_idx]
+        with lock:
+            if self.cache and chunk_idx in self.cache.dirty_chunks():
+                self._before_write(chunk_idx)
+                f = self._pin(chunk_idx)
+                try:
+                    self.cache.flush_chunk(chunk_idx, f.fileno())
+                finally:
+                    self._release(f)
+            filename = self.chunk_map.get(chunk_idx)
+            if not filename or compress.is_packed(filename):
+                return None
+            return filename, self.journal.version(chunk_idx)
+
+    def rename_hashed(self, chunk_idx, version, new_name, record):
+        """
+        Second half: unless the chunk was written since settle() returned version,
+        renames its file to new_name and calls record(new_name) to store the new
+        hashes, both under the chunk lock. Open handles stay valid across the
+        rename. Returns False if a write raced the rehash.
+        """
+        with self._table_lock:
+            lock = self._chunk_locks[chunk_idx]
+        with lock:
+            if self.journal.version(chunk_idx) != version:
+                return False
+            old = self.chunk_map[chunk_idx]
+            if new_name != old:
+                os.rename(os.path.join(self.root, old), os.path.join(self.root, new_name))
+                self._renamed(os.path.join(self.root, new_name))
+                with self._table_lock:
+                    self.chunk_map[chunk_idx] = new_name
+            record(new_name)
+            return True
+
+    def _flush_cached(self, chunk_idx):
+        with self._chunk(chunk_idx, write=True) as f:
+            self.cache.flush_chunk(chunk_idx, f.fileno())
+
+    def _flush_loop(self, interval):
+        while not self._stop.wait(interval):
+            for chunk_idx in self.cache.dirty_chunks():
+                self._flush_cached(chunk_idx)
+
+    def resize(self, max_open_files, cache_bytes=None, readahead_bytes=None):
+        """
+        Adjusts the handle, write-back and read-ahead budgets while serving (the
+        supervisor splits its global budgets across drives). Lower limits take
+        effect as handles are opened and writes arrive.
+        """
+        with self._table_lock:
+            self.max_open_files = max_open_files
+        if self.cache and cache_bytes is not None:
+            self.cache.max_bytes = cache_bytes
+        if self.readahead and readahead_bytes is not None:
+            self.readahead.resize(readahead_bytes)
+
+    def stats_snapshot(self):
+        """Counters of the handle cache and the optional caches, for the stats socket."""
+        with self._table_lock:
+            snap = {"fd_cache": {
+                "open": len(self.open_files), "hits": self.stats["fd_hits"],
+                "misses": self.stats["fd_misses"], "evictions": self.stats["fd_evictions"],
+            }}
+        if self.cache:
+            snap["write_back"] = dict(self.cache.stats, dirty_bytes=self.cache.dirty_bytes)
+        if self.readahead:
+            snap["readahead"] = dict(self.readahead.stats)
+        with self._sync_cond:
+            snap["sync"] = dict(self.sync_stats)
+        return snap
+
+    @contextlib.contextmanager
+    def frozen(self):
+        """
+        Quiesces the disk for a consistent point-in-time view: syncs like FLUSH,
+        then holds every chunk lock, so no request changes a chunk file until the
+        block exits. Reads of already pinned handles carry on.
+        """
+        self.sync()
+        with self._table_lock:
+            locks = [self._chunk_locks[i] for i in range(self.total_chunks)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            # Writes cached while the sync above ran
+            for chunk_idx in self.cache.dirty_chunks() if self.cache else []:
+                self._before_write(chunk_idx)
+                f = self._pin(chunk_idx)
+                try:
+                    self.cache.flush_chunk(chunk_idx, f.fileno())
+                    _datasync(f)
+                finally:
+                    self._release(f)
+            # A snapshot links the chunk files: no chunk may be half in its pack
+            with self._unpack_lock:
+                unpacking = sorted(self._unpacking)
+            for chunk_idx in unpacking:
+                f = self._pin(chunk_idx)
+                try:
+                    self._advance_unpack(chunk_idx, f, None)
+                finally:
+                    self._release(f)
+            if self.journal:
+                self.journal.flush()
+            yield
+        finally:
+            for lock in locks:
+                lock.release()
+
     def sync(self):
-        """Flushes all open handles."""
-        for f in self.open_files.values():
-            os.fsync(f.fileno())
+        """
+        FLUSH: makes every write that completed before the call durable, with
+        the dirty journal. Concurrent callers are group-committed: each waits
+        for the first sync round that starts after it arrived, and everyone
+        waiting then shares that round.
+        """
+        with self._sync_cond:
+            self.sync_stats["requests"] += 1
+            # A round already running may have missed writes that completed just before this call
+            ticket = self._sync_started + 1
+            self._sync_waiters[ticket] += 1
+            try:
+                while self._sync_done < ticket:
+                    if self._sync_running:
+                        self._sync_cond.wait()
+                        continue
+                    self._sync_running = True
+                    self._sync_started += 1
+                    round_no = self._sync_started
+                    error = None
+                    self._sync_cond.release()
+                    try:
+                        self._sync_round()
+                    except Exception as e:
+                        error = e
+                    finally:
+                        self._sync_cond.acquire()
+                        self._sync_running = False
+                        self._sync_done = round_no
+                        self.sync_stats["rounds"] += 1
+                        if error:
+                            self._sync_errors[round_no] = error
+                        self._sync_cond.notify_all()
+                error = self._sync_errors.get(ticket)
+            finally:
+                self._sync_waiters[ticket] -= 1
+                if not self._sync_waiters[ticket]:
+                    del self._sync_waiters[ticket]
+                    self._sync_errors.pop(ticket, None)
+        if error:
+            raise error
+
+    def _sync_round(self):
+        """Writes back cached blocks, fdatasyncs the chunks written since the last round, then the journal."""
+        if self.cache:
+            for chunk_idx in self.cache.dirty_chunks():
+                self._flush_cached(chunk_idx)
+        with self._unsynced_lock:
+            chunks, self._unsynced = self._unsynced, set()
+        pending = sorted(chunks)
+        try:
+            while pending:
+                # Evicted handles are reopened: the data is in the page cache of the file
+                f = self._pin(pending[-1])
+                try:
+                    _datasync(f)
+                finally:
+                    self._release(f)
+                pending.pop()
+                with self._sync_cond:
+                    self.sync_stats["chunks"] += 1
+        except BaseException:
+            with self._unsynced_lock:
+                self._unsynced.update(pending)
+            raise
+        self._sync_dirs()
+        if self.journal:
+            self.journal.flush()
+
+    def _sync_dirs(self):
+        with self._unsynced_lock:
+            dirs, self._unsynced_dirs = self._unsynced_dirs, set()
+        while dirs:
+            d = dirs.pop()
+            try:
+                fd = os.open(d, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except BaseException:
+                # Requeue this folder and the ones not reached yet
+                dirs.add(d)
+                with self._unsynced_lock:
+                    self._unsynced_dirs.update(dirs)
+                raise
 
     def close(self):
-        for f in self.open_files.values():
-            f.close()
-        self.open_files.clear()
+        if self.readahead:
+            self.readahead.close()
+        if self.cache:
+            self._stop.set()
+            self._flusher.join()
+            for chunk_idx in self.cache.dirty_chunks():
+                self._flush_cached(chunk_idx)
+        if self._unpacker:
+            # Finishes the queued unpacks, then any a handle reopened since
+            self._unpack_queue.put(None)
+            self._unpacker.join()
+            with self._unpack_lock:
+                unpacking = sorted(self._unpacking)
+            for chunk_idx in unpacking:
+                self._unpack_step(chunk_idx)
+        with self._table_lock:
+            for f in self.open_files.values():
+                self._retire(f)
+            self.open_files.clear()
+        if self.journal:
+            self.journal.close()
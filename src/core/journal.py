@@ -0,0 +1,70 @@
+import threading
+import collections
+
+# Past this many disjoint ranges a chunk is tracked as one covering range
+MAX_RANGES_PER_CHUNK = 256
+
+def merge_ranges(spans):
+    """Sorts and coalesces overlapping or touching (start, end) ranges."""
+    merged = []
+    for s, e in sorted(spans):
+        if merged and s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
+
+class DirtyJournal:
+    """
+    Tracks which byte ranges of which chunks were written while the daemon runs.
+    Ranges accumulate in memory and are persisted to the drive DB on flush (NBD FLUSH),
+    so check_drive can rehash only what changed. The DB carries a clean flag that is
+    cleared while the journal is open; after a crash the journal is not trusted.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.pending = {}
+        # Bumped by every mark, so a background rehash can tell it raced a write
+        self.versions = collections.Counter()
+        self._lock = threading.Lock()
+
+    def open(self):
+        self.db.open_journal()
+
+    def mark(self, chunk_idx, start, end):
+        with self._lock:
+            self.versions[chunk_idx] += 1
+            spans = self.pending.setdefault(chunk_idx, [])
+            if spans and spans[-1][1] == start:
+                # Sequential writes extend the last range in place
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+            if len(spans) > MAX_RANGES_PER_CHUNK:
+                merged = merge_ranges(spans)
+                if len(merged) > MAX_RANGES_PER_CHUNK:
+                    merged = [(merged[0][0], merged[-1][1])]
+                self.pending[chunk_idx] = merged
+
+    def version(self, chunk_idx):
+        with self._lock:
+            return self.versions[chunk_idx]
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            self.db.record_dirty({idx: merge_ranges(spans) for idx, spans in pending.items()})
+        except Exception:
+            # Put the ranges back so a later flush (or close) still records them
+            with self._lock:
+                for idx, spans in pending.items():
+                    self.pending.setdefault(idx, []).extend(spans)
+            raise
+
+    def close(self):
+        self.flush()
+        self.db.close_journal()
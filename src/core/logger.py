@@ -0,0 +1,41 @@
+import queue
+import atexit
+import logging
+import logging.handlers
+
+DEFAULT_FILE = "/tmp/tgfs_debug.log"
+DEFAULT_LEVEL = "INFO"
+
+_listener = None
+
+def setup(path=DEFAULT_FILE, level=DEFAULT_LEVEL):
+    """
+    Routes the "tgfs" loggers through an in-memory queue to a file written by a
+    background thread. Callers only format and enqueue; records below `level`
+    are dropped before even that.
+    """
+    global _listener
+    if _listener:
+        return
+    root = logging.getLogger("tgfs")
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    root.propagate = False
+
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(name)s: %(message)s"))
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """Writes out whatever is still queued."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+def get(name):
+    return logging.getLogger(f"tgfs.{name}")
@@ -1,22 +1,30 @@
 import os
 import time
 import sys
-import multiprocessing
 import subprocess
 import signal
 import typer
+import json
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config_loader import get_config
-from core import database, chunker, formatter, validator, nbd_server
+# The daemon stack and the transfer code are imported by the commands using them
+from core import database, chunker, validator, hasher, compress, control, snapshot
 from utils import shell
 
-conf = get_config()
-
 def get_pid_file(name):
-    return os.path.join(conf['paths']['storage_root'], f".{name}.pid")
+    return os.path.join(get_config()['paths']['storage_root'], f".{name}.pid")
+
+LAYOUTS = ("chunks", "cas")
+# How long a daemon gets to drain, flush and close its disk after a disconnect
+STOP_TIMEOUT = 60.0
 
-def create_drive(name: str, size_mb: int, chunk_mb: int, fs: str):
+def create_drive(name: str, size_mb: int, chunk_mb: int, fs: str, algo: str = hasher.DEFAULT_ALGO,
+                 layout: str = "chunks", compression: str = None):
+    import multiprocessing
+    from core import nbd_server, formatter
     path = validator.get_drive_path(name)
-    storage_root = conf['paths']['storage_root']
+    storage_root = get_config()['paths']['storage_root']
 
     if not os.path.exists(storage_root):
         os.makedirs(storage_root, exist_ok=True)
@@ -28,165 +36,784 @@ def create_drive(name: str, size_mb: int, chunk_mb: int, fs: str):
     
     # DB Init
     db = database.DBManager(path, name)
-    db.initialize({"chunk_size_mb": chunk_mb, "total_chunks": total_chunks, "fs": fs})
+    db.initialize({
+        "chunk_size_mb": chunk_mb, "total_chunks": total_chunks, "fs": fs,
+        "hash_algo": algo, "block_size_mb": chunker.get_block_size_mb(chunk_mb), "layout": layout,
+        "compression": compression or ""
+    })
     
-    typer.echo("[*] Allocating chunks...")
-    chunks = chunker.create_initial_chunks(path, name, total_chunks, chunk_mb)
-    for c in chunks:
-        st = os.stat(os.path.join(path, c['filename']))
-        db.update_chunk(c['index'], c['hash'], c['filename'], st.st_size, st.st_mtime)
+    if layout == "cas":
+        # Nothing to allocate: every block starts out mapped to the shared zero block
+        chunk_size = chunk_mb * 1024 * 1024
+        block_size = chunker.get_block_size_mb(chunk_mb) * 1024 * 1024
+        h = chunker.get_zero_root(chunk_size, block_size, algo)
+        padding = chunker.get_padding(total_chunks)
+        now = time.time()
+        db.update_chunks([(i, h, chunker.format_name(name, i, h, padding), chunk_size, now) for i in range(total_chunks)])
+    else:
+        typer.echo("[*] Allocating chunks...")
+        chunks = chunker.create_initial_chunks(path, name, total_chunks, chunk_mb, algo)
+        rows = []
+        for c in chunks:
+            st = os.stat(os.path.join(path, c['filename']))
+            rows.append((c['index'], c['hash'], c['filename'], st.st_size, st.st_mtime))
+        db.update_chunks(rows)
     
     typer.echo("[*] Formatting...")
     
     # For formatting, multiprocessing is fine because we wait for it
-    device = "/dev/nbd0"
-    p = multiprocessing.Process(
-        target=nbd_server.run_daemon,
-        args=(path, name, chunk_mb, total_chunks, device)
-    )
-    p.start()
-    
-    time.sleep(1) 
-    
-    try:
-        formatter.format_device(device, fs)
-    except Exception as e:
-        typer.secho(f"Formatting failed: {e}", fg="red")
-    finally:
-        shell.run(["nbd-client", "-d", device], check=False)
-        p.terminate()
-        p.join()
+    with claim_device() as device:
+        ready, ready_w = os.pipe()
+        p = multiprocessing.Process(
+            target=nbd_server.run_daemon,
+            args=(path, name, chunk_mb, total_chunks, device),
+            kwargs={"ready_fd": ready_w}
+        )
+        p.start()
+        os.close(ready_w)
+        
+        try:
+            if not nbd_server.wait_ready(ready):
+                raise IOError(f"NBD daemon did not come up on {device}")
+            formatter.format_device(device, fs)
+        except Exception as e:
+            typer.secho(f"Formatting failed: {e}", fg="red")
+        finally:
+            shell.run(["nbd-client", "-d", device], check=False)
+            p.terminate()
+            p.join()
 
     fix_permissions(storage_root, recursive=True)
     typer.secho(f"[+] Drive '{name}' created successfully.", fg="green")
 
-def mount_drive(name: str):
+def mount_drive(name: str, connections: int = None, snap: str = None):
+    from core import nbd_server, supervisor
     validator.require_drive_exists(name)
-    if is_running(name):
-        typer.echo(f"Drive {name} is already mounted/running.")
+    db = database.DBManager(validator.get_drive_path(name), name)
+    instance = name
+    if snap:
+        if snap not in db.get_snapshots():
+            typer.secho(f"Error: Drive '{name}' has no snapshot '{snap}'.", fg="red")
+            return
+        instance = snapshot.instance_name(name, snap)
+    if is_running(instance):
+        typer.echo(f"Drive {instance} is already mounted/running.")
         return
 
     path = validator.get_drive_path(name)
-    db = database.DBManager(path, name)
-    chunk_mb = int(db.get_meta("chunk_size_mb"))
-    total_chunks = int(db.get_meta("total_chunks"))
-    fs = db.get_meta("fs")
-    
-    device = "/dev/nbd0"
-    
-    typer.echo("[*] Starting NBD Daemon...")
+    meta = db.get_all_meta()
+    chunk_mb = int(meta["chunk_size_mb"])
+    total_chunks = int(meta["total_chunks"])
+    fs = meta.get("fs")
     
-    # USE SUBPROCESS TO DETACH
-    # We call ourself with the hidden 'internal-serve' command
-    cmd = [
-        sys.executable, 
-        sys.argv[0], 
-        "internal-serve", 
-        path, 
-        name, 
-        str(chunk_mb), 
-        str(total_chunks), 
-        device
-    ]
-    
-    p = subprocess.Popen(
-        cmd,
-        start_new_session=True, # This detaches the process group
-        stdout=subprocess.DEVNULL, # Suppress stdout
-        stderr=subprocess.DEVNULL  # Suppress stderr (logs go to file if enabled)
-    )
+    io_conf = get_config().get('io', {})
+    if not connections:
+        connections = io_conf.get('connections', nbd_server.DEFAULT_CONNECTIONS)
+    supervised = get_config().get('serve', {}).get('supervisor', False)
     
-    # Save PID
-    with open(get_pid_file(name), 'w') as f:
-        f.write(str(p.pid))
-    
-    time.sleep(1) # Wait for init
+    # The device stays claimed until the daemon has it and the state file says so
+    with claim_device() as device:
+        if supervised:
+            typer.echo(f"[*] Attaching to supervisor on {device}...")
+            pid = start_supervisor()
+            if not pid:
+                return
+            try:
+                control.call(supervisor.get_socket(get_config()['paths']['storage_root']), "attach", timeout=None,
+                             path=path, name=name, chunk_mb=chunk_mb, total_chunks=total_chunks, device=device,
+                             connections=connections, cache_mb=io_conf.get('write_back_mb', 0),
+                             readahead_mb=io_conf.get('readahead_mb', 0), tier_mb=io_conf.get('tier_cache_mb', 0),
+                             snapshot_name=snap)
+            except (OSError, RuntimeError) as e:
+                typer.secho(f"[-] Attach failed: {e}", fg="red")
+                return
+        else:
+            typer.echo(f"[*] Starting NBD Daemon on {device}...")
+            
+            # USE SUBPROCESS TO DETACH
+            # We call ourself with the hidden 'internal-serve' command
+            cmd = [
+                sys.executable, 
+                sys.argv[0], 
+                "internal-serve", 
+                path, 
+                name, 
+                str(chunk_mb), 
+                str(total_chunks), 
+                device,
+                "--cache-mb", str(io_conf.get('write_back_mb', 0)),
+                "--readahead-mb", str(io_conf.get('readahead_mb', 0)),
+                "--connections", str(connections),
+                "--tier-mb", str(io_conf.get('tier_cache_mb', 0))
+            ]
+            if snap:
+                cmd += ["--snapshot", snap]
+            # The daemon writes to this pipe once its device is live
+            ready, ready_w = os.pipe()
+            cmd += ["--ready-fd", str(ready_w)]
+            
+            p = subprocess.Popen(
+                cmd,
+                start_new_session=True, # This detaches the process group
+                stdout=subprocess.DEVNULL, # Suppress stdout
+                stderr=subprocess.DEVNULL, # Suppress stderr (logs go to file if enabled)
+                pass_fds=(ready_w,)
+            )
+            os.close(ready_w)
+            pid = p.pid
+        
+        write_state(instance, pid, device, supervised)
+        # The supervisor only answers attach once the device is live
+        if not supervised and not nbd_server.wait_ready(ready):
+            typer.secho("[-] NBD daemon did not come up (see the log).", fg="red")
+            stop_daemon(instance)
+            return
     
-    mount_point = conf['paths']['mount_root']
+    mount_point = get_config()['paths']['mount_root']
     try:
         from core import mount
-        mount.mount_vdev(device, mount_point, name, fs)
-        typer.secho(f"[+] Mounted {name} at {mount_point}/{name}", fg="green")
+        mount.mount_vdev(device, mount_point, instance, fs, read_only=bool(snap))
+        typer.secho(f"[+] Mounted {instance} at {mount_point}/{instance}", fg="green")
     except Exception as e:
         typer.secho(f"[-] Mount failed: {e}", fg="red")
         # Cleanup
-        try:
-            os.kill(p.pid, signal.SIGTERM)
-        except: pass
-        if os.path.exists(get_pid_file(name)): os.remove(get_pid_file(name))
+        stop_daemon(instance)
 
 def umount_drive(name: str):
-    mount_point = conf['paths']['mount_root']
+    mount_point = get_config()['paths']['mount_root']
     
     # 1. System Umount
     from core import mount
     mount.umount_vdev(mount_point, name)
     
     # 2. Stop Daemon
-    pid_file = get_pid_file(name)
-    if os.path.exists(pid_file):
-        with open(pid_file, 'r') as f:
-            try:
-                pid = int(f.read().strip())
-            except ValueError:
-                pid = None
-        
-        # Disconnect NBD gracefully
-        shell.run(["nbd-client", "-d", "/dev/nbd0"], check=False)
-        
-        if pid:
+    stop_daemon(name)
+    
+    # 3. Check integrity (snapshots are read-only)
+    if not snapshot.split_name(name)[1]:
+        check_drive(name)
+    typer.secho(f"[+] Unmounted {name}", fg="green")
+
+def serve_drive(name: str, listen: str = None, snap: str = None):
+    """
+    Serves a drive to NBD clients over the network from this process, without
+    a kernel device, until interrupted. The drive counts as mounted meanwhile.
+    """
+    from core import nbd_net, logger
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    instance = name
+    if snap:
+        if snap not in db.get_snapshots():
+            typer.secho(f"Error: Drive '{name}' has no snapshot '{snap}'.", fg="red")
+            return
+        instance = snapshot.instance_name(name, snap)
+    if is_running(instance):
+        typer.echo(f"Drive {instance} is already mounted/running.")
+        return
+
+    meta = db.get_all_meta()
+    conf = get_config()
+    io_conf = conf.get('io', {})
+    listen = listen or conf.get('serve', {}).get('listen', nbd_net.DEFAULT_LISTEN)
+    log_conf = conf.get('log', {})
+    logger.setup(log_conf.get('file', logger.DEFAULT_FILE), log_conf.get('level', logger.DEFAULT_LEVEL))
+
+    server = nbd_net.open_network_server(
+        path, name, int(meta["chunk_size_mb"]), int(meta["total_chunks"]), listen,
+        cache_mb=io_conf.get('write_back_mb', 0), readahead_mb=io_conf.get('readahead_mb', 0),
+        tier_mb=io_conf.get('tier_cache_mb', 0), snapshot_name=snap
+    )
+    # No device: stop_daemon only has to signal us
+    write_state(instance, os.getpid(), None)
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    try:
+        server.start(lambda: typer.secho(f"[+] Serving {instance} on {listen} (Ctrl-C to stop)", fg="green"))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        typer.secho(f"[-] Could not listen on {listen}: {e}", fg="red")
+        return
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(get_pid_file(instance))
+        logger.shutdown()
+
+    if not snap:
+        check_drive(name)
+    typer.secho(f"[+] Stopped serving {instance}", fg="green")
+
+def stop_daemon(name):
+    """Disconnects a drive's device and stops whatever serves it (own daemon or supervisor)."""
+    from core import supervisor
+    state = read_state(name)
+    if state is None:
+        return
+    if state.get("supervised"):
+        # The supervisor disconnects the device and waits for the disk to close
+        try:
+            control.call(supervisor.get_socket(get_config()['paths']['storage_root']), "detach", timeout=None, name=name)
+        except (OSError, RuntimeError) as e:
+            typer.secho(f"Warning: Detach from supervisor failed: {e}", fg="yellow")
+    else:
+        # Disconnecting ends NBD_DO_IT; the daemon then drains, flushes and marks
+        # the journal clean on its own. SIGTERM takes the same path, so it is
+        # the fallback, and the only way for network-served drives (no device).
+        exited = False
+        if state["device"]:
+            shell.run(["nbd-client", "-d", state["device"]], check=False)
+            exited = wait_exit(state["pid"], STOP_TIMEOUT)
+        if not exited:
             try:
-                os.kill(pid, signal.SIGTERM)
+                os.kill(state["pid"], signal.SIGTERM)
             except ProcessLookupError:
                 pass
-            
-        os.remove(pid_file)
-    
-    # 3. Check integrity
-    check_drive(name)
-    typer.secho(f"[+] Unmounted {name}", fg="green")
+            if not wait_exit(state["pid"], STOP_TIMEOUT):
+                typer.secho(f"Warning: Daemon {state['pid']} of {name} is still shutting down.", fg="yellow")
+    # A network server removes its own on the way out
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(get_pid_file(name))
+
+def wait_exit(pid, timeout):
+    """True once the process is gone, False if it still runs after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        # Our own child (a daemon that failed to come up) stays a zombie until reaped
+        with contextlib.suppress(ChildProcessError):
+            os.waitpid(pid, os.WNOHANG)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+
+def read_state(name):
+    """{"pid", "device", "supervised"} of a mounted drive, or None."""
+    try:
+        with open(get_pid_file(name), 'r') as f:
+            state = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if isinstance(state, int):
+        # Pid files from before device allocation hold just the pid
+        state = {"pid": state, "device": "/dev/nbd0"}
+    return state
+
+def write_state(name, pid, device, supervised=False):
+    with open(get_pid_file(name), 'w') as f:
+        json.dump({"pid": pid, "device": device, "supervised": supervised}, f)
 
 def is_running(name):
-    pid_file = get_pid_file(name)
-    if not os.path.exists(pid_file): return False
+    state = read_state(name)
+    if not state: return False
     try:
-        with open(pid_file, 'r') as f:
-            pid = int(f.read())
-        os.kill(pid, 0)
+        os.kill(state["pid"], 0)
         return True
     except:
         return False
 
-def check_drive(name: str):
+def used_devices():
+    """Devices recorded by every drive that is still being served."""
+    devices = set()
+    for f in os.listdir(get_config()['paths']['storage_root']):
+        if f.startswith(".") and f.endswith(".pid"):
+            name = f[1 : -len(".pid")]
+            if is_running(name):
+                if read_state(name)["device"]:
+                    devices.add(read_state(name)["device"])
+    return devices
+
+def claim_device():
+    from core import devices
+    serve = get_config().get('serve', {})
+    return devices.claim(get_config()['paths']['storage_root'], used_devices, serve.get('nbd_devices', devices.DEFAULT_DEVICES))
+
+def supervisor_pid():
+    """Pid of the running supervisor, or None."""
+    from core import supervisor
+    try:
+        with open(supervisor.get_state_file(get_config()['paths']['storage_root']), 'r') as f:
+            pid = json.loads(f.read())["pid"]
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError, KeyError):
+        return None
+
+def start_supervisor():
+    """Starts the supervisor unless it runs already. Returns its pid, or None if it did not come up."""
+    from core import supervisor
+    pid = supervisor_pid()
+    if pid:
+        return pid
+    storage_root = get_config()['paths']['storage_root']
+    p = subprocess.Popen(
+        [sys.executable, sys.argv[0], "internal-supervise"],
+        start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    with open(supervisor.get_state_file(storage_root), 'w') as f:
+        json.dump({"pid": p.pid}, f)
+    # Ready once its control socket answers
+    for _ in range(50):
+        try:
+            control.call(supervisor.get_socket(storage_root), "list")
+            return p.pid
+        except (OSError, RuntimeError):
+            if p.poll() is not None:
+                break
+            time.sleep(0.1)
+    typer.secho("Error: Supervisor did not start.", fg="red")
+    return None
+
+def manage_supervisor(start: bool = False, stop: bool = False, force: bool = False):
+    from core import supervisor
+    storage_root = get_config()['paths']['storage_root']
+    if start and not start_supervisor():
+        return
+    if not supervisor_pid():
+        typer.echo("Supervisor is not running.")
+        return
+    sock = supervisor.get_socket(storage_root)
+    try:
+        if stop:
+            control.call(sock, "stop", force=force)
+            typer.secho("[+] Supervisor stopping.", fg="green")
+            return
+        drives = control.call(sock, "list")
+    except (OSError, RuntimeError) as e:
+        typer.secho(f"Error: {e}", fg="red")
+        return
+    typer.echo(f"Supervisor {supervisor_pid()}: {len(drives)} drives attached.")
+    for name, d in sorted(drives.items()):
+        typer.echo(f"{name:<24}{d['device']:<14}{d['inflight']:>4} in flight{d['open_files']:>6} handles")
+
+def check_drive(name: str, workers: int = hasher.DEFAULT_WORKERS):
+    from core import cas, tiered
     validator.require_drive_exists(name)
     path = validator.get_drive_path(name)
     db = database.DBManager(path, name)
+
+    if db.get_meta("layout") == "cas":
+        if is_running(name):
+            typer.echo("[*] Drive is being served; private blocks are published after umount.")
+            return
+        typer.echo("[*] Publishing written blocks to the shared store...")
+        changed = cas.publish(path, name, cas.get_cas_root(get_config()['paths']['storage_root']), workers, log=typer.echo)
+        typer.echo(f"Check complete. {changed} chunks updated.")
+        return
+
+    if not is_running(name):
+        # Tier files and unpacks of a mount that did not close
+        tiered.restore(path, db)
+        compress.finish_unpacks(path)
     chunks = db.get_chunks()
     padding = chunker.get_padding(int(db.get_meta("total_chunks")))
+    algo = db.get_meta("hash_algo") or hasher.DEFAULT_ALGO
+    chunk_size = int(db.get_meta("chunk_size_mb")) * 1024 * 1024
+
+    # Drives from before per-block hashing have no leaves yet: hash every block
+    # of every chunk once, after which the root hash names each chunk
+    block_mb = db.get_meta("block_size_mb")
+    upgrade = block_mb is None
+    block_size = int(block_mb or chunker.get_block_size_mb(chunk_size // (1024 * 1024))) * 1024 * 1024
+    zero_leaf = chunker.get_zero_hash(block_size, algo)
     
-    changed = 0
-    typer.echo("[*] Scanning chunks for changes...")
-    
-    for c in chunks:
-        curr_path = os.path.join(path, c['filename'])
+    # A clean journal lists every range written since the last check, so only
+    # the blocks under those ranges need hashing. Otherwise (crash, or drive
+    # still mounted) fall back to comparing mtime/size of every chunk.
+    journal_clean = db.journal_is_clean() and not upgrade
+    if journal_clean:
+        dirty = db.get_dirty()
+        candidates = [c for c in chunks if c['chunk_index'] in dirty]
+        typer.echo(f"[*] Journal lists {len(candidates)} written chunks.")
+    else:
+        candidates = chunks
+        typer.echo("[*] Scanning chunks for changes...")
+
+    # path -> (chunk row, stat, block indices to rehash or None for all)
+    to_hash = {}
+    for c in candidates:
+        # A write unpacks a packed chunk, so the DB may still name the other form
+        curr_path = compress.resolve(path, c['filename'])
         if not os.path.exists(curr_path):
             continue
+        if compress.is_packed(curr_path):
+            # Packed chunks are never written in place: unchanged since packing
+            continue
             
         st = os.stat(curr_path)
+        if journal_clean:
+            blocks = set()
+            for start, end in dirty[c['chunk_index']]:
+                blocks.update(chunker.get_block_range(start, end, block_size))
+            to_hash[curr_path] = (c, st, blocks)
         # Check tolerance for float mtime
-        if abs(st.st_mtime - (c.get('mtime') or 0)) > 0.0001 or st.st_size != c.get('size'):
-            new_h = chunker.get_hash(curr_path)
-            if new_h != c['hash']:
-                new_name = chunker.format_name(name, c['chunk_index'], new_h, padding)
-                new_full = os.path.join(path, new_name)
-                os.rename(curr_path, new_full)
-                
-                db.update_chunk(c['chunk_index'], new_h, new_name, st.st_size, st.st_mtime)
-                changed += 1
-                typer.echo(f"Updated Chunk {c['chunk_index']}")
+        elif upgrade or abs(st.st_mtime - (c.get('mtime') or 0)) > 0.0001 or st.st_size != c.get('size'):
+            to_hash[curr_path] = (c, st, None)
+
+    changed = 0
+    def on_hashed(curr_path, new_leaves):
+        nonlocal changed
+        c, st, blocks = to_hash[curr_path]
+        full = blocks is None
+        leaves = {} if full else db.get_block_hashes(c['chunk_index'])
+        leaves.update(new_leaves)
+        new_h = chunker.get_root(leaves, chunk_size, block_size, algo)
+
+        new_name = os.path.basename(curr_path)
+        if new_h != c['hash']:
+            new_name = chunker.format_name(name, c['chunk_index'], new_h, padding)
+            os.rename(curr_path, os.path.join(path, new_name))
+            changed += 1
+            typer.echo(f"Updated Chunk {c['chunk_index']}")
+        
+        with db.transaction():
+            db.update_block_hashes(c['chunk_index'], new_leaves, zero_leaf, replace=full)
+            db.update_chunk(c['chunk_index'], new_h, new_name, st.st_size, st.st_mtime)
+
+    if to_hash:
+        jobs = {p: blocks for p, (_, _, blocks) in to_hash.items()}
+        _, stats = hasher.hash_blocks_many(jobs, block_size, algo, workers, on_done=on_hashed)
+        typer.echo(f"[*] Hashed {stats}")
     
+    if journal_clean:
+        db.clear_dirty(list(dirty))
+    elif not is_running(name):
+        # Full scan covered everything; the journal can be trusted from here on
+        db.clear_dirty()
+        db.close_journal()
+    if upgrade and not is_running(name):
+        db.set_meta("block_size_mb", block_size // (1024 * 1024))
+
+    codec = db.get_meta("compression")
+    if codec and not is_running(name):
+        pack_chunks(path, db, codec, workers)
+
     typer.echo(f"Check complete. {changed} chunks updated.")
 
+def pack_chunks(path, db, codec, workers):
+    """Compresses every raw chunk of a stopped drive into its packed form."""
+    rows = {}
+    for c in db.get_chunks():
+        curr_path = compress.resolve(path, c['filename'])
+        if os.path.exists(curr_path) and not compress.is_packed(curr_path):
+            rows[curr_path] = c
+    if not rows:
+        return
+
+    def on_packed(raw_path, packed_path):
+        c = rows[raw_path]
+        st = os.stat(packed_path)
+        db.update_chunk(c['chunk_index'], c['hash'], os.path.basename(packed_path), st.st_size, st.st_mtime)
+
+    typer.echo(f"[*] Compressing {len(rows)} chunks ({codec})...")
+    stats = compress.pack_many(list(rows), codec, workers, on_done=on_packed)
+    typer.echo(f"[*] Packed {stats}")
+
+def push_drive(name: str, concurrency: int = None, bandwidth_mb: float = None):
+    import asyncio
+    from core import remote, uploader
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+
+    if db.get_meta("layout") == "cas":
+        typer.secho("Error: Pushing content-addressed drives is not supported.", fg="red")
+        return
+    # Chunk names only describe their content after a check of the stopped drive
+    if is_running(name):
+        typer.secho(f"Error: Drive '{name}' is mounted. Umount and check it before pushing.", fg="red")
+        return
+
+    opts = get_config().get('remote', {})
+    if concurrency is None:
+        concurrency = opts.get('concurrency', uploader.DEFAULT_CONCURRENCY)
+    if bandwidth_mb is None:
+        bandwidth_mb = opts.get('bandwidth_mb', 0)
+
+    up = uploader.Uploader(
+        path, name, remote.get_backend(opts), concurrency,
+        part_size=int(opts.get('part_mb', uploader.DEFAULT_PART_SIZE // (1024 * 1024))) * 1024 * 1024,
+        retries=opts.get('retries', uploader.DEFAULT_RETRIES),
+        bandwidth=int(bandwidth_mb * 1024 * 1024), log=typer.echo
+    )
+    typer.echo(f"[*] Pushing {name} ({concurrency} parallel transfers)...")
+    stats = asyncio.run(up.run())
+    typer.echo(f"Push complete. {stats}")
+
+def delta_drive(name: str, out_dir: str = None, workers: int = hasher.DEFAULT_WORKERS, ack: bool = False):
+    """
+    Writes <key>.delta into out_dir for every chunk changed since its version
+    was last published (pushed, or sent as an acknowledged delta). The new
+    versions only become the base of the next run once ack=True confirms that
+    the deltas were applied; until then every run diffs against the old base.
+    """
+    from core import delta, tiered
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+
+    if ack:
+        n = db.ack_pending_signatures()
+        typer.secho(f"[+] {n} chunk versions are now the base of the next delta.", fg="green")
+        return
+    if db.get_meta("layout") == "cas":
+        typer.secho("Error: Deltas of content-addressed drives are not supported.", fg="red")
+        return
+    if is_running(name):
+        typer.secho(f"Error: Drive '{name}' is mounted. Umount and check it first.", fg="red")
+        return
+    if not os.path.isdir(out_dir):
+        typer.secho(f"Error: Output folder '{out_dir}' does not exist.", fg="red")
+        return
+    tiered.restore(path, db)
+    compress.finish_unpacks(path)
+
+    published = db.get_signatures()
+    todo = []
+    for c in db.get_chunks():
+        curr_path = compress.resolve(path, c['filename'])
+        if os.path.exists(curr_path) and published.get(c['chunk_index']) != os.path.basename(curr_path):
+            todo.append((c['chunk_index'], curr_path))
+    if not todo:
+        typer.echo("No chunk changed since it was last published.")
+        return
+
+    def job(item):
+        idx, curr_path = item
+        key = os.path.basename(curr_path)
+        base = db.get_signature(idx)
+        stats = delta.DeltaStats()
+        dst = os.path.join(out_dir, key + delta.DELTA_EXT)
+        with open(f"{dst}.tmp", "wb") as out:
+            if base:
+                delta.make(curr_path, out, key, base['key'], base['data'], base['block_size'], stats)
+            else:
+                delta.make(curr_path, out, key, stats=stats)
+        os.rename(f"{dst}.tmp", dst)
+        return key, delta.signature(curr_path), stats
+
+    typer.echo(f"[*] Writing deltas of {len(todo)} chunks to {out_dir}...")
+    total = delta.DeltaStats()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="delta") as pool:
+        futures = {pool.submit(job, item): item[0] for item in todo}
+        for fut in as_completed(futures):
+            key, (size, sig), stats = fut.result()
+            db.set_pending_signature(futures[fut], key, delta.DEFAULT_BLOCK_SIZE, size, sig)
+            total.add(stats)
+    typer.secho(f"[+] Delta complete. {total}", fg="green")
+    typer.echo(f"[*] Once the deltas are applied, run `delta {name} --ack` to diff against these versions next.")
+
+def apply_deltas(delta_dir: str, base_dir: str):
+    """
+    Rebuilds chunks from the deltas in delta_dir next to their base versions in
+    base_dir (a backup, or the remote folder of the dir backend).
+    """
+    from core import delta
+    files = sorted(f for f in os.listdir(delta_dir) if f.endswith(delta.DELTA_EXT))
+    for f in files:
+        with open(os.path.join(delta_dir, f), "rb") as src:
+            key = delta.apply(src, base_dir, base_dir)
+        typer.echo(f"Rebuilt {key}")
+    typer.secho(f"[+] Applied {len(files)} deltas.", fg="green")
+
+def import_image(name: str, source: str, workers: int = hasher.DEFAULT_WORKERS):
+    """Replaces a stopped drive's content with a raw image read from a file or stdin ("-")."""
+    from core import image
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    if db.get_meta("layout") == "cas":
+        typer.secho("Error: Importing into content-addressed drives is not supported.", fg="red")
+        return
+    if not db.get_meta("block_size_mb"):
+        typer.secho(f"Error: Drive '{name}' predates per-block hashes. Check it first.", fg="red")
+        return
+    if is_running(name):
+        typer.secho(f"Error: Drive '{name}' is mounted. Umount it before importing.", fg="red")
+        return
+
+    importer = image.Importer(path, name, db, workers)
+    if source == "-":
+        src = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    else:
+        src = open(source, "rb", buffering=0)
+        size = os.fstat(src.fileno()).st_size
+        if size > importer.total_size:
+            src.close()
+            typer.secho(f"Error: Image is {size} bytes; the drive holds {importer.total_size}.", fg="red")
+            return
+        os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    typer.echo(f"[*] Importing into {name} ({importer.workers} threads)...")
+    with src:
+        stats = importer.run(src)
+    typer.echo(f"[*] Imported {stats}")
+    if importer.overflow:
+        typer.secho(f"Warning: Image is larger than the drive; only its first {importer.total_size} bytes were imported.",
+                    fg="yellow")
+
+    codec = db.get_meta("compression")
+    if codec:
+        pack_chunks(path, db, codec, workers)
+    typer.secho("[+] Import complete. Chunk names and hashes are final.", fg="green")
+
+def export_image(name: str, target: str, workers: int = hasher.DEFAULT_WORKERS, snap: str = None):
+    """Writes a drive (or one of its snapshots) as a raw image to a file or stdout ("-")."""
+    from core import image, nbd_server
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    instance = snapshot.instance_name(name, snap) if snap else name
+    if snap and snap not in db.get_snapshots():
+        typer.secho(f"Error: Drive '{name}' has no snapshot '{snap}'.", fg="red", err=True)
+        return
+    # The daemon may hold writes that are not in the chunk files yet
+    if is_running(instance) and not snap:
+        typer.secho(f"Error: Drive '{name}' is mounted. Umount it or export a snapshot.", fg="red", err=True)
+        return
+
+    meta = db.get_all_meta()
+    vdisk, _, _ = nbd_server.open_disk(path, name, int(meta["chunk_size_mb"]), int(meta["total_chunks"]),
+                                       tier_mb=get_config().get('io', {}).get('tier_cache_mb', 0),
+                                       snapshot_name=snap, read_only=True)
+    # Progress goes to stderr, so the image can go to stdout
+    typer.echo(f"[*] Exporting {instance}...", err=True)
+    try:
+        if target == "-":
+            stats = image.export(vdisk, sys.stdout.fileno(), workers)
+        else:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                stats = image.export(vdisk, fd, workers)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    finally:
+        vdisk.close()
+    typer.secho(f"[+] Exported {stats}", fg="green", err=True)
+
+def show_stats(name: str, watch: float = None, as_json: bool = False):
+    from core import metrics
+    validator.require_drive_exists(snapshot.split_name(name)[0])
+    if not is_running(name):
+        typer.secho(f"Error: Drive '{name}' is not mounted.", fg="red")
+        return
+    path = control.get_control_socket(get_config()['paths']['storage_root'], name)
+    try:
+        snap = control.call(path, "stats")
+    except OSError as e:
+        typer.secho(f"Error: Could not reach the daemon at {path}: {e}", fg="red")
+        return
+
+    if as_json:
+        typer.echo(json.dumps(snap, indent=2))
+        return
+    typer.echo(metrics.format_stats(snap))
+    # Watch mode: each frame shows rates over the last interval only
+    while watch:
+        try:
+            time.sleep(watch)
+            prev, snap = snap, control.call(path, "stats")
+        except (OSError, KeyboardInterrupt):
+            return
+        typer.clear()
+        typer.echo(metrics.format_stats(snap, prev))
+
+@contextlib.contextmanager
+def frozen_fs(name):
+    """Freezes the filesystem of a mounted drive, so what the daemon sees is consistent."""
+    target = os.path.join(get_config()['paths']['mount_root'], name)
+    if not os.path.ismount(target):
+        yield
+        return
+    # Freezing flushes the filesystem, which sends the daemon a FLUSH
+    shell.run(["fsfreeze", "--freeze", target])
+    try:
+        yield
+    finally:
+        shell.run(["fsfreeze", "--unfreeze", target])
+
+def take_snapshot(name: str, snap: str):
+    """Snapshots a drive, through its daemon when mounted. Returns False on error."""
+    from core import tiered
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    if db.get_meta("layout") == "cas":
+        typer.secho("Error: Snapshots of content-addressed drives are not supported.", fg="red")
+        return False
+    try:
+        if is_running(name):
+            sock = control.get_control_socket(get_config()['paths']['storage_root'], name)
+            with frozen_fs(name):
+                res = control.call(sock, "snapshot", timeout=None, name=snap)
+            linked = res["linked"]
+        else:
+            tiered.restore(path, db)
+            compress.finish_unpacks(path)
+            linked = len(snapshot.take(path, db, snap, snapshot.local_files(path, db)))
+    except (OSError, ValueError, RuntimeError) as e:
+        typer.secho(f"Error: {e}", fg="red")
+        return False
+    if linked:
+        typer.echo(f"[*] {linked} chunks hard linked (no reflink support); they are copied on first write.")
+    return True
+
+def snapshot_drive(name: str, snap: str):
+    validator.require_drive_exists(name)
+    if take_snapshot(name, snap):
+        typer.secho(f"[+] Snapshot '{snap}' of {name} created.", fg="green")
+
+def list_snapshots(name: str):
+    validator.require_drive_exists(name)
+    snaps = database.DBManager(validator.get_drive_path(name), name).get_snapshots()
+    if not snaps:
+        typer.echo(f"Drive '{name}' has no snapshots.")
+    for snap, created in snaps.items():
+        state = " (mounted)" if is_running(snapshot.instance_name(name, snap)) else ""
+        typer.echo(f"{snap:<24}{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))}{state}")
+
+def delete_snapshot(name: str, snap: str):
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    if snap not in db.get_snapshots():
+        typer.secho(f"Error: Drive '{name}' has no snapshot '{snap}'.", fg="red")
+        return
+    if is_running(snapshot.instance_name(name, snap)):
+        typer.secho(f"Error: Snapshot '{snap}' is mounted.", fg="red")
+        return
+    snapshot.delete(path, db, snap)
+    typer.secho(f"[+] Snapshot '{snap}' deleted.", fg="green")
+
+def clone_drive(name: str, new_name: str, snap: str = None):
+    validator.require_drive_exists(name)
+    path = validator.get_drive_path(name)
+    db = database.DBManager(path, name)
+    if validator.exists_on_disk(new_name):
+        typer.secho(f"Error: Drive '{new_name}' already exists.", fg="red")
+        return
+    temporary = snap is None
+    if temporary:
+        # Cloning the current state: go through a snapshot dropped afterwards
+        snap = f"clone-{new_name}-{int(time.time())}"
+        if not take_snapshot(name, snap):
+            return
+    elif snap not in db.get_snapshots():
+        typer.secho(f"Error: Drive '{name}' has no snapshot '{snap}'.", fg="red")
+        return
+
+    try:
+        count = snapshot.clone(path, name, snap, validator.get_drive_path(new_name), new_name)
+    finally:
+        if temporary:
+            snapshot.delete(path, db, snap)
+    fix_permissions(validator.get_drive_path(new_name), recursive=True)
+    source = name if temporary else snapshot.instance_name(name, snap)
+    typer.secho(f"[+] Drive '{new_name}' cloned from {source} ({count} chunks).", fg="green")
+
 def fix_permissions(path, recursive=True):
     sudo_user = os.environ.get("SUDO_USER")
     if sudo_user:
@@ -0,0 +1,130 @@
+import time
+import threading
+
+# Latency buckets are powers of two in microseconds: bucket i holds [2^(i-1), 2^i) us
+# (bit_length of the whole microseconds), bucket 0 anything under 1 us
+BUCKETS = 32
+COMMANDS = {0: "read", 1: "write", 3: "flush", 4: "trim", 6: "write_zeroes", 7: "block_status"}
+
+class Histogram:
+    """Fixed log2 latency histogram; recording is one index computation and an add."""
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0.0
+
+    def observe(self, seconds):
+        us = int(seconds * 1e6)
+        self.counts[min(BUCKETS - 1, us.bit_length())] += 1
+        self.total += seconds
+
+def percentile(counts, q):
+    """Upper bound in microseconds (2^i, exclusive) of the bucket holding quantile q."""
+    n = sum(counts)
+    if not n:
+        return 0
+    rank = q * n
+    seen = 0
+    for i, c in enumerate(counts):
+        seen += c
+        if seen >= rank:
+            return 1 << i
+    return 1 << (BUCKETS - 1)
+
+class Metrics:
+    """
+    Per-command counters and latency histograms for the NBD server, plus queue
+    depth. Updates take one short lock; readers get a consistent snapshot.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.ops = {name: 0 for name in COMMANDS.values()}
+        self.errors = {name: 0 for name in COMMANDS.values()}
+        self.bytes = {name: 0 for name in COMMANDS.values()}
+        self.latency = {name: Histogram() for name in COMMANDS.values()}
+        self.inflight = 0
+        self.max_inflight = 0
+        self.last_request = time.monotonic()
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Called when a request is queued; returns its start time."""
+        with self._lock:
+            self.inflight += 1
+            if self.inflight > self.max_inflight:
+                self.max_inflight = self.inflight
+            self.last_request = time.monotonic()
+        return time.perf_counter()
+
+    def idle_for(self):
+        """Seconds since the last request arrived; 0 while any is in flight."""
+        with self._lock:
+            return 0.0 if self.inflight else time.monotonic() - self.last_request
+
+    def end(self, cmd_type, started, nbytes, error):
+        elapsed = time.perf_counter() - started
+        name = COMMANDS.get(cmd_type)
+        with self._lock:
+            self.inflight -= 1
+            if name is None:
+                return
+            self.ops[name] += 1
+            if error:
+                self.errors[name] += 1
+            else:
+                self.bytes[name] += nbytes
+            self.latency[name].observe(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "commands": {
+                    name: {
+                        "ops": self.ops[name], "errors": self.errors[name], "bytes": self.bytes[name],
+                        "latency_total": self.latency[name].total, "latency": list(self.latency[name].counts),
+                    }
+                    for name in COMMANDS.values()
+                },
+            }
+
+def diff(new, old):
+    """Per-command activity between two snapshots of the same daemon."""
+    out = {}
+    for name, c in new["commands"].items():
+        o = old["commands"][name] if old else None
+        out[name] = {
+            "ops": c["ops"] - (o["ops"] if o else 0),
+            "errors": c["errors"] - (o["errors"] if o else 0),
+            "bytes": c["bytes"] - (o["bytes"] if o else 0),
+            "latency": [a - b for a, b in zip(c["latency"], o["latency"])] if o else c["latency"],
+        }
+    return out
+
+def format_stats(new, old=None):
+    """Renders a snapshot as text; with `old`, rates cover the interval between them."""
+    seconds = (new["time"] - old["time"]) if old else new["uptime"]
+    seconds = max(seconds, 1e-9)
+    lines = [f"{'command':<13}{'ops':>10}{'ops/s':>10}{'MB/s':>9}{'p50':>10}{'p99':>10}{'p999':>10}{'errors':>8}"]
+    for name, c in diff(new, old).items():
+        lat = c["latency"]
+        lines.append(
+            f"{name:<13}{c['ops']:>10}{c['ops'] / seconds:>10.0f}{c['bytes'] / (1024 * 1024) / seconds:>9.1f}"
+            f"{percentile(lat, 0.5):>8}us{percentile(lat, 0.99):>8}us{percentile(lat, 0.999):>8}us{c['errors']:>8}"
+        )
+    lines.append(f"queue depth {new['inflight']} (max {new['max_inflight']}), uptime {new['uptime']:.0f}s")
+
+    disk = new.get("vdisk", {})
+    fd = disk.get("fd_cache")
+    if fd:
+        lookups = fd["hits"] + fd["misses"]
+        rate = fd["hits"] / lookups if lookups else 0.0
+        lines.append(f"fd cache: {fd['open']} open, {rate:.1%} hit rate, {fd['evictions']} evictions")
+    for section in ("sync", "write_back", "readahead", "tier"):
+        if disk.get(section):
+            lines.append(f"{section}: " + ", ".join(f"{k} {v}" for k, v in sorted(disk[section].items())))
+    if new.get("rehash"):
+        lines.append("rehash: " + ", ".join(f"{k} {v}" for k, v in sorted(new["rehash"].items())))
+    return "\n".join(lines)
@@ -1,12 +1,17 @@
 import os
 from utils import shell
 
-def mount_vdev(vdev_path, mount_root, drive_name, fs_type):
+# Read-only mounts must not replay a journal or log: the device takes no writes
+READ_ONLY_OPTIONS = {"ext4": "ro,noload", "btrfs": "ro,nologreplay", "xfs": "ro,norecovery"}
+
+def mount_vdev(vdev_path, mount_root, drive_name, fs_type, read_only=False):
     target = os.path.join(mount_root, drive_name)
     os.makedirs(target, exist_ok=True)
     
     opts = ["mount"]
-    if fs_type == "btrfs":
+    if read_only:
+        opts += ["-o", READ_ONLY_OPTIONS.get(fs_type, "ro")]
+    elif fs_type == "btrfs":
         opts += ["-o", "compress=zstd"]
     
     opts += [vdev_path, target]
@@ -0,0 +1,375 @@
+import os
+import socket
+import struct
+import threading
+from core import nbd_server, control, logger
+from core.nbd_server import NBDServer
+
+# Newstyle handshake
+NBD_MAGIC = b"NBDMAGIC"
+NBD_OPTS_MAGIC = 0x49484156454F5054  # "IHAVEOPT"
+NBD_REP_MAGIC = 0x3e889045565a9
+
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_OPT_LIST_META_CONTEXT = 9
+NBD_OPT_SET_META_CONTEXT = 10
+
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_META_CONTEXT = 4
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_REP_ERR_INVALID = (1 << 31) + 3
+NBD_REP_ERR_UNKNOWN = (1 << 31) + 6
+
+NBD_INFO_EXPORT = 0
+NBD_INFO_BLOCK_SIZE = 3
+
+# Transmission additions over the kernel protocol
+NBD_FLAG_SEND_DF = 1 << 7
+NBD_CMD_BLOCK_STATUS = 7
+NBD_CMD_FLAG_REQ_ONE = 1 << 3
+
+# Structured replies
+NBD_STRUCTURED_REPLY_MAGIC = 0x668e33ef
+NBD_REPLY_FLAG_DONE = 1 << 0
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+
+# The one metadata context: allocation as seen by block status
+BASE_ALLOCATION = "base:allocation"
+BASE_ALLOCATION_ID = 1
+NBD_STATE_HOLE = 1 << 0
+NBD_STATE_ZERO = 1 << 1
+
+DEFAULT_PORT = 10809
+DEFAULT_LISTEN = f"127.0.0.1:{DEFAULT_PORT}"
+# Options carry names and context queries; anything bigger is not a real client
+MAX_OPTION = 64 * 1024
+# Preferred request alignment advertised to clients (the kernel device's block size)
+PREFERRED_BLOCK = 4096
+
+log = logger.get("nbd-net")
+
+def parse_listen(listen):
+    """(family, address) of a listen address: a path for a Unix socket, else host:port."""
+    if "/" in listen:
+        return socket.AF_UNIX, listen
+    host, sep, port = listen.rpartition(":")
+    if not sep:
+        host, port = listen, DEFAULT_PORT
+    host = host.strip("[]")
+    return (socket.AF_INET6 if ":" in host else socket.AF_INET), (host, int(port))
+
+class Session:
+    """What one client negotiated during the handshake, for the life of its connection."""
+    def __init__(self, peer):
+        self.peer = peer
+        self.structured = False
+        # base:allocation selected with SET_META_CONTEXT, so BLOCK_STATUS is allowed
+        self.allocation = False
+
+class NetworkServer(NBDServer):
+    """
+    Serves a drive to NBD clients over TCP or a Unix socket (qemu, nbdcopy,
+    nbd-client on another host), no kernel module or root needed. Each client
+    goes through the fixed newstyle handshake, then gets NBDServer's dispatcher
+    and worker pool on its own connection, all against the one VirtualDisk.
+    Clients that negotiate structured replies may ask for block status
+    (base:allocation): holes in chunk files and missing chunks come back as
+    zero holes, so copies and backups can skip them.
+    """
+    def __init__(self, listen, vdisk, **kwargs):
+        super().__init__(listen, vdisk, **kwargs)
+        self.listen = listen
+        self.sock = None
+        # Sessions of clients in transmission; _clients also holds those still haggling
+        self.sessions = {}
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+
+    def _socket_pairs(self, connections):
+        # Clients bring their own sockets
+        return []
+
+    def _flags(self, multi_conn):
+        # Every connection shares the disk, so a FLUSH on one covers writes from all
+        return super()._flags(True) | NBD_FLAG_SEND_DF
+
+    def _recv(self, conn, n):
+        buf = bytearray(n)
+        self._recv_into(conn, memoryview(buf))
+        return bytes(buf)
+
+    # --- Handshake ---
+
+    def _export_names(self):
+        # "" is the default export
+        return ("", self.name)
+
+    def _option_reply(self, conn, opt, rep_type, data=b""):
+        conn.sendall(struct.pack(">QLLL", NBD_REP_MAGIC, opt, rep_type, len(data)) + data)
+
+    def _parse_export(self, data):
+        """Splits a leading length-prefixed export name off option data."""
+        (n,) = struct.unpack_from(">L", data)
+        if 4 + n > len(data):
+            raise ValueError("Export name runs past the option")
+        return data[4 : 4 + n].decode(), data[4 + n :]
+
+    def _handshake(self, conn, session):
+        """Option haggling. Returns True once the client moves on to transmission."""
+        conn.sendall(NBD_MAGIC + struct.pack(">QH", NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        (client_flags,) = struct.unpack(">L", self._recv(conn, 4))
+        if not client_flags & NBD_FLAG_C_FIXED_NEWSTYLE:
+            log.warning(f"{session.peer}: client does not speak fixed newstyle")
+            return False
+
+        while True:
+            magic, opt, n = struct.unpack(">QLL", self._recv(conn, 16))
+            if magic != NBD_OPTS_MAGIC or n > MAX_OPTION:
+                log.warning(f"{session.peer}: bad option header")
+                return False
+            data = self._recv(conn, n)
+
+            if opt == NBD_OPT_EXPORT_NAME:
+                # No way to refuse here but to hang up
+                if data.decode(errors="replace") not in self._export_names():
+                    return False
+                zeroes = b"" if client_flags & NBD_FLAG_C_NO_ZEROES else bytes(124)
+                conn.sendall(struct.pack(">QH", self.vdisk.total_size, self._flags(True)) + zeroes)
+                return True
+
+            if opt == NBD_OPT_ABORT:
+                self._option_reply(conn, opt, NBD_REP_ACK)
+                return False
+
+            try:
+                if opt == NBD_OPT_LIST:
+                    if data:
+                        raise ValueError("LIST takes no data")
+                    name = self.name.encode()
+                    self._option_reply(conn, opt, NBD_REP_SERVER, struct.pack(">L", len(name)) + name)
+                    self._option_reply(conn, opt, NBD_REP_ACK)
+
+                elif opt in (NBD_OPT_INFO, NBD_OPT_GO):
+                    name, rest = self._parse_export(data)
+                    (count,) = struct.unpack_from(">H", rest)
+                    if len(rest) != 2 + 2 * count:
+                        raise ValueError("Bad information request list")
+                    if name not in self._export_names():
+                        self._option_reply(conn, opt, NBD_REP_ERR_UNKNOWN)
+                        continue
+                    self._option_reply(conn, opt, NBD_REP_INFO, struct.pack(
+                        ">HQH", NBD_INFO_EXPORT, self.vdisk.total_size, self._flags(True)))
+                    self._option_reply(conn, opt, NBD_REP_INFO, struct.pack(
+                        ">HLLL", NBD_INFO_BLOCK_SIZE, 1, PREFERRED_BLOCK, nbd_server.MAX_PAYLOAD))
+                    self._option_reply(conn, opt, NBD_REP_ACK)
+                    if opt == NBD_OPT_GO:
+                        return True
+
+                elif opt == NBD_OPT_STRUCTURED_REPLY:
+                    if data:
+                        raise ValueError("STRUCTURED_REPLY takes no data")
+                    session.structured = True
+                    self._option_reply(conn, opt, NBD_REP_ACK)
+
+                elif opt in (NBD_OPT_LIST_META_CONTEXT, NBD_OPT_SET_META_CONTEXT):
+                    self._meta_context(conn, opt, data, session)
+
+                else:
+                    self._option_reply(conn, opt, NBD_REP_ERR_UNSUP)
+
+            except (ValueError, struct.error, UnicodeDecodeError) as e:
+                log.debug(f"{session.peer}: invalid option {opt}: {e}")
+                self._option_reply(conn, opt, NBD_REP_ERR_INVALID)
+
+    def _meta_context(self, conn, opt, data, session):
+        """LIST/SET_META_CONTEXT. SET replaces the selection, so it may also clear it."""
+        name, rest = self._parse_export(data)
+        (count,) = struct.unpack_from(">L", rest)
+        queries, pos = [], 4
+        for _ in range(count):
+            (n,) = struct.unpack_from(">L", rest, pos)
+            queries.append(rest[pos + 4 : pos + 4 + n].decode())
+            pos += 4 + n
+        if pos != len(rest):
+            raise ValueError("Bad context query list")
+        if opt == NBD_OPT_SET_META_CONTEXT and not session.structured:
+            raise ValueError("SET_META_CONTEXT before STRUCTURED_REPLY")
+        if name not in self._export_names():
+            self._option_reply(conn, opt, NBD_REP_ERR_UNKNOWN)
+            return
+
+        if opt == NBD_OPT_LIST_META_CONTEXT:
+            # No queries lists everything; "base:" asks for all of that namespace
+            match = not queries or any(q in ("base:", BASE_ALLOCATION) for q in queries)
+        else:
+            match = BASE_ALLOCATION in queries
+            session.allocation = match
+        if match:
+            ctx = BASE_ALLOCATION.encode()
+            self._option_reply(conn, opt, NBD_REP_META_CONTEXT, struct.pack(">L", BASE_ALLOCATION_ID) + ctx)
+        self._option_reply(conn, opt, NBD_REP_ACK)
+
+    # --- Transmission ---
+
+    def _send_chunk(self, conn, flags, reply_type, handle, payload=b""):
+        header = struct.pack(">LHHQL", NBD_STRUCTURED_REPLY_MAGIC, flags, reply_type, handle, len(payload))
+        self._send(conn, header, payload)
+
+    def _send_reply(self, conn, handle, error, data=b""):
+        if not self.sessions[conn].structured:
+            super()._send_reply(conn, handle, error, data)
+        elif error:
+            self._send_chunk(conn, NBD_REPLY_FLAG_DONE, NBD_REPLY_TYPE_ERROR, handle, struct.pack(">LH", error, 0))
+        else:
+            self._send_chunk(conn, NBD_REPLY_FLAG_DONE, NBD_REPLY_TYPE_NONE, handle)
+
+    def _read_header(self, conn, handle, offset, length):
+        if not self.sessions[conn].structured:
+            return super()._read_header(conn, handle, offset, length)
+        # The whole read is one data chunk, so DF requests are always honored
+        return struct.pack(">LHHQLQ", NBD_STRUCTURED_REPLY_MAGIC, NBD_REPLY_FLAG_DONE, NBD_REPLY_TYPE_OFFSET_DATA,
+                           handle, length + 8, offset)
+
+    def _block_status(self, conn, flags, handle, offset, length):
+        runs = self.vdisk.extents(offset, length)
+        if flags & NBD_CMD_FLAG_REQ_ONE:
+            runs = runs[:1]
+        payload = struct.pack(">L", BASE_ALLOCATION_ID) + b"".join(
+            struct.pack(">LL", n, NBD_STATE_HOLE | NBD_STATE_ZERO if hole else 0) for n, hole in runs
+        )
+        self._send_chunk(conn, NBD_REPLY_FLAG_DONE, NBD_REPLY_TYPE_BLOCK_STATUS, handle, payload)
+
+    def _execute(self, conn, cmd_type, flags, handle, offset, length, data, started):
+        if cmd_type != NBD_CMD_BLOCK_STATUS:
+            super()._execute(conn, cmd_type, flags, handle, offset, length, data, started)
+            return
+
+        error = 0
+        try:
+            if not self.sessions[conn].allocation or not length or offset + length > self.vdisk.total_size:
+                error = 22 # EINVAL
+            else:
+                self._block_status(conn, flags, handle, offset, length)
+        except Exception as e:
+            log.exception(f"Block status failed at offset {offset}: {e}")
+            error = 5 # EIO
+        try:
+            if error:
+                self._send_reply(conn, handle, error)
+        except OSError as e:
+            log.error(f"Reply failed for handle {handle}: {e}")
+        self.metrics.end(cmd_type, started, length, error)
+
+    def _disconnected(self, conn):
+        # Only this client is leaving
+        pass
+
+    def _serve_client(self, conn, peer):
+        session = Session(peer or self.listen)
+        try:
+            if conn.family != socket.AF_UNIX:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if not self._handshake(conn, session):
+                return
+            self.sessions[conn] = session
+            log.info(f"{session.peer} attached (structured replies: {session.structured})")
+            self._handle_request(conn)
+        except (OSError, EOFError, struct.error) as e:
+            log.info(f"{session.peer} dropped: {e}")
+        finally:
+            with self._clients_lock:
+                self._clients.discard(conn)
+                self.sessions.pop(conn, None)
+                self._send_locks.pop(conn, None)
+            conn.close()
+
+    def stats(self):
+        snap = super().stats()
+        snap["connections"] = len(self.sessions)
+        return snap
+
+    def _bind(self):
+        family, address = parse_listen(self.listen)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(address)
+            sock.listen(16)
+            return sock
+        return socket.create_server(address, family=family, backlog=16)
+
+    def start(self, ready=None):
+        """Takes clients until stop(). ready() is called once the socket listens."""
+        threads = []
+        ctl = control.ControlServer(self.control_path, self.handlers)
+        try:
+            self.sock = self._bind()
+            self.running = True
+            if self.control_path:
+                ctl.start()
+            if self.rehasher:
+                self.rehasher.start()
+            log.info(f"Serving {self.name} on {self.listen}")
+            if ready:
+                ready()
+            while self.running:
+                try:
+                    conn, peer = self.sock.accept()
+                except OSError:
+                    break
+                with self._clients_lock:
+                    self._clients.add(conn)
+                threads = [t for t in threads if t.is_alive()]
+                t = threading.Thread(target=self._serve_client, args=(conn, peer), daemon=True, name="nbd-client")
+                t.start()
+                threads.append(t)
+        finally:
+            self.running = False
+            if self.control_path:
+                ctl.stop()
+            if self.sock:
+                self.sock.close()
+                if self.sock.family == socket.AF_UNIX and os.path.exists(self.listen):
+                    os.remove(self.listen)
+            # Wake the dispatchers; each lets its in-flight requests finish
+            with self._clients_lock:
+                for conn in self._clients:
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            for t in threads:
+                t.join()
+            if self.rehasher:
+                self.rehasher.stop()
+            self.vdisk.close()
+
+    def stop(self):
+        """Stops taking clients and disconnects the attached ones; start() returns once they are done."""
+        self.running = False
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def open_network_server(drive_path, drive_name, chunk_mb, total_chunks, listen, **kwargs):
+    """open_server for a NetworkServer listening on listen; kwargs as for open_server."""
+    return nbd_server.open_server(drive_path, drive_name, chunk_mb, total_chunks, listen,
+                                  server_class=NetworkServer, **kwargs)
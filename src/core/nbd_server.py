@@ -4,147 +4,457 @@ import os
 import fcntl
 import threading
 import signal
-import sys
-import datetime
+import time
+import select
+from concurrent.futures import ThreadPoolExecutor
 from core.io import VirtualDisk
+from core.database import DBManager
+from core.journal import DirtyJournal
+from core import cas, tiered, remote, snapshot, rehash
+from config_loader import get_config
+from core.buffers import BufferPool
+from core import metrics, logger, control, devices
 from utils import shell
 
-# ... (Keep constants the same) ...
 NBD_SET_SOCK = 0xab00
 NBD_SET_BLKSIZE = 0xab01
 NBD_SET_SIZE = 0xab02
 NBD_DO_IT = 0xab03
 NBD_CLEAR_SOCK = 0xab04
+NBD_SET_FLAGS = 0xab0a
+
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_SEND_FUA = 1 << 3
+NBD_FLAG_SEND_TRIM = 1 << 5
+NBD_FLAG_SEND_WRITE_ZEROES = 1 << 6
+NBD_FLAG_CAN_MULTI_CONN = 1 << 8
 
 NBD_CMD_READ = 0
 NBD_CMD_WRITE = 1
 NBD_CMD_DISC = 2
 NBD_CMD_FLUSH = 3
 NBD_CMD_TRIM = 4
+NBD_CMD_WRITE_ZEROES = 6
+
+# Force unit access: the reply may only go out once the data is durable
+NBD_CMD_FLAG_FUA = 1 << 0
+NBD_CMD_FLAG_NO_HOLE = 1 << 1
 
 NBD_REQUEST_MAGIC = 0x25609513
 NBD_REPLY_MAGIC = 0x67446698
 
-def log_debug(msg):
-    """Simple file logger for debugging background process."""
-    with open("/tmp/tgfs_debug.log", "a") as f:
-        ts = datetime.datetime.now().isoformat()
-        f.write(f"[{ts}] {msg}\n")
+# Largest READ or WRITE payload taken; the kernel sends at most 32 MiB per request
+MAX_PAYLOAD = 32 * 1024 * 1024
+
+DEFAULT_WORKERS = 8
+DEFAULT_CONNECTIONS = 1
+
+# "sendfile" streams chunk files straight to the socket; "preadv" reads into a
+# pooled buffer first (for sockets or kernels where sendfile is unavailable)
+READ_MODES = ("sendfile", "preadv")
+
+# Longest a starting server may take to have its device live before the
+# mount gives up on it
+READY_TIMEOUT = 10.0
+
+log = logger.get("nbd")
+
+class StopRequested(Exception):
+    """Raised by the SIGTERM handler of a daemon to leave NBD_DO_IT (see NBDServer.request_stop)."""
 
 class NBDServer:
-    def __init__(self, device_path, vdisk: VirtualDisk):
+    """
+    Serves the NBD transmission phase. A dispatcher thread keeps reading request
+    headers (and write payloads) off the socket while a worker pool runs the
+    VirtualDisk I/O. Replies carry the request handle, so they may go out of order;
+    a per-socket send lock keeps each reply contiguous on the wire.
+    With several connections the kernel spreads requests over one socket pair per
+    queue, each served by its own dispatcher against the shared VirtualDisk.
+    """
+    def __init__(self, device_path, vdisk: VirtualDisk, workers=DEFAULT_WORKERS, read_mode="sendfile",
+                 connections=DEFAULT_CONNECTIONS, control_path=None, executor=None, buffers=None,
+                 name=None):
+        if read_mode not in READ_MODES:
+            raise ValueError(f"Unknown read mode: {read_mode}")
+        if not hasattr(os, "sendfile"):
+            read_mode = "preadv"
         self.device_path = device_path
+        self.name = name or device_path
         self.vdisk = vdisk
-        self.sock_pair = socket.socketpair()
+        self.sock_pairs = self._socket_pairs(connections)
         self.running = False
+        self.workers = workers
+        self.read_mode = read_mode
+        # A supervisor passes in its buffer pool and worker executor, shared by all drives
+        self.buffers = buffers or BufferPool()
+        self.executor = executor
+        self._send_locks = {}
+        self.metrics = metrics.Metrics()
+        # Optional Unix socket for CLI requests; run_daemon registers more handlers
+        self.control_path = control_path
+        self.handlers = {"stats": self.stats}
+        # Optional background rehasher, run while the device is served
+        self.rehasher = None
+        self._stopping = False
 
-    def _recv_exact(self, conn, size):
-        data = b""
-        while len(data) < size:
-            chunk = conn.recv(size - len(data))
-            if not chunk: 
+    def _socket_pairs(self, connections):
+        """One (our end, kernel end) pair per device queue."""
+        return [socket.socketpair() for _ in range(max(1, connections))]
+
+    def _flags(self, multi_conn):
+        """Transmission flags advertised for the export."""
+        flags = (NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH | NBD_FLAG_SEND_FUA | NBD_FLAG_SEND_TRIM
+                 | NBD_FLAG_SEND_WRITE_ZEROES)
+        if self.vdisk.read_only:
+            flags |= NBD_FLAG_READ_ONLY
+        if multi_conn:
+            # FLUSH syncs every chunk written since the last one, from any queue
+            flags |= NBD_FLAG_CAN_MULTI_CONN
+        return flags
+
+    def _recv_into(self, conn, view):
+        """Fills a memoryview from the socket in place, without building bytes."""
+        received = 0
+        size = len(view)
+        while received < size:
+            n = conn.recv_into(view[received:], size - received)
+            if not n:
                 raise EOFError("Socket closed prematurely")
-            data += chunk
-        return data
+            received += n
+
+    def _send(self, conn, header, data=b""):
+        """Serialized reply writer: header and payload go out back to back."""
+        with self._send_locks[conn]:
+            conn.sendall(header)
+            if data:
+                conn.sendall(data)
+
+    def _send_reply(self, conn, handle, error, data=b""):
+        self._send(conn, struct.pack(">LLQ", NBD_REPLY_MAGIC, error, handle), data)
+
+    def _read_header(self, conn, handle, offset, length):
+        """Header that goes out ahead of a READ's payload."""
+        return struct.pack(">LLQ", NBD_REPLY_MAGIC, 0, handle)
+
+    def _send_read(self, conn, handle, offset, length):
+        """Replies to a READ. Handles are pinned before the header commits us to a payload."""
+        # Blocks still in the write-back cache are not in the files sendfile reads,
+        # and read-ahead hits are cheaper to copy than to fetch again
+        if self.read_mode == "sendfile" and not self.vdisk.in_memory(offset, length):
+            with self.vdisk.pinned(offset, length) as segments:
+                with self._send_locks[conn]:
+                    conn.sendall(self._read_header(conn, handle, offset, length))
+                    try:
+                        self.vdisk.sendfile(conn, segments)
+                    except OSError as e:
+                        # The header already promised a payload; the stream is now
+                        # unrecoverable, so drop the connection instead of desyncing
+                        log.error(f"sendfile failed mid-reply for handle {handle}: {e}")
+                        conn.shutdown(socket.SHUT_RDWR)
+            return
+
+        buf = self.buffers.acquire(length)
+        try:
+            view = memoryview(buf)[:length]
+            self.vdisk.read_into(view, offset)
+            self._send(conn, self._read_header(conn, handle, offset, length), view)
+            view.release()
+        finally:
+            self.buffers.release(buf)
+
+    def _execute(self, conn, cmd_type, flags, handle, offset, length, data, started):
+        """Runs one request on a pool worker and sends its reply."""
+        error = 0
+        replied = False
+
+        try:
+            if offset + length > self.vdisk.total_size:
+                error = 22 # EINVAL
+
+            elif self.vdisk.read_only and cmd_type in (NBD_CMD_WRITE, NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES):
+                error = 1 # EPERM
+
+            elif cmd_type == NBD_CMD_READ and length > MAX_PAYLOAD:
+                error = 22 # EINVAL
+
+            elif cmd_type == NBD_CMD_READ:
+                self._send_read(conn, handle, offset, length)
+                replied = True
+            
+            elif cmd_type == NBD_CMD_WRITE:
+                self.vdisk.write(offset, data, fua=bool(flags & NBD_CMD_FLAG_FUA))
+            
+            elif cmd_type == NBD_CMD_FLUSH:
+                self.vdisk.sync()
+
+            elif cmd_type == NBD_CMD_TRIM:
+                self.vdisk.trim(offset, length, fua=bool(flags & NBD_CMD_FLAG_FUA))
+
+            elif cmd_type == NBD_CMD_WRITE_ZEROES:
+                self.vdisk.write_zeroes(offset, length, may_trim=not (flags & NBD_CMD_FLAG_NO_HOLE),
+                                        fua=bool(flags & NBD_CMD_FLAG_FUA))
+
+            else:
+                log.warning(f"Unknown command type: {cmd_type}")
+                error = 1 
+        
+        except Exception as e:
+            log.exception(f"CRITICAL IO ERROR processing cmd {cmd_type} at offset {offset}: {e}")
+            error = 5 # EIO
+        finally:
+            if data is not None:
+                buf = data.obj
+                data.release()
+                self.buffers.release(buf)
+
+        try:
+            if not replied:
+                self._send_reply(conn, handle, error)
+        except OSError as e:
+            log.error(f"Reply failed for handle {handle}: {e}")
+        self.metrics.end(cmd_type, started, length, error)
 
     def _handle_request(self, conn):
-        log_debug("Worker thread started.")
-        while self.running:
-            try:
+        log.debug("Dispatcher thread started.")
+        self._send_locks[conn] = threading.Lock()
+        if self.executor:
+            pool = self.executor.bind(self)
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="nbd-io")
+        header = bytearray(28)
+        header_view = memoryview(header)
+        try:
+            while self.running:
                 try:
-                    header = self._recv_exact(conn, 28)
-                except EOFError:
-                    log_debug("Kernel closed connection (EOF).")
-                    break
+                    try:
+                        self._recv_into(conn, header_view)
+                    except EOFError:
+                        log.info("Kernel closed connection (EOF).")
+                        break
 
-                (magic, cmd_type, handle, offset, length) = struct.unpack(">LLQQL", header)
+                    (magic, cmd_type, handle, offset, length) = struct.unpack(">LLQQL", header)
+                    # Upper 16 bits of the type field carry per-command flags
+                    flags, cmd_type = cmd_type >> 16, cmd_type & 0xffff
 
-                if magic != NBD_REQUEST_MAGIC:
-                    log_debug(f"Invalid magic: {hex(magic)}")
-                    break
+                    if magic != NBD_REQUEST_MAGIC:
+                        log.error(f"Invalid magic: {hex(magic)}")
+                        break
 
-                error = 0
-                response_data = b""
+                    if cmd_type == NBD_CMD_DISC:
+                        log.info("Received DISCONNECT command.")
+                        self._disconnected(conn)
+                        break
+
+                    # The payload must be drained here to keep the stream in sync.
+                    # It lands in a pooled buffer that the worker hands back.
+                    data = None
+                    if cmd_type == NBD_CMD_WRITE:
+                        if length > MAX_PAYLOAD:
+                            # Too big to buffer, and skipping it would desync the stream
+                            log.error(f"Write of {length} bytes exceeds {MAX_PAYLOAD}")
+                            break
+                        data = memoryview(self.buffers.acquire(length))[:length]
+                        self._recv_into(conn, data)
+
+                    started = self.metrics.begin()
+                    pool.submit(self._execute, conn, cmd_type, flags, handle, offset, length, data, started)
 
-                try:
-                    if cmd_type == NBD_CMD_READ:
-                        response_data = self.vdisk.read(offset, length)
-                    
-                    elif cmd_type == NBD_CMD_WRITE:
-                        data = self._recv_exact(conn, length)
-                        self.vdisk.write(offset, data)
-                    
-                    elif cmd_type == NBD_CMD_DISC:
-                        log_debug("Received DISCONNECT command.")
-                        self.running = False
-                        return 
-                    
-                    elif cmd_type == NBD_CMD_FLUSH:
-                        self.vdisk.sync()
-
-                    elif cmd_type == NBD_CMD_TRIM:
-                        pass 
-
-                    else:
-                        log_debug(f"Unknown command type: {cmd_type}")
-                        error = 1 
-                
                 except Exception as e:
-                    log_debug(f"CRITICAL IO ERROR processing cmd {cmd_type} at offset {offset}: {e}")
-                    import traceback
-                    log_debug(traceback.format_exc())
-                    error = 5 # EIO
-
-                reply = struct.pack(">LLQ", NBD_REPLY_MAGIC, error, handle)
-                conn.sendall(reply)
-                
-                if cmd_type == NBD_CMD_READ and error == 0:
-                    conn.sendall(response_data)
-
-            except Exception as e:
-                log_debug(f"Loop crash: {e}")
-                break
-        log_debug("Worker thread exiting.")
-
-    def start(self):
-        log_debug(f"Starting NBD Server on {self.device_path}")
+                    log.exception(f"Loop crash: {e}")
+                    break
+        finally:
+            # Let in-flight requests finish and reply before returning
+            pool.shutdown(wait=True)
+        log.debug("Dispatcher thread exiting.")
+
+    def _disconnected(self, conn):
+        """DISC on a kernel socket: the device is going away, so stop serving it."""
+        self.running = False
+
+    def stats(self):
+        """Live counters for `tgfs stats`."""
+        snap = self.metrics.snapshot()
+        snap["connections"] = len(self.sock_pairs)
+        snap["vdisk"] = self.vdisk.stats_snapshot()
+        if self.rehasher:
+            snap["rehash"] = dict(self.rehasher.stats)
+        return snap
+
+    def _signal_ready(self, ready):
+        # NBD_DO_IT blocks for the life of the device, so watch for the pid
+        # the kernel publishes in sysfs once it has taken the sockets
+        deadline = time.monotonic() + READY_TIMEOUT
+        while self.running and not devices.is_connected(self.device_path):
+            if time.monotonic() > deadline:
+                log.warning(f"{self.device_path} not live after {READY_TIMEOUT}s")
+                return
+            time.sleep(0.002)
+        if self.running:
+            ready()
+
+    def request_stop(self, *_):
+        """
+        SIGTERM handler of a daemon. Raising interrupts NBD_DO_IT, which the
+        kernel then ends like a disconnect, and start() drains requests and
+        closes the disk as usual. Later signals are ignored so the cleanup
+        is not cut short.
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        raise StopRequested()
+
+    def start(self, ready=None):
+        """
+        Serves until the device is disconnected. ready() is called once the
+        kernel has the device live, i.e. NBD_DO_IT is running.
+        """
+        log.info(f"Starting NBD Server on {self.device_path}")
         self.running = True
         
         try:
             nbd_fd = os.open(self.device_path, os.O_RDWR)
         except OSError as e:
-            log_debug(f"Failed to open device: {e}")
+            log.error(f"Failed to open device: {e}")
             return
 
+        threads = []
+        ctl = control.ControlServer(self.control_path, self.handlers)
         try:
             fcntl.ioctl(nbd_fd, NBD_SET_BLKSIZE, 4096) 
             fcntl.ioctl(nbd_fd, NBD_SET_SIZE, self.vdisk.total_size)
+            fcntl.ioctl(nbd_fd, NBD_SET_FLAGS, self._flags(len(self.sock_pairs) > 1))
             fcntl.ioctl(nbd_fd, NBD_CLEAR_SOCK)
 
-            kernel_sock = self.sock_pair[1]
-            my_sock = self.sock_pair[0]
-            
-            fcntl.ioctl(nbd_fd, NBD_SET_SOCK, kernel_sock.fileno())
+            # Each NBD_SET_SOCK adds one hardware queue to the device
+            for my_sock, kernel_sock in self.sock_pairs:
+                fcntl.ioctl(nbd_fd, NBD_SET_SOCK, kernel_sock.fileno())
 
-            t = threading.Thread(target=self._handle_request, args=(my_sock,))
-            t.start()
+                t = threading.Thread(target=self._handle_request, args=(my_sock,))
+                t.start()
+                threads.append(t)
 
-            log_debug("Calling NBD_DO_IT (Blocking)...")
+            if self.control_path:
+                ctl.start()
+            if self.rehasher:
+                self.rehasher.start()
+            if ready:
+                threading.Thread(target=self._signal_ready, args=(ready,), daemon=True, name="ready").start()
+            log.debug("Calling NBD_DO_IT (Blocking)...")
             fcntl.ioctl(nbd_fd, NBD_DO_IT)
-            log_debug("NBD_DO_IT returned.")
+            log.info("NBD_DO_IT returned.")
             
+        except StopRequested:
+            log.info("Stopping on SIGTERM")
         except Exception as e:
-            log_debug(f"Setup error: {e}")
+            log.exception(f"Setup error: {e}")
         finally:
             self.running = False
-            self.sock_pair[0].close()
-            self.sock_pair[1].close()
+            if self.control_path:
+                ctl.stop()
+            # Wake the dispatchers and let in-flight writes land before the
+            # journal is closed and marked clean
+            for my_sock, _ in self.sock_pairs:
+                try:
+                    my_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for t in threads:
+                t.join()
+            for my_sock, kernel_sock in self.sock_pairs:
+                my_sock.close()
+                kernel_sock.close()
             os.close(nbd_fd)
+            if self.rehasher:
+                self.rehasher.stop()
             self.vdisk.close()
-            # t.join() # Don't block here in daemon
 
-def run_daemon(drive_path, drive_name, chunk_mb, total_chunks, device="/dev/nbd0"):
+def open_disk(drive_path, drive_name, chunk_mb, total_chunks, cache_mb=0, readahead_mb=0, tier_mb=0,
+              snapshot_name=None, read_only=False):
+    """
+    Opens the VirtualDisk that fits the drive (layout, tier, snapshot).
+    Writable disks get a dirty journal. Returns (vdisk, db, instance name).
+    """
+    db = DBManager(drive_path, drive_name)
+    instance = drive_name
+    journal = None
+    if not (snapshot_name or read_only or db.get_meta("layout") == "cas"):
+        journal = DirtyJournal(db)
+        journal.open()
+    if snapshot_name:
+        # Snapshot folders hold the chunk files under their usual names
+        instance = snapshot.instance_name(drive_name, snapshot_name)
+        vdisk = VirtualDisk(snapshot.get_snapshot_path(drive_path, snapshot_name), drive_name, chunk_mb,
+                            total_chunks, read_only=True, readahead_mb=readahead_mb)
+    elif db.get_meta("layout") == "cas":
+        # Private block copies are the record of what changed; no journal needed
+        cas_root = cas.get_cas_root(os.path.dirname(drive_path))
+        vdisk = cas.CASDisk(drive_path, drive_name, chunk_mb, total_chunks, int(db.get_meta("block_size_mb")),
+                            cas_root, read_only=read_only, cache_mb=cache_mb, readahead_mb=readahead_mb)
+    elif tier_mb:
+        # Chunks not on local disk are fetched from the remote as they are read
+        backend = remote.get_backend(get_config().get('remote', {}))
+        vdisk = tiered.TieredDisk(drive_path, drive_name, chunk_mb, total_chunks, backend, tier_mb,
+                                  read_only=read_only, journal=journal, cache_mb=cache_mb,
+                                  readahead_mb=readahead_mb, db=db)
+    else:
+        # Left in the tier by a tiered mount that did not close
+        tiered.restore(drive_path, db)
+        vdisk = VirtualDisk(drive_path, drive_name, chunk_mb, total_chunks, read_only=read_only, journal=journal,
+                            cache_mb=cache_mb, readahead_mb=readahead_mb, db=db)
+    return vdisk, db, instance
+
+def open_server(drive_path, drive_name, chunk_mb, total_chunks, device, cache_mb=0, readahead_mb=0,
+                connections=DEFAULT_CONNECTIONS, tier_mb=0, snapshot_name=None, server_class=None, **kwargs):
+    """
+    Opens the drive's VirtualDisk (see open_disk) and an NBDServer (or
+    server_class) for it with its control socket. kwargs go to the server.
+    """
+    vdisk, db, instance = open_disk(drive_path, drive_name, chunk_mb, total_chunks, cache_mb, readahead_mb, tier_mb,
+                                    snapshot_name)
+    control_path = control.get_control_socket(os.path.dirname(drive_path), instance)
+    server = (server_class or NBDServer)(device, vdisk, connections=connections, control_path=control_path,
+                                         name=instance, **kwargs)
+    if not vdisk.read_only and db.get_meta("layout") != "cas":
+        server.handlers["snapshot"] = lambda name: snapshot.take_live(vdisk, db, name)
+    conf = get_config().get('rehash', {})
+    # Tiered drives keep remote object keys by chunk filename, so their chunks keep names while served
+    if type(vdisk) is VirtualDisk and vdisk.journal and db.get_meta("block_size_mb") and conf.get('enabled', True):
+        server.rehasher = rehash.Rehasher(
+            vdisk, db, server.metrics.idle_for, conf.get('idle_s', rehash.DEFAULT_IDLE),
+            conf.get('rate_mb', rehash.DEFAULT_RATE_MB), conf.get('interval_s', rehash.DEFAULT_INTERVAL)
+        )
+    return server
+
+def notify_ready(fd):
+    """Daemon side of the startup handshake: tells the waiting parent the device is live."""
+    os.write(fd, b"1")
+    os.close(fd)
+
+def wait_ready(fd, timeout=READY_TIMEOUT):
+    """
+    Parent side of the startup handshake: blocks on the read end of the pipe
+    handed to the daemon. False if the daemon exited (pipe closed without a
+    byte) or did not come up in time.
+    """
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        return bool(readable) and os.read(fd, 1) == b"1"
+    finally:
+        os.close(fd)
+
+def run_daemon(drive_path, drive_name, chunk_mb, total_chunks, device, cache_mb=0, readahead_mb=0,
+               connections=DEFAULT_CONNECTIONS, tier_mb=0, snapshot_name=None, ready_fd=None):
+    log_conf = get_config().get('log', {})
+    logger.setup(log_conf.get('file', logger.DEFAULT_FILE), log_conf.get('level', logger.DEFAULT_LEVEL))
     shell.run(["modprobe", "nbd"], check=False)
-    vdisk = VirtualDisk(drive_path, drive_name, chunk_mb, total_chunks)
-    server = NBDServer(device, vdisk)
-    server.start()
+    ready = None
+    if ready_fd is not None:
+        ready = lambda: notify_ready(ready_fd)
+    server = open_server(drive_path, drive_name, chunk_mb, total_chunks, device, cache_mb, readahead_mb, connections,
+                         tier_mb, snapshot_name)
+    signal.signal(signal.SIGTERM, server.request_stop)
+    server.start(ready)
+    logger.shutdown()
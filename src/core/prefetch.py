@@ -0,0 +1,156 @@
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Prefetched data is kept in aligned units so lookups are a dict probe
+UNIT = 256 * 1024
+MIN_WINDOW = 2 * UNIT
+MAX_WINDOW = 32 * UNIT
+MAX_STREAMS = 16
+
+class Stream:
+    def __init__(self, next_offset):
+        self.next_offset = next_offset
+        self.window = MIN_WINDOW
+
+class ReadAhead:
+    """
+    Adaptive sequential read-ahead in front of VirtualDisk.
+    Each read is matched against recently seen streams; a read that continues a
+    stream doubles its window (up to max_window) and background threads fetch the
+    units ahead of it into a bounded buffer. Works on device offsets, so windows
+    cross chunk boundaries freely. Writes invalidate overlapping units.
+    """
+    def __init__(self, fetch, total_size, max_bytes=64 * 1024 * 1024, workers=2):
+        # fetch(view, offset) fills view from the disk (bypassing read-ahead)
+        self.fetch = fetch
+        self.total_size = total_size
+        self.max_units = max(1, max_bytes // UNIT)
+        # Leave room for a few streams so windows do not evict each other
+        self.max_window = max(UNIT, min(MAX_WINDOW, self.max_units * UNIT // 4))
+        self.streams = collections.OrderedDict()
+        # unit index -> bytearray (ready) or Future (in flight)
+        self.units = collections.OrderedDict()
+        self.used = set()
+        self.stats = collections.Counter()
+        # unit index -> token of the fetch allowed to publish it; invalidate()
+        # and eviction drop the token so a stale fetch is discarded
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="readahead")
+
+    def serve(self, view, offset):
+        """Fills view from prefetched units if all of them are present. Returns True on a hit."""
+        first, last = offset // UNIT, (offset + len(view) - 1) // UNIT
+        with self._lock:
+            parts = [self.units.get(u) for u in range(first, last + 1)]
+        if any(p is None for p in parts):
+            return False
+
+        pos = 0
+        for u, part in zip(range(first, last + 1), parts):
+            if not isinstance(part, bytearray):
+                part = part.result()
+                if part is None:
+                    # Fetch was invalidated or failed
+                    return False
+            base = u * UNIT
+            lo = max(offset, base) - base
+            hi = min(offset + len(view), base + UNIT) - base
+            view[pos : pos + hi - lo] = part[lo:hi]
+            pos += hi - lo
+
+        with self._lock:
+            self.stats["hits"] += 1
+            # Units the reader has moved past will not be asked for again
+            for u in range(first, last + 1):
+                if (u + 1) * UNIT <= offset + len(view):
+                    self.units.pop(u, None)
+                    self.used.discard(u)
+                else:
+                    self.used.add(u)
+        return True
+
+    def has(self, offset, length):
+        """True if every unit of the range is buffered or being fetched."""
+        with self._lock:
+            return all(u in self.units for u in range(offset // UNIT, (offset + length - 1) // UNIT + 1))
+
+    def observe(self, offset, length, hit):
+        """Updates stream detection after a read and schedules prefetches ahead of it."""
+        end = offset + length
+        with self._lock:
+            stream = self.streams.pop(offset, None)
+            if stream is None:
+                stream = Stream(end)
+            else:
+                if not hit:
+                    self.stats["misses"] += 1
+                stream.window = min(stream.window * 2, self.max_window)
+                stream.next_offset = end
+                self._issue(stream)
+
+            self.streams[end] = stream
+            while len(self.streams) > MAX_STREAMS:
+                self.streams.popitem(last=False)
+
+    def _issue(self, stream):
+        """
+        Schedules missing units in [next_offset, next_offset + window), which also
+        refetches units a write invalidated. Called with _lock held.
+        """
+        target = min(stream.next_offset + stream.window, self.total_size)
+        u = stream.next_offset // UNIT
+        while u * UNIT < target:
+            if u not in self.units:
+                self._evict()
+                token = self._inflight[u] = object()
+                self.units[u] = self._pool.submit(self._fetch_unit, u, token)
+                self.stats["prefetched"] += 1
+            u += 1
+
+    def _fetch_unit(self, u, token):
+        base = u * UNIT
+        buf = bytearray(min(UNIT, self.total_size - base))
+        try:
+            self.fetch(memoryview(buf), base)
+        except Exception:
+            buf = None
+        with self._lock:
+            if self._inflight.get(u) is not token:
+                # Evicted, or a write landed while we were reading
+                return None
+            del self._inflight[u]
+            if buf is None:
+                self.units.pop(u, None)
+            else:
+                self.units[u] = buf
+        return buf
+
+    def _drop(self, u):
+        """Removes a unit (ready or in flight). Called with _lock held."""
+        self.units.pop(u, None)
+        self._inflight.pop(u, None)
+        if u not in self.used:
+            self.stats["wasted"] += 1
+        self.used.discard(u)
+
+    def _evict(self):
+        while len(self.units) >= self.max_units:
+            self._drop(next(iter(self.units)))
+
+    def invalidate(self, offset, length):
+        """Drops units overlapping a written range. Call after the write is on disk."""
+        first, last = offset // UNIT, (offset + length - 1) // UNIT
+        with self._lock:
+            for u in [u for u in self.units if first <= u <= last]:
+                self._drop(u)
+
+    def resize(self, max_bytes):
+        """Changes the buffer budget; a smaller one takes effect as units are fetched."""
+        with self._lock:
+            self.max_units = max(1, max_bytes // UNIT)
+            self.max_window = max(UNIT, min(MAX_WINDOW, self.max_units * UNIT // 4))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
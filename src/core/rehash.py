@@ -0,0 +1,134 @@
+import os
+import time
+import threading
+import collections
+from core import chunker, hasher, logger
+
+# Seconds without a request before the drive counts as idle
+DEFAULT_IDLE = 2.0
+# Hashing bandwidth cap in MB/s (0 = unlimited)
+DEFAULT_RATE_MB = 200
+# Seconds between passes over the dirty chunks
+DEFAULT_INTERVAL = 10.0
+
+log = logger.get("rehash")
+
+class Rehasher:
+    """
+    Rehashes written chunks inside the daemon while the drive is idle, doing
+    check_drive's journal-driven work ahead of time: the blocks under each
+    chunk's dirty ranges are hashed, the chunk file takes the name of its new
+    root and the ranges are cleared, so umount only has to check what was
+    written since the last pass.
+
+    Hashing runs without the chunk lock; VirtualDisk.rename_hashed commits it
+    only if the journal saw no write to the chunk meanwhile. A write after that
+    check marks the chunk dirty again for the next pass or for check_drive.
+    """
+    def __init__(self, vdisk, db, idle_for, idle=DEFAULT_IDLE, rate_mb=DEFAULT_RATE_MB, interval=DEFAULT_INTERVAL):
+        self.vdisk = vdisk
+        self.db = db
+        # Callable returning seconds since the last request (Metrics.idle_for)
+        self.idle_for = idle_for
+        self.idle = idle
+        self.rate = rate_mb * 1024 * 1024
+        self.interval = interval
+
+        meta = db.get_all_meta()
+        self.algo = meta.get("hash_algo") or hasher.DEFAULT_ALGO
+        self.chunk_size = int(meta["chunk_size_mb"]) * 1024 * 1024
+        self.block_size = int(meta["block_size_mb"]) * 1024 * 1024
+        self.padding = chunker.get_padding(int(meta["total_chunks"]))
+        self.zero_leaf = chunker.get_zero_hash(self.block_size, self.algo)
+
+        self.stats = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="rehash")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _busy(self):
+        return self.idle_for() < self.idle
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._busy():
+                continue
+            try:
+                self.run_pass()
+            except Exception as e:
+                log.exception(f"Rehash pass failed: {e}")
+
+    def run_pass(self):
+        """Rehashes every dirty chunk, stopping early if requests come in."""
+        self.vdisk.journal.flush()
+        for chunk_idx in sorted(self.db.get_dirty()):
+            if self._stop.is_set() or self._busy():
+                return
+            self._rehash(chunk_idx)
+        self.stats["passes"] += 1
+
+    def _wait_idle(self):
+        """Pauses while the drive serves requests. False once stopping."""
+        while self._busy():
+            if self._stop.wait(self.idle):
+                return False
+        return not self._stop.is_set()
+
+    def _rehash(self, chunk_idx):
+        settled = self.vdisk.settle(chunk_idx)
+        if settled is None:
+            return
+        filename, version = settled
+        # Ranges written up to the version above are now in the DB
+        self.vdisk.journal.flush()
+        blocks = set()
+        for start, end in self.db.get_dirty().get(chunk_idx, ()):
+            blocks.update(chunker.get_block_range(start, end, self.block_size))
+
+        path = os.path.join(self.vdisk.root, filename)
+        new_leaves = {}
+        try:
+            for bi in sorted(blocks):
+                if not self._wait_idle():
+                    return
+                started = time.monotonic()
+                leaves, hashed = hasher.hash_blocks(path, self.block_size, [bi], self.algo)
+                new_leaves.update(leaves)
+                self.stats["bytes"] += hashed
+                if self.rate:
+                    # Keep to the bandwidth cap, so the pass stays in the background
+                    self._stop.wait(max(0.0, hashed / self.rate - (time.monotonic() - started)))
+        except FileNotFoundError:
+            # Replaced under us (copy on write); the write that did it raced us anyway
+            self.stats["raced"] += 1
+            return
+
+        c = self.db.get_chunk(chunk_idx)
+        leaves = self.db.get_block_hashes(chunk_idx)
+        leaves.update(new_leaves)
+        new_h = chunker.get_root(leaves, self.chunk_size, self.block_size, self.algo)
+        new_name = filename
+        if new_h != c['hash']:
+            new_name = chunker.format_name(self.vdisk.name, chunk_idx, new_h, self.padding)
+
+        def record(name):
+            st = os.stat(os.path.join(self.vdisk.root, name))
+            with self.db.transaction():
+                self.db.update_block_hashes(chunk_idx, new_leaves, self.zero_leaf)
+                self.db.update_chunk(chunk_idx, new_h, name, st.st_size, st.st_mtime)
+                self.db.clear_dirty([chunk_idx])
+
+        if self.vdisk.rename_hashed(chunk_idx, version, new_name, record):
+            self.stats["chunks"] += 1
+            if new_name != filename:
+                log.info(f"Rehashed chunk {chunk_idx}: {new_name}")
+        else:
+            self.stats["raced"] += 1
@@ -0,0 +1,104 @@
+import os
+import uuid
+import shutil
+import asyncio
+from config_loader import resolve_path
+
+class Backend:
+    """
+    Remote object store for chunk files. Objects are immutable and keyed by chunk
+    filename, which carries the content hash, so a changed chunk is a new object.
+    Large objects go up as numbered parts that complete() assembles; an unfinished
+    upload can be resumed from the parts list_parts() reports.
+    """
+    async def exists(self, key):
+        raise NotImplementedError
+
+    async def read_range(self, key, offset, length):
+        """Returns `length` bytes of an object from `offset` (fewer at its end)."""
+        raise NotImplementedError
+
+    async def create_upload(self, key):
+        """Starts a multipart upload. Returns its upload id."""
+        raise NotImplementedError
+
+    async def upload_part(self, upload_id, part_no, data):
+        raise NotImplementedError
+
+    async def list_parts(self, upload_id):
+        """Returns {part_no: size} stored so far, or None if the upload is unknown."""
+        raise NotImplementedError
+
+    async def complete(self, key, upload_id, part_count):
+        raise NotImplementedError
+
+    async def abort(self, upload_id):
+        raise NotImplementedError
+
+class DirectoryBackend(Backend):
+    """
+    Local stand-in for the remote store: objects are files in a directory, parts
+    are staged under .uploads/<upload_id>/. File I/O runs in worker threads so the
+    event loop keeps driving the other transfers.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.staging = os.path.join(root, ".uploads")
+        os.makedirs(self.staging, exist_ok=True)
+
+    def _part_path(self, upload_id, part_no):
+        return os.path.join(self.staging, upload_id, f"{part_no:06d}")
+
+    async def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+
+    async def read_range(self, key, offset, length):
+        def read():
+            with open(os.path.join(self.root, key), "rb", buffering=0) as f:
+                return os.pread(f.fileno(), length, offset)
+        return await asyncio.to_thread(read)
+
+    async def create_upload(self, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.staging, upload_id))
+        return upload_id
+
+    async def upload_part(self, upload_id, part_no, data):
+        path = self._part_path(upload_id, part_no)
+
+        def write():
+            # Write then rename, so a half-written part never counts as stored
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.rename(f"{path}.tmp", path)
+        await asyncio.to_thread(write)
+
+    async def list_parts(self, upload_id):
+        folder = os.path.join(self.staging, upload_id)
+        if not os.path.isdir(folder):
+            return None
+        return {int(f): os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder) if f.isdigit()}
+
+    async def complete(self, key, upload_id, part_count):
+        dst = os.path.join(self.root, key)
+
+        def assemble():
+            with open(f"{dst}.tmp", "wb") as out:
+                for part_no in range(part_count):
+                    with open(self._part_path(upload_id, part_no), "rb") as f:
+                        shutil.copyfileobj(f, out, 1024 * 1024)
+            os.rename(f"{dst}.tmp", dst)
+            shutil.rmtree(os.path.join(self.staging, upload_id))
+        await asyncio.to_thread(assemble)
+
+    async def abort(self, upload_id):
+        await asyncio.to_thread(shutil.rmtree, os.path.join(self.staging, upload_id), True)
+
+BACKENDS = {"dir": lambda opts: DirectoryBackend(resolve_path(opts["path"]))}
+
+def get_backend(opts):
+    """Builds the backend named by the [remote] config section."""
+    kind = opts.get("backend", "dir")
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown remote backend: {kind}")
+    return BACKENDS[kind](opts)
@@ -0,0 +1,152 @@
+import os
+import re
+import time
+import errno
+import fcntl
+import shutil
+from core import compress
+from core.database import DBManager
+
+# Snapshot folders, one per snapshot, inside the drive folder
+SNAPSHOT_DIR = ".snapshots"
+# linux/fs.h: share all extents of the source file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+def validate_name(name):
+    if not NAME_PATTERN.match(name or ""):
+        raise ValueError(f"Invalid snapshot name '{name}' (letters, digits, '.', '_' and '-' only)")
+
+def get_snapshot_path(drive_path, name):
+    return os.path.join(drive_path, SNAPSHOT_DIR, name)
+
+def instance_name(drive_name, snap):
+    """Name a mounted snapshot goes by (pid file, mount point): drive@snapshot."""
+    return f"{drive_name}@{snap}"
+
+def split_name(name):
+    """Inverse of instance_name: (drive, snapshot), snapshot None for the drive itself."""
+    drive, _, snap = name.partition("@")
+    return drive, snap or None
+
+def clone_file(src, dst):
+    """
+    Makes dst a second copy of src that costs no data: a reflink where the
+    filesystem supports it, else a hard link (which VirtualDisk copies on write).
+    Returns True for a reflink.
+    """
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            st = os.fstat(f_in.fileno())
+            # Keep the mtime check_drive compares against
+            os.utime(f_out.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                raise
+    os.remove(dst)
+    os.link(src, dst)
+    return False
+
+def local_files(drive_path, db):
+    """{chunk_index: filename} of a stopped drive, in whichever form each chunk is stored."""
+    files = {}
+    for c in db.get_chunks():
+        path = compress.resolve(drive_path, c['filename'])
+        if not os.path.exists(path):
+            raise IOError(f"Chunk {c['chunk_index']} is not on local disk.")
+        files[c['chunk_index']] = os.path.basename(path)
+    return files
+
+def take(drive_path, db, name, files):
+    """
+    Records a snapshot of the given chunk files: each is reflinked or hard linked
+    into the snapshot folder, and its row as of the last check is copied, so the
+    cost is metadata only. Returns the indices that were hard linked.
+    """
+    validate_name(name)
+    if name in db.get_snapshots():
+        raise ValueError(f"Snapshot '{name}' already exists.")
+    rows = {c['chunk_index']: c for c in db.get_chunks()}
+    final = get_snapshot_path(drive_path, name)
+    tmp = f"{final}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    linked = set()
+    out = []
+    try:
+        for idx, filename in sorted(files.items()):
+            if not clone_file(os.path.join(drive_path, filename), os.path.join(tmp, filename)):
+                linked.add(idx)
+            c = rows.get(idx, {})
+            out.append((idx, c.get('hash'), filename, c.get('size'), c.get('mtime')))
+        with db.transaction():
+            db.add_snapshot(name, time.time(), out)
+            os.rename(tmp, final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return linked
+
+def take_live(vdisk, db, name):
+    """Snapshot of a served drive, taken behind a flush barrier (control request handler)."""
+    with vdisk.frozen():
+        missing = [i for i in range(vdisk.total_chunks) if i not in vdisk.chunk_map]
+        if missing:
+            raise IOError(f"Chunk {missing[0]} is not on local disk ({len(missing)} chunks are remote only).")
+        linked = take(vdisk.root, db, name, dict(vdisk.chunk_map))
+        # Shared with the snapshot now: the next write to these has to copy
+        vdisk.owned -= linked
+    return {"chunks": vdisk.total_chunks, "linked": len(linked)}
+
+def delete(drive_path, db, name):
+    """Drops a snapshot. Chunk data still used by the drive or by clones stays."""
+    with db.transaction():
+        db.drop_snapshot(name)
+        shutil.rmtree(get_snapshot_path(drive_path, name), ignore_errors=True)
+
+def clone(src_path, src_name, snap, dst_path, dst_name):
+    """
+    Creates drive dst_name from a snapshot of src_name, sharing its chunk files.
+    The new drive starts with an untrusted journal, so its first check compares
+    every chunk's size and mtime and rehashes those that changed after the
+    snapshot's rows were recorded. Returns the number of chunks.
+    """
+    src_db = DBManager(src_path, src_name)
+    rows = src_db.get_snapshot_chunks(snap)
+    if not rows:
+        raise ValueError(f"Snapshot '{snap}' of '{src_name}' not found.")
+    meta = src_db.get_all_meta()
+    meta.pop("journal_clean", None)
+    current = {c['chunk_index']: c['hash'] for c in src_db.get_chunks()}
+    leaves = {}
+    for chunk_idx, block_idx, h in src_db.get_all_block_hashes():
+        leaves.setdefault(chunk_idx, {})[block_idx] = h
+
+    snap_path = get_snapshot_path(src_path, snap)
+    os.makedirs(dst_path)
+    try:
+        db = DBManager(dst_path, dst_name)
+        with db.transaction():
+            db.initialize(dict(meta, origin=instance_name(src_name, snap)))
+            db.open_journal()
+            chunks = []
+            for r in rows:
+                filename = dst_name + r['filename'][len(src_name):]
+                clone_file(os.path.join(snap_path, r['filename']), os.path.join(dst_path, filename))
+                mtime = r['mtime']
+                if current.get(r['chunk_index']) == r['hash']:
+                    # Same root as the drive has now, so the same leaves
+                    db.update_block_hashes(r['chunk_index'], leaves.get(r['chunk_index'], {}), None)
+                else:
+                    # Leaves are gone with the old version: rehash all of it
+                    mtime = None
+                chunks.append((r['chunk_index'], r['hash'], filename, r['size'], mtime))
+            db.update_chunks(chunks)
+    except BaseException:
+        shutil.rmtree(dst_path, ignore_errors=True)
+        raise
+    return len(rows)
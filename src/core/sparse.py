@@ -0,0 +1,97 @@
+import os
+import ctypes
+import ctypes.util
+import errno
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+# Shared read-only zero page run, sliced instead of allocating b'\x00' * n
+ZERO_BLOCK_SIZE = 1024 * 1024
+ZEROES = memoryview(bytes(ZERO_BLOCK_SIZE))
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+def _fallocate(fd, mode, offset, length):
+    if _libc.fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def write_zeroes(fd, offset, length):
+    """Fallback for filesystems without fallocate modes: writes from the shared buffer."""
+    while length > 0:
+        n = os.pwrite(fd, ZEROES[:min(length, ZERO_BLOCK_SIZE)], offset)
+        offset += n
+        length -= n
+
+def punch_hole(fd, offset, length):
+    """Deallocates a byte range, keeping file size. Reads of the range return zeroes."""
+    try:
+        _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+        write_zeroes(fd, offset, length)
+
+def zero_range(fd, offset, length):
+    """Zeroes a byte range while keeping it allocated (no payload is written)."""
+    try:
+        _fallocate(fd, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE, offset, length)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+        write_zeroes(fd, offset, length)
+
+def copy_sparse(src_fd, dst_fd, size):
+    """
+    Copies a file's data extents with copy_file_range (in the kernel, and
+    reflinked where supported), leaving holes as holes in the copy.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(src_fd, offset, os.SEEK_DATA)
+            end = min(os.lseek(src_fd, start, os.SEEK_HOLE), size)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break  # Only holes from here to the end
+            if e.errno != errno.EINVAL:
+                raise
+            start, end = offset, size  # No SEEK_DATA support: copy everything
+        while start < end:
+            n = os.copy_file_range(src_fd, dst_fd, end - start, start, start)
+            if not n: break
+            start += n
+        offset = end
+    os.ftruncate(dst_fd, size)
+
+def extents(fd, offset, end):
+    """
+    Allocation of the file range offset..end as (length, hole) runs, found with
+    SEEK_DATA/SEEK_HOLE. Past the end of the file is a hole; on filesystems
+    without SEEK_DATA everything up to it counts as data.
+    """
+    runs = []
+    pos, limit = offset, min(end, os.fstat(fd).st_size)
+    while pos < limit:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+            if start >= limit:
+                break
+            stop = min(os.lseek(fd, start, os.SEEK_HOLE), limit)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break  # Only holes from here to the end
+            if e.errno != errno.EINVAL:
+                raise
+            start, stop = pos, limit
+        if start > pos:
+            runs.append((start - pos, True))
+        runs.append((stop - start, False))
+        pos = stop
+    if pos < end:
+        runs.append((end - pos, True))
+    return runs
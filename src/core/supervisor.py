@@ -0,0 +1,228 @@
+import os
+import time
+import signal
+import threading
+import collections
+from core import nbd_server, control, logger
+from core.buffers import BufferPool
+from utils import shell
+
+# Global budgets, split evenly across the attached drives
+DEFAULT_WORKERS = 32
+DEFAULT_MAX_OPEN_FILES = 1024
+DEFAULT_CACHE_MB = 256
+# However many drives are attached, none gets fewer handles than this
+MIN_OPEN_FILES = 8
+
+log = logger.get("supervisor")
+
+def get_socket(storage_root):
+    return os.path.join(storage_root, ".tgfs-supervisor.sock")
+
+def get_state_file(storage_root):
+    return os.path.join(storage_root, ".tgfs-supervisor.state")
+
+class FairExecutor:
+    """
+    Worker threads shared by every drive of the supervisor. Each drive has its
+    own queue and workers take from the queues round-robin, so a drive with a
+    deep queue cannot starve the others.
+    """
+    def __init__(self, workers):
+        # key -> deque of (fn, args); order is the round-robin turn
+        self.queues = collections.OrderedDict()
+        self.active = collections.Counter()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True, name=f"nbd-io-{i}") for i in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key, fn, *args):
+        with self._cond:
+            self.queues.setdefault(key, collections.deque()).append((fn, args))
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self.queues and not self._closed:
+                    self._cond.wait()
+                if not self.queues:
+                    return
+                key, queue = next(iter(self.queues.items()))
+                fn, args = queue.popleft()
+                if queue:
+                    # Next turn goes to the drive after this one
+                    self.queues.move_to_end(key)
+                else:
+                    del self.queues[key]
+                self.active[key] += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                log.exception(f"Request failed: {e}")
+            finally:
+                with self._cond:
+                    self.active[key] -= 1
+                    if not self.active[key]:
+                        del self.active[key]
+                    self._cond.notify_all()
+
+    def drain(self, key):
+        """Waits until every request submitted under key has run."""
+        with self._cond:
+            while key in self.queues or self.active[key]:
+                self._cond.wait()
+
+    def bind(self, key):
+        """The executor as one drive sees it: submit() and shutdown() like ThreadPoolExecutor."""
+        return _Bound(self, key)
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+class _Bound:
+    def __init__(self, executor, key):
+        self.executor = executor
+        self.key = key
+
+    def submit(self, fn, *args):
+        self.executor.submit(self.key, fn, *args)
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.executor.drain(self.key)
+
+class Supervisor:
+    """
+    One process serving many drives. Each attached drive gets its own NBDServer
+    (own device, dispatchers and control socket) running in a thread, while the
+    I/O workers, request buffers, file handle budget and cache memory budget are
+    shared: budgets are re-split evenly whenever a drive comes or goes.
+    """
+    def __init__(self, storage_root, workers=DEFAULT_WORKERS, max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 cache_mb=DEFAULT_CACHE_MB):
+        self.storage_root = storage_root
+        self.max_open_files = max_open_files
+        self.cache_bytes = cache_mb * 1024 * 1024
+        self.executor = FairExecutor(workers)
+        self.buffers = BufferPool()
+        # instance name -> (server, thread, requested cache bytes, requested read-ahead bytes)
+        self.drives = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def attach(self, path, name, chunk_mb, total_chunks, device, connections=nbd_server.DEFAULT_CONNECTIONS,
+               cache_mb=0, readahead_mb=0, tier_mb=0, snapshot_name=None):
+        """Starts serving a drive on a device. Returns the instance name once the device is live."""
+        server = nbd_server.open_server(path, name, chunk_mb, total_chunks, device, cache_mb, readahead_mb,
+                                        connections, tier_mb, snapshot_name,
+                                        executor=self.executor, buffers=self.buffers)
+        instance = server.name
+        with self._lock:
+            self._prune()
+            if instance in self.drives:
+                server.vdisk.close()
+                raise ValueError(f"{instance} is already attached.")
+            ready = threading.Event()
+            thread = threading.Thread(target=server.start, args=(ready.set,), name=f"serve-{instance}")
+            self.drives[instance] = (server, thread, cache_mb * 1024 * 1024, readahead_mb * 1024 * 1024)
+            self._rebalance()
+        thread.start()
+        # The server thread ends early if it cannot set up the device
+        deadline = time.monotonic() + nbd_server.READY_TIMEOUT
+        while not ready.wait(0.05) and thread.is_alive() and time.monotonic() < deadline:
+            pass
+        if not ready.is_set():
+            self.detach(instance, timeout=nbd_server.READY_TIMEOUT)
+            raise IOError(f"{instance} did not come up on {device}.")
+        log.info(f"Attached {instance} on {device}")
+        return instance
+
+    def detach(self, name, timeout=None):
+        """Disconnects a drive's device and waits until its disk is closed."""
+        with self._lock:
+            entry = self.drives.get(name)
+        if entry is None:
+            raise ValueError(f"{name} is not attached.")
+        server, thread = entry[0], entry[1]
+        # Ends NBD_DO_IT; the server then drains its requests and closes the disk
+        shell.run(["nbd-client", "-d", server.device_path], check=False)
+        thread.join(timeout)
+        if thread.is_alive():
+            raise IOError(f"{name} is still shutting down.")
+        with self._lock:
+            self.drives.pop(name, None)
+            self._rebalance()
+        log.info(f"Detached {name}")
+        return name
+
+    def list(self):
+        with self._lock:
+            self._prune()
+            return {
+                name: {"device": server.device_path, "inflight": server.metrics.inflight,
+                       "open_files": server.vdisk.max_open_files}
+                for name, (server, _, _, _) in self.drives.items()
+            }
+
+    def stop(self, force=False):
+        with self._lock:
+            if self.drives and not force:
+                raise ValueError(f"{len(self.drives)} drives are still attached.")
+        self._stop.set()
+        return True
+
+    def _prune(self):
+        """Forgets drives whose server ended on its own (device disconnected elsewhere)."""
+        for name in [n for n, e in self.drives.items() if not e[1].is_alive() and e[1].ident]:
+            del self.drives[name]
+
+    def _rebalance(self):
+        """Splits the global budgets evenly; called with _lock held."""
+        if not self.drives:
+            return
+        files = max(MIN_OPEN_FILES, self.max_open_files // len(self.drives))
+        share = self.cache_bytes // len(self.drives)
+        for server, _, cache_bytes, readahead_bytes in self.drives.values():
+            # Write-back first, read-ahead gets what is left of the share
+            wb = min(cache_bytes, share)
+            server.vdisk.resize(files, wb, min(readahead_bytes, share - wb))
+
+    def run(self):
+        ctl = control.ControlServer(get_socket(self.storage_root), {
+            "attach": self.attach, "detach": self.detach, "list": self.list, "stop": self.stop,
+        })
+        ctl.start()
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        log.info("Supervisor started")
+        try:
+            # wait() with a timeout keeps the main thread responsive to signals
+            while not self._stop.wait(1):
+                pass
+        finally:
+            ctl.stop()
+            for name in list(self.drives):
+                try:
+                    self.detach(name, timeout=30)
+                except Exception as e:
+                    log.error(f"Detach of {name} failed: {e}")
+            self.executor.shutdown()
+            log.info("Supervisor stopped")
+
+def run_supervisor(storage_root, conf):
+    log_conf = conf.get('log', {})
+    logger.setup(log_conf.get('file', logger.DEFAULT_FILE), log_conf.get('level', logger.DEFAULT_LEVEL))
+    serve = conf.get('serve', {})
+    Supervisor(
+        storage_root, serve.get('workers', DEFAULT_WORKERS),
+        serve.get('max_open_files', DEFAULT_MAX_OPEN_FILES), serve.get('cache_mb', DEFAULT_CACHE_MB)
+    ).run()
+    logger.shutdown()
@@ -0,0 +1,271 @@
+import os
+import asyncio
+import threading
+import collections
+import contextlib
+from core import compress
+from core.io import VirtualDisk
+from core.database import DBManager
+
+# Clean chunks fetched from the remote live here, sparse, one file per chunk
+TIER_DIR = ".tier"
+# Granularity of on-demand fetches within a chunk
+FETCH_UNIT = 4 * 1024 * 1024
+FETCH_RETRIES = 3
+
+def restore(drive_path, db):
+    """
+    Moves every complete tier file of a stopped drive back into the drive
+    folder, so plain VirtualDisks and the offline commands (check, snapshot,
+    export, delta) find it where they look. Partly fetched files stay: the
+    remote copy is the chunk. Returns the number of chunks moved.
+    """
+    tier_dir = os.path.join(drive_path, TIER_DIR)
+    if not os.path.isdir(tier_dir):
+        return 0
+    rows = {c['chunk_index']: c for c in db.get_chunks()}
+    moved = 0
+    for idx, units in db.get_tier_units().items():
+        row = rows.get(idx)
+        src = os.path.join(tier_dir, row['filename']) if row else None
+        if not src or not os.path.exists(src):
+            db.clear_tier_units(idx)
+            continue
+        size = os.stat(src).st_size
+        if not units.issuperset(range(-(-size // FETCH_UNIT))):
+            continue
+        # A fetched file is the pushed version: give it the row's mtime, so
+        # check and the next tiered mount see it unchanged
+        os.utime(src, (row['mtime'], row['mtime']))
+        os.rename(src, os.path.join(drive_path, row['filename']))
+        db.clear_tier_units(idx)
+        moved += 1
+    return moved
+
+class TieredDisk(VirtualDisk):
+    """
+    VirtualDisk whose clean chunks may live only on the remote backend.
+    A read of a chunk that is not local fetches just the units it touches into
+    a sparse file under .tier/; requests for other ranges keep going meanwhile,
+    and requests for a unit already being fetched wait on that same fetch.
+    Tier files are kept within a byte budget by evicting the least recently used.
+    The first write to a chunk pulls the rest of it and moves the file into the
+    drive folder, where it is an ordinary local chunk again (check and push see
+    complete files). Chunks that were pushed and left untouched are handed back
+    to the tier at mount time, so they become evictable; close() returns the
+    complete ones to the drive folder (see restore).
+    """
+    def __init__(self, drive_path, drive_name, chunk_size_mb, total_chunks, backend, tier_mb,
+                 read_only=False, **kwargs):
+        self.backend = backend
+        self.tier_budget = tier_mb * 1024 * 1024
+        self.db = kwargs.setdefault("db", DBManager(drive_path, drive_name))
+        self.tier_dir = os.path.join(drive_path, TIER_DIR)
+        os.makedirs(self.tier_dir, exist_ok=True)
+
+        # Object key (the chunk filename) of every chunk, from the DB
+        self.keys = {c['chunk_index']: c['filename'] for c in self.db.get_chunks()}
+        # chunk_idx -> fetched units; order is recency of use, for eviction
+        self.units = collections.OrderedDict()
+        self.tier_stats = collections.Counter()
+        # (chunk_idx, unit) -> concurrent Future of the fetch covering it
+        self._inflight = {}
+        # Readers between fetching a range and pinning its handle; not evictable
+        self._leases = collections.Counter()
+        # Guards units, _inflight and _leases; taken before _table_lock, never after
+        self._tier_lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True, name="tier-fetch")
+        self._loop_thread.start()
+
+        super().__init__(drive_path, drive_name, chunk_size_mb, total_chunks, read_only=read_only, **kwargs)
+        self.unit_count = -(-self.chunk_size // FETCH_UNIT)
+
+    def _scan_chunks(self):
+        super()._scan_chunks()
+        # The DB lists every chunk; only those whose file is in the drive folder are local
+        present = set(os.listdir(self.root))
+        for idx in [i for i, f in self.chunk_map.items() if f not in present]:
+            del self.chunk_map[idx]
+        for idx, units in sorted(self.db.get_tier_units().items()):
+            if os.path.exists(self._tier_path(idx)):
+                self.units[idx] = units
+            else:
+                self.db.clear_tier_units(idx)
+
+        # Pushed and unchanged since: the remote has a copy, so the tier can own it
+        uploads = self.db.get_uploads()
+        for idx, filename in list(self.chunk_map.items()):
+            up = uploads.get(idx)
+            if not up or not up['done'] or up['key'] != filename or compress.is_packed(filename):
+                continue
+            st = os.stat(os.path.join(self.root, filename))
+            if (st.st_size, st.st_mtime) != (up['size'], up['mtime']):
+                continue
+            os.rename(os.path.join(self.root, filename), self._tier_path(idx))
+            units = set(range(-(-st.st_size // FETCH_UNIT)))
+            self.db.add_tier_units(idx, units)
+            self.units[idx] = units
+            del self.chunk_map[idx]
+
+    def _tier_path(self, chunk_idx):
+        return os.path.join(self.tier_dir, self.keys[chunk_idx])
+
+    def _chunk_path(self, chunk_idx):
+        if chunk_idx in self.chunk_map:
+            return self.chunk_map[chunk_idx]
+        return os.path.relpath(self._tier_path(chunk_idx), self.root)
+
+    def _writable(self, chunk_idx):
+        # Tier files are written only by fetches; a write promotes the chunk first
+        return chunk_idx in self.chunk_map and super()._writable(chunk_idx)
+
+    @contextlib.contextmanager
+    def _resident(self, chunk_idx, chunk_offset, length):
+        with self._tier_lock:
+            self._leases[chunk_idx] += 1
+        try:
+            if chunk_idx not in self.chunk_map:
+                first = chunk_offset // FETCH_UNIT
+                last = (chunk_offset + max(length, 1) - 1) // FETCH_UNIT
+                self._fetch(chunk_idx, range(first, last + 1))
+            yield
+        finally:
+            with self._tier_lock:
+                self._leases[chunk_idx] -= 1
+                if not self._leases[chunk_idx]:
+                    del self._leases[chunk_idx]
+        self._evict()
+
+    def _fetch(self, chunk_idx, units):
+        """Blocks until the given units of a tier chunk are on local disk."""
+        waits = []
+        with self._tier_lock:
+            present = self.units.setdefault(chunk_idx, set())
+            self.units.move_to_end(chunk_idx)
+            run = []
+            for u in list(units) + [None]:
+                fut = None if u is None else self._inflight.get((chunk_idx, u))
+                if u is not None and u not in present and fut is None:
+                    run.append(u)
+                    continue
+                # Contiguous missing units go out as one ranged request
+                if run:
+                    new = asyncio.run_coroutine_threadsafe(self._fetch_run(chunk_idx, run), self._loop)
+                    for r in run:
+                        self._inflight[(chunk_idx, r)] = new
+                    waits.append(new)
+                    run = []
+                if fut is not None:
+                    waits.append(fut)
+            if waits:
+                self.tier_stats["misses"] += 1
+            else:
+                self.tier_stats["hits"] += 1
+        for fut in waits:
+            fut.result()
+
+    async def _fetch_run(self, chunk_idx, run):
+        key = self.keys[chunk_idx]
+        if compress.is_packed(key):
+            raise IOError(f"Chunk {chunk_idx} is stored packed and cannot be read by range")
+        offset = run[0] * FETCH_UNIT
+        length = min(len(run) * FETCH_UNIT, self.chunk_size - offset)
+        try:
+            for attempt in range(FETCH_RETRIES):
+                try:
+                    data = await self.backend.read_range(key, offset, length)
+                    break
+                except Exception:
+                    if attempt == FETCH_RETRIES - 1:
+                        raise
+                    await asyncio.sleep(0.2 * 2 ** attempt)
+            await asyncio.to_thread(self._store, chunk_idx, offset, data, run)
+        finally:
+            with self._tier_lock:
+                for u in run:
+                    self._inflight.pop((chunk_idx, u), None)
+
+    def _store(self, chunk_idx, offset, data, run):
+        fd = os.open(self._tier_path(chunk_idx), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.chunk_size:
+                os.ftruncate(fd, self.chunk_size)
+            view = memoryview(data)
+            done = 0
+            while done < len(view):
+                done += os.pwrite(fd, view[done:], offset + done)
+        finally:
+            os.close(fd)
+        self.db.add_tier_units(chunk_idx, run)
+        with self._tier_lock:
+            self.units.setdefault(chunk_idx, set()).update(run)
+            self.tier_stats["fetched_bytes"] += len(data)
+
+    def _evict(self):
+        """Drops least recently used tier chunks until the budget holds."""
+        with self._tier_lock:
+            used = sum(len(u) for u in self.units.values()) * FETCH_UNIT
+            for idx in list(self.units):
+                if used <= self.tier_budget:
+                    break
+                if self._leases[idx] or any(k[0] == idx for k in self._inflight):
+                    continue
+                used -= len(self.units.pop(idx)) * FETCH_UNIT
+                with self._table_lock:
+                    old = self.open_files.pop(idx, None)
+                    if old:
+                        self._retire(old)
+                # Unlinked under the lock, so a refetch cannot race the removal
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._tier_path(idx))
+                self.db.clear_tier_units(idx)
+                self.tier_stats["evictions"] += 1
+
+    def _extents(self, chunk_idx, chunk_offset, length):
+        # A tier file only shows which units were fetched; the remote copy is all data
+        if chunk_idx not in self.chunk_map and chunk_idx in self.keys:
+            return [(length, False)]
+        return super()._extents(chunk_idx, chunk_offset, length)
+
+    def _before_write(self, chunk_idx):
+        if chunk_idx not in self.chunk_map:
+            self._promote(chunk_idx)
+        super()._before_write(chunk_idx)
+
+    def _promote(self, chunk_idx):
+        """Makes a tier chunk fully local and moves it into the drive folder."""
+        with self._tier_lock:
+            self._leases[chunk_idx] += 1
+        try:
+            self._fetch(chunk_idx, range(self.unit_count))
+            with self._tier_lock:
+                filename = self.keys[chunk_idx]
+                os.rename(self._tier_path(chunk_idx), os.path.join(self.root, filename))
+                self._renamed(os.path.join(self.root, filename))
+                self.units.pop(chunk_idx, None)
+                with self._table_lock:
+                    self.chunk_map[chunk_idx] = filename
+                    # The cached handle is read-only
+                    old = self.open_files.pop(chunk_idx, None)
+                    if old:
+                        self._retire(old)
+            self.db.clear_tier_units(chunk_idx)
+        finally:
+            with self._tier_lock:
+                self._leases[chunk_idx] -= 1
+                if not self._leases[chunk_idx]:
+                    del self._leases[chunk_idx]
+
+    def stats_snapshot(self):
+        snap = super().stats_snapshot()
+        with self._tier_lock:
+            snap["tier"] = dict(self.tier_stats, units=sum(len(u) for u in self.units.values()))
+        return snap
+
+    def close(self):
+        super().close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        restore(self.root, self.db)
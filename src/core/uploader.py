@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import asyncio
+from core import compress, delta
+from core.database import DBManager
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_RETRIES = 5
+RETRY_BASE_DELAY = 0.5
+
+class RateLimiter:
+    """Token bucket shared by all transfers; rate is bytes per second (0 = unlimited)."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = 0.0
+        self.last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, n):
+        if not self.rate:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            # Allow at most one second of burst after an idle period
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= n
+            if self.allowance < 0:
+                # Holding the lock while we pay off the debt paces everyone else too
+                await asyncio.sleep(-self.allowance / self.rate)
+
+class UploadStats:
+    def __init__(self):
+        self.chunks = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.parts = 0
+        self.resumed_parts = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+        return self
+
+    def __str__(self):
+        mb = self.bytes / (1024 * 1024)
+        rate = mb / self.elapsed if self.elapsed else 0.0
+        return (f"{self.chunks} chunks, {mb:.0f} MB in {self.elapsed:.2f}s ({rate:.0f} MB/s), "
+                f"{self.parts} parts ({self.resumed_parts} resumed), {self.retries} retries, "
+                f"{self.skipped} up to date, {self.failed} failed")
+
+class Uploader:
+    """
+    Pushes a drive's chunk files to a remote backend. Chunks whose current file
+    (named by content hash) has not been uploaded yet are sent as parts, several
+    at a time, under one bandwidth limit. Every stored part is recorded in the
+    drive DB, so an interrupted push resumes where it stopped.
+    """
+    def __init__(self, drive_path, drive_name, backend, concurrency=DEFAULT_CONCURRENCY,
+                 part_size=DEFAULT_PART_SIZE, retries=DEFAULT_RETRIES, bandwidth=0, log=print):
+        self.root = drive_path
+        self.db = DBManager(drive_path, drive_name)
+        self.backend = backend
+        self.concurrency = max(1, concurrency)
+        self.part_size = part_size
+        self.retries = retries
+        self.limiter = RateLimiter(bandwidth)
+        self.log = log
+        self.stats = UploadStats()
+        # Bounds parts in flight across all chunks, and with it the memory in use
+        self._parts = None
+
+    def pending(self):
+        """Returns [(chunk row, path, upload row or None)] for chunks not yet on the remote."""
+        uploads = self.db.get_uploads()
+        todo = []
+        for c in self.db.get_chunks():
+            path = compress.resolve(self.root, c['filename'])
+            if not os.path.exists(path):
+                continue
+            up = uploads.get(c['chunk_index'])
+            if up and up['done'] and up['key'] == os.path.basename(path):
+                self.stats.skipped += 1
+                continue
+            todo.append((c, path, up))
+        return todo
+
+    async def run(self):
+        self._parts = asyncio.Semaphore(self.concurrency)
+        queue = asyncio.Queue()
+        for job in self.pending():
+            queue.put_nowait(job)
+
+        async def worker():
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._upload_chunk(*job)
+                except Exception as e:
+                    self.stats.failed += 1
+                    self.log(f"[!] Chunk {job[0]['chunk_index']} failed: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return self.stats.finish()
+
+    async def _retry(self, what, fn, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return await fn(*args)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                self.stats.retries += 1
+                delay = RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random())
+                self.log(f"[!] {what} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _upload_chunk(self, c, path, up):
+        idx = c['chunk_index']
+        key = os.path.basename(path)
+        st = os.stat(path)
+
+        if await self._retry(f"exists {key}", self.backend.exists, key):
+            self.db.begin_upload(idx, key, None, st.st_size, st.st_mtime)
+            self.db.finish_upload(idx, None)
+            await asyncio.to_thread(self._sign, idx, path, key)
+            self.stats.skipped += 1
+            return
+
+        # Resume only an upload of this exact file; otherwise the chunk changed
+        done_parts = {}
+        upload_id = None
+        if up and not up['done'] and up['upload_id']:
+            if up['key'] == key and up['size'] == st.st_size and up['mtime'] == st.st_mtime:
+                remote_parts = await self._retry(f"list {key}", self.backend.list_parts, up['upload_id'])
+                if remote_parts is not None:
+                    upload_id = up['upload_id']
+                    local_parts = self.db.get_parts(upload_id)
+                    # Trust a part only if both sides agree it is complete
+                    done_parts = {p: n for p, n in local_parts.items() if remote_parts.get(p) == n}
+            if upload_id is None:
+                await self._retry(f"abort {up['key']}", self.backend.abort, up['upload_id'])
+                self.db.drop_upload(idx, up['upload_id'])
+
+        if upload_id is None:
+            upload_id = await self._retry(f"start {key}", self.backend.create_upload, key)
+            self.db.begin_upload(idx, key, upload_id, st.st_size, st.st_mtime)
+
+        part_count = max(1, -(-st.st_size // self.part_size))
+        self.stats.resumed_parts += len(done_parts)
+        with open(path, "rb", buffering=0) as f:
+            # Let every part settle before the file is closed under them
+            results = await asyncio.gather(*(
+                self._upload_part(f.fileno(), key, upload_id, part_no, st.st_size)
+                for part_no in range(part_count) if part_no not in done_parts
+            ), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            # Stored parts stay recorded; the next push resumes from them
+            raise errors[0]
+
+        now = os.stat(path)
+        if (now.st_size, now.st_mtime) != (st.st_size, st.st_mtime):
+            # Written to while we read it: the object would not match its name
+            await self._retry(f"abort {key}", self.backend.abort, upload_id)
+            self.db.drop_upload(idx, upload_id)
+            raise IOError(f"{key} changed during upload")
+
+        await self._retry(f"complete {key}", self.backend.complete, key, upload_id, part_count)
+        self.db.finish_upload(idx, upload_id)
+        await asyncio.to_thread(self._sign, idx, path, key)
+        self.stats.chunks += 1
+        self.log(f"Uploaded Chunk {idx}")
+
+    def _sign(self, idx, path, key):
+        """Records the signature of the version now on the remote: the base of the chunk's next delta."""
+        size, sig = delta.signature(path)
+        self.db.set_signature(idx, key, delta.DEFAULT_BLOCK_SIZE, size, sig)
+
+    async def _upload_part(self, fd, key, upload_id, part_no, size):
+        offset = part_no * self.part_size
+        n = min(self.part_size, size - offset)
+        async with self._parts:
+            data = await asyncio.to_thread(os.pread, fd, n, offset)
+            await self.limiter.acquire(len(data))
+            await self._retry(f"part {part_no} of {key}", self.backend.upload_part, upload_id, part_no, data)
+        self.db.record_part(upload_id, part_no, len(data))
+        self.stats.parts += 1
+        self.stats.bytes += len(data)
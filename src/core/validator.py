@@ -1,10 +1,8 @@
 import os
 from config_loader import get_config
 
-conf = get_config()
-
 def get_drive_path(name: str):
-    return os.path.join(conf['paths']['storage_root'], name)
+    return os.path.join(get_config()['paths']['storage_root'], name)
 
 def exists_on_disk(name: str) -> bool:
     return os.path.exists(get_drive_path(name))
@@ -1,6 +1,7 @@
 import typer
-import sys
-from core import manager, validator, nbd_server
+# Only modules needed to build the command line are imported here; each command
+# imports what it uses, so e.g. `stats` does not load the whole daemon stack
+from core import hasher, compress
 
 app = typer.Typer(help="tgfs: Telegram File System CLI (NBD Architecture)", add_completion=False)
 
@@ -9,9 +10,13 @@ def create(
     name: str = typer.Argument(None, help="The name of the drive"),
     size_mb: int = typer.Option(None, "--size", "-s", help="Total size in MB"),
     chunk_mb: int = typer.Option(None, "--chunk", "-c", help="Chunk size in MB"),
-    fs: str = typer.Option(None, "--fs", "-f", help="Filesystem (ext4/btrfs)")
+    fs: str = typer.Option(None, "--fs", "-f", help="Filesystem (ext4/btrfs)"),
+    algo: str = typer.Option(hasher.DEFAULT_ALGO, "--hash", help=f"Chunk hash ({'/'.join(hasher.ALGORITHMS)})"),
+    layout: str = typer.Option("chunks", "--layout", help="Storage layout (chunks/cas: deduplicated blocks)"),
+    compression: str = typer.Option(None, "--compress", help=f"Pack chunks on check ({'/'.join(compress.available())})")
 ):
     """Initializes and formats a new drive using NBD."""
+    from core import manager, validator
     while True:
         if not name: name = typer.prompt("Drive Name")
         if validator.exists_on_disk(name):
@@ -23,25 +28,204 @@ def create(
     if not chunk_mb: chunk_mb = int(typer.prompt("Chunk Size (MB)", default=500))
     if not fs: fs = typer.prompt("Filesystem (ext4/btrfs)", default="btrfs")
 
-    manager.create_drive(name, size_mb, chunk_mb, fs)
+    if algo not in hasher.ALGORITHMS:
+        typer.secho(f"Error: Unknown hash '{algo}'.", fg="red")
+        raise typer.Exit(code=1)
+    if layout not in manager.LAYOUTS:
+        typer.secho(f"Error: Unknown layout '{layout}'.", fg="red")
+        raise typer.Exit(code=1)
+    if compression and (compression not in compress.available() or layout != "chunks"):
+        typer.secho(f"Error: Compression '{compression}' is not available for layout '{layout}'.", fg="red")
+        raise typer.Exit(code=1)
+
+    manager.create_drive(name, size_mb, chunk_mb, fs, algo, layout, compression)
 
 @app.command(name="mount")
-def mount_cmd(name: str = typer.Argument(None)):
+def mount_cmd(
+    name: str = typer.Argument(None),
+    connections: int = typer.Option(None, "--connections", "-j", help="NBD sockets (kernel queues) to serve in parallel"),
+    snap: str = typer.Option(None, "--snapshot", help="Mount this snapshot read-only, as <name>@<snapshot>")
+):
     """Starts the NBD daemon and mounts the filesystem."""
+    from core import manager
     if not name: name = typer.prompt("Drive Name")
-    manager.mount_drive(name)
+    manager.mount_drive(name, connections, snap)
 
 @app.command(name="umount")
 def umount_cmd(name: str = typer.Argument(None)):
     """Unmounts filesystem and stops the NBD daemon."""
+    from core import manager
     if not name: name = typer.prompt("Drive Name")
     manager.umount_drive(name)
 
+@app.command(name="serve")
+def serve_cmd(
+    name: str = typer.Argument(None),
+    listen: str = typer.Option(None, "--listen", "-l", help="host:port, or a path for a Unix socket (default from config.toml)"),
+    snap: str = typer.Option(None, "--snapshot", help="Serve this snapshot read-only, as <name>@<snapshot>")
+):
+    """Serves a drive to NBD clients (qemu, nbdcopy, nbd-client) over the network until Ctrl-C."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    manager.serve_drive(name, listen, snap)
+
 @app.command(name="check")
-def check_cmd(name: str = typer.Argument(None)):
+def check_cmd(
+    name: str = typer.Argument(None),
+    workers: int = typer.Option(hasher.DEFAULT_WORKERS, "--workers", "-w", help="Parallel hashing threads")
+):
     """Scans chunks, updates hashes in DB."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    manager.check_drive(name, workers)
+
+@app.command(name="push")
+def push_cmd(
+    name: str = typer.Argument(None),
+    concurrency: int = typer.Option(None, "--jobs", "-j", help="Parallel part transfers"),
+    bandwidth_mb: float = typer.Option(None, "--limit", help="Upload bandwidth cap in MB/s (0 = unlimited)")
+):
+    """Uploads new and changed chunks to the remote backend."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    manager.push_drive(name, concurrency, bandwidth_mb)
+
+@app.command(name="delta")
+def delta_cmd(
+    name: str = typer.Argument(None),
+    out_dir: str = typer.Argument(None, help="Existing folder to write the .delta files to"),
+    workers: int = typer.Option(hasher.DEFAULT_WORKERS, "--workers", "-w", help="Parallel delta threads"),
+    ack: bool = typer.Option(False, "--ack", help="Confirm the last deltas were applied; the next run diffs against them")
+):
+    """
+    Writes binary deltas of the chunks changed since they were last pushed or acknowledged.
+    The base only moves on with --ack, so deltas that were lost or failed to apply are simply written again.
+    """
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    if not out_dir and not ack: out_dir = typer.prompt("Output Folder")
+    manager.delta_drive(name, out_dir, workers, ack)
+
+@app.command(name="patch")
+def patch_cmd(
+    delta_dir: str = typer.Argument(..., help="Folder of .delta files"),
+    base_dir: str = typer.Argument(..., help="Folder holding the base chunk versions; rebuilt chunks go here")
+):
+    """Rebuilds changed chunks from deltas and their previous versions."""
+    from core import manager
+    manager.apply_deltas(delta_dir, base_dir)
+
+@app.command(name="import")
+def import_cmd(
+    name: str = typer.Argument(None),
+    source: str = typer.Argument(None, help="Raw image file, or - for stdin"),
+    workers: int = typer.Option(hasher.DEFAULT_WORKERS, "--workers", "-w", help="Parallel write/hash threads")
+):
+    """Replaces a drive's content with a raw image, hashing it on the way in (no check needed)."""
+    from core import manager
     if not name: name = typer.prompt("Drive Name")
-    manager.check_drive(name)
+    if not source: source = typer.prompt("Image")
+    manager.import_image(name, source, workers)
+
+@app.command(name="export")
+def export_cmd(
+    name: str = typer.Argument(None),
+    target: str = typer.Argument(None, help="Output file (written sparse), or - for stdout"),
+    workers: int = typer.Option(hasher.DEFAULT_WORKERS, "--workers", "-w", help="Parallel read threads"),
+    snap: str = typer.Option(None, "--snapshot", help="Export this snapshot instead of the current state")
+):
+    """Writes a drive as a raw image, skipping unallocated ranges."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    if not target: target = typer.prompt("Output")
+    manager.export_image(name, target, workers, snap)
+
+@app.command(name="snapshot")
+def snapshot_cmd(
+    name: str = typer.Argument(None),
+    snap: str = typer.Argument(None, help="Snapshot name"),
+    list_all: bool = typer.Option(False, "--list", "-l", help="List the drive's snapshots"),
+    delete: bool = typer.Option(False, "--delete", "-d", help="Delete the snapshot")
+):
+    """Takes an instant copy-on-write snapshot of a drive, mounted or not."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    if list_all:
+        manager.list_snapshots(name)
+        return
+    if not snap: snap = typer.prompt("Snapshot Name")
+    if delete:
+        manager.delete_snapshot(name, snap)
+    else:
+        manager.snapshot_drive(name, snap)
+
+@app.command(name="clone")
+def clone_cmd(
+    name: str = typer.Argument(None, help="Source drive"),
+    new_name: str = typer.Argument(None, help="Name of the new drive"),
+    snap: str = typer.Option(None, "--snapshot", help="Clone this snapshot instead of the current state")
+):
+    """Creates a new drive sharing the source's chunks; each side copies a chunk on first write."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    if not new_name: new_name = typer.prompt("New Drive Name")
+    manager.clone_drive(name, new_name, snap)
+
+@app.command(name="stats")
+def stats_cmd(
+    name: str = typer.Argument(None),
+    watch: float = typer.Option(None, "--watch", "-w", help="Refresh every N seconds with interval rates"),
+    as_json: bool = typer.Option(False, "--json", help="Print the raw snapshot")
+):
+    """Shows live I/O counters and latencies of a mounted drive."""
+    from core import manager
+    if not name: name = typer.prompt("Drive Name")
+    manager.show_stats(name, watch, as_json)
+
+@app.command(name="supervisor")
+def supervisor_cmd(
+    start: bool = typer.Option(False, "--start", help="Start it now instead of on the next mount"),
+    stop: bool = typer.Option(False, "--stop", help="Stop it (refused while drives are attached)"),
+    force: bool = typer.Option(False, "--force", help="With --stop: detach every drive first")
+):
+    """Shows the supervisor serving all drives, when enabled in config.toml."""
+    from core import manager
+    manager.manage_supervisor(start, stop, force)
+
+@app.command(name="bench")
+def bench_cmd(
+    size_mb: int = typer.Option(256, "--size", "-s", help="Scratch drive size in MB"),
+    chunk_mb: int = typer.Option(64, "--chunk", "-c", help="Chunk size in MB"),
+    workloads: str = typer.Option(None, "--workloads", "-w", help="Comma-separated job names (default: all)"),
+    target: str = typer.Option("all", "--target", "-t", help="direct, nbd or all"),
+    runtime: float = typer.Option(None, "--runtime", help="Seconds per job (default 3)"),
+    cache_mb: int = typer.Option(0, "--cache-mb"),
+    readahead_mb: int = typer.Option(0, "--readahead-mb"),
+    read_mode: str = typer.Option("sendfile", "--read-mode", help="NBD read path (sendfile/preadv)"),
+    directory: str = typer.Option(None, "--dir", help="Where to create the scratch drive"),
+    output: str = typer.Option(None, "--json", help="Write results to this file"),
+    baseline: str = typer.Option(None, "--compare", help="Compare against an earlier --json file")
+):
+    """Benchmarks VirtualDisk and the NBD handler in-process (no /dev/nbd or root needed)."""
+    from core import bench, nbd_server
+    targets = bench.TARGETS if target == "all" else (target,)
+    if any(t not in bench.TARGETS for t in targets) or read_mode not in nbd_server.READ_MODES:
+        typer.secho("Error: Unknown target or read mode.", fg="red")
+        raise typer.Exit(code=1)
+    try:
+        jobs = bench.get_workloads(workloads.split(",") if workloads else None)
+    except ValueError as e:
+        typer.secho(f"Error: {e}", fg="red")
+        raise typer.Exit(code=1)
+
+    doc = bench.run(size_mb, chunk_mb, jobs, targets, runtime or bench.DEFAULT_RUNTIME, cache_mb, readahead_mb, read_mode, directory,
+                    log=typer.echo)
+    if output:
+        bench.save(doc, output)
+    if baseline:
+        regressions = bench.compare(bench.load(baseline), doc, log=typer.echo)
+        if regressions:
+            raise typer.Exit(code=1)
 
 @app.command(name="internal-serve", hidden=True)
 def internal_serve(
@@ -49,13 +233,29 @@ def internal_serve(
     name: str, 
     chunk_mb: int, 
     total_chunks: int, 
-    device: str
+    device: str,
+    cache_mb: int = typer.Option(0, "--cache-mb"),
+    readahead_mb: int = typer.Option(0, "--readahead-mb"),
+    connections: int = typer.Option(1, "--connections"),
+    tier_mb: int = typer.Option(0, "--tier-mb"),
+    snap: str = typer.Option(None, "--snapshot"),
+    ready_fd: int = typer.Option(None, "--ready-fd")
 ):
     """
     Internal Entrypoint: Runs the NBD server. 
     Called via subprocess to detach from terminal.
     """
-    nbd_server.run_daemon(path, name, chunk_mb, total_chunks, device)
+    from core import nbd_server
+    nbd_server.run_daemon(path, name, chunk_mb, total_chunks, device, cache_mb, readahead_mb, connections, tier_mb, snap,
+                          ready_fd)
+
+@app.command(name="internal-supervise", hidden=True)
+def internal_supervise():
+    """Internal Entrypoint: Runs the supervisor serving many drives."""
+    from core import supervisor
+    from config_loader import get_config
+    conf = get_config()
+    supervisor.run_supervisor(conf['paths']['storage_root'], conf)
 
 if __name__ == "__main__":
     app()
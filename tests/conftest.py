@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The CLI runs with src/ on PYTHONPATH (see tgfs.sh); do the same for the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
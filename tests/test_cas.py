@@ -0,0 +1,87 @@
+import os
+import time
+from core import cas, chunker
+from core.database import DBManager
+
+CHUNK_MB = 2
+CHUNKS = 2
+BLOCK = chunker.get_block_size_mb(CHUNK_MB) * 1024 * 1024
+SIZE = CHUNKS * CHUNK_MB * 1024 * 1024
+
+def make_drive(root, name):
+    """An all-zero content-addressed drive, as create_drive lays it out."""
+    path = root / name
+    path.mkdir()
+    db = DBManager(str(path), name)
+    db.initialize({"chunk_size_mb": CHUNK_MB, "total_chunks": CHUNKS, "block_size_mb": BLOCK // (1024 * 1024),
+                   "layout": "cas"})
+    h = chunker.get_zero_root(CHUNK_MB * 1024 * 1024, BLOCK)
+    padding = chunker.get_padding(CHUNKS)
+    db.update_chunks([(i, h, chunker.format_name(name, i, h, padding), CHUNK_MB * 1024 * 1024, time.time())
+                      for i in range(CHUNKS)])
+    return str(path)
+
+def open_disk(path, name, cas_root, **kwargs):
+    return cas.CASDisk(path, name, CHUNK_MB, CHUNKS, BLOCK // (1024 * 1024), cas_root, **kwargs)
+
+def refcounts(cas_root):
+    with cas.get_refs_db(cas_root)._get_conn() as conn:
+        return dict(conn.execute("SELECT hash, refcount FROM refs").fetchall())
+
+def stored(cas_root):
+    return sorted(f for f in os.listdir(cas_root) if f.endswith(".blk") and not f.startswith("zero-"))
+
+def write(path, name, cas_root, offset, data):
+    vd = open_disk(path, name, cas_root)
+    try:
+        vd.write(offset, data)
+    finally:
+        vd.close()
+
+def test_identical_blocks_are_stored_once(tmp_path):
+    cas_root = str(tmp_path / cas.CAS_DIR)
+    a, b = make_drive(tmp_path, "a"), make_drive(tmp_path, "b")
+    data = os.urandom(BLOCK)
+    write(a, "a", cas_root, 0, data)
+    write(a, "a", cas_root, 3 * BLOCK, data)
+    write(b, "b", cas_root, BLOCK, data)
+
+    assert cas.publish(a, "a", cas_root, log=lambda *_: None) == 2
+    assert cas.publish(b, "b", cas_root, log=lambda *_: None) == 1
+    assert len(stored(cas_root)) == 1
+    assert list(refcounts(cas_root).values()) == [3]
+    # Private copies were folded into the store
+    assert not os.listdir(os.path.join(a, cas.PRIVATE_DIR))
+
+    vd = open_disk(b, "b", cas_root, read_only=True)
+    try:
+        assert bytes(vd.read(BLOCK, BLOCK)) == data
+        assert bytes(vd.read(0, BLOCK)) == bytes(BLOCK)
+    finally:
+        vd.close()
+
+def test_overwrite_releases_the_old_block(tmp_path):
+    cas_root = str(tmp_path / cas.CAS_DIR)
+    a = make_drive(tmp_path, "a")
+    old, new = os.urandom(BLOCK), os.urandom(BLOCK)
+    write(a, "a", cas_root, 0, old)
+    cas.publish(a, "a", cas_root, log=lambda *_: None)
+    old_blocks = stored(cas_root)
+
+    # Copy-on-write: the shared block keeps its data until publish
+    write(a, "a", cas_root, 0, new[:4096])
+    assert stored(cas_root) == old_blocks
+    write(a, "a", cas_root, 4096, new[4096:])
+    cas.publish(a, "a", cas_root, log=lambda *_: None)
+    assert stored(cas_root) != old_blocks and len(stored(cas_root)) == 1
+    assert list(refcounts(cas_root).values()) == [1]
+
+    # Zeroing the block drops the last reference
+    write(a, "a", cas_root, 0, bytes(BLOCK))
+    cas.publish(a, "a", cas_root, log=lambda *_: None)
+    assert stored(cas_root) == [] and refcounts(cas_root) == {}
+    vd = open_disk(a, "a", cas_root, read_only=True)
+    try:
+        assert bytes(vd.read(0, SIZE)) == bytes(SIZE)
+    finally:
+        vd.close()
@@ -0,0 +1,141 @@
+import os
+import random
+import time
+import pytest
+from core import chunker, compress
+from core.io import VirtualDisk
+
+NAME = "d"
+CHUNK_MB = 1
+CHUNKS = 2
+CHUNK = CHUNK_MB * 1024 * 1024
+SIZE = CHUNKS * CHUNK
+
+def packed_drive(path, codec="zlib"):
+    """A drive with random, repetitive and zero ranges, then packed. Returns its content."""
+    chunker.create_initial_chunks(str(path), NAME, CHUNKS, CHUNK_MB)
+    rnd = random.Random(0)
+    ref = bytearray(SIZE)
+    ref[100 : 300100] = rnd.randbytes(300000)
+    ref[CHUNK - 1000 : CHUNK + 500000] = (b"hello world " * 50000)[:501000]
+    vd = VirtualDisk(str(path), NAME, CHUNK_MB, CHUNKS)
+    try:
+        vd.write(0, ref)
+    finally:
+        vd.close()
+    compress.pack_many([os.path.join(path, f) for f in os.listdir(path)], codec)
+    return ref
+
+def files(path):
+    return sorted(os.listdir(path))
+
+@pytest.mark.parametrize("codec", compress.available())
+def test_pack_unpack_round_trip(tmp_path, codec):
+    data = random.Random(1).randbytes(200000) + bytes(compress.PACK_BLOCK * 2) + b"ab" * 100000
+    src = tmp_path / "a.img"
+    src.write_bytes(data)
+    raw_size, packed_size = compress.pack_file(str(src), str(tmp_path / "a.pack"), codec)
+    assert raw_size == len(data) and packed_size < len(data)
+
+    compress.unpack_file(str(tmp_path / "a.pack"), str(tmp_path / "b.img"))
+    assert (tmp_path / "b.img").read_bytes() == data
+    # The zero blocks stay holes
+    assert os.stat(tmp_path / "b.img").st_blocks * 512 < len(data)
+
+def test_packed_reader_random_reads_and_extents(tmp_path):
+    data = random.Random(2).randbytes(compress.PACK_BLOCK) + bytes(compress.PACK_BLOCK) + b"x" * 1000
+    (tmp_path / "a.img").write_bytes(data)
+    compress.pack_file(str(tmp_path / "a.img"), str(tmp_path / "a.pack"), "zlib")
+    reader = compress.PackedReader(str(tmp_path / "a.pack"))
+    try:
+        rnd = random.Random(3)
+        for _ in range(100):
+            offset = rnd.randrange(len(data))
+            buf = bytearray(rnd.randrange(1, 300000))
+            n = reader.read_into(memoryview(buf), offset)
+            assert n == min(len(buf), len(data) - offset)
+            assert bytes(buf[:n]) == data[offset : offset + n]
+        block = compress.PACK_BLOCK
+        assert reader.extents(0, 4 * block) == [(block, False), (block, True), (block, False), (block, True)]
+    finally:
+        reader.close()
+
+def test_packed_drive_reads(tmp_path):
+    ref = packed_drive(tmp_path)
+    assert all(compress.is_packed(f) for f in files(tmp_path))
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, read_only=True)
+    try:
+        assert vd.in_memory(0, 10)
+        assert bytes(vd.read(0, SIZE)) == ref
+        assert sum(n for n, _ in vd.extents(0, SIZE)) == SIZE
+    finally:
+        vd.close()
+
+def test_write_copies_only_the_blocks_it_touches(tmp_path, monkeypatch):
+    ref = packed_drive(tmp_path)
+    # Keep the background copy from running, to see what the write itself did
+    monkeypatch.setattr(VirtualDisk, "_unpack_loop", lambda self: None)
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+    try:
+        vd.write(5, b"xyz")
+        ref[5:8] = b"xyz"
+        f = vd._unpacking[0]
+        assert sum(f.copied) == 1
+        assert bytes(vd.read(0, SIZE)) == ref
+        vd.trim(CHUNK - 4096, 4096)
+        ref[CHUNK - 4096 : CHUNK] = bytes(4096)
+        assert sum(f.copied) == 2
+        vd.sync()
+        assert bytes(vd.read(0, SIZE)) == ref
+    finally:
+        vd.close()
+    # close() finishes the unpack
+    assert files(tmp_path)[0].endswith(compress.RAW_EXT) and compress.is_packed(files(tmp_path)[1])
+    assert len(files(tmp_path)) == 2
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, read_only=True)
+    try:
+        assert bytes(vd.read(0, SIZE)) == ref
+    finally:
+        vd.close()
+
+def test_background_copy_finishes_the_unpack(tmp_path):
+    ref = packed_drive(tmp_path)
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+    try:
+        vd.write(CHUNK + 10, b"abc")
+        ref[CHUNK + 10 : CHUNK + 13] = b"abc"
+        deadline = time.monotonic() + 10
+        while vd._unpacking and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not vd._unpacking
+        assert compress.is_packed(vd.chunk_map[0]) and vd.chunk_map[1].endswith(compress.RAW_EXT)
+        assert bytes(vd.read(0, SIZE)) == ref
+    finally:
+        vd.close()
+
+@pytest.mark.parametrize("resume", ["mount", "offline"])
+def test_unpack_resumes_after_a_crash(tmp_path, monkeypatch, resume):
+    ref = packed_drive(tmp_path)
+    with monkeypatch.context() as m:
+        m.setattr(VirtualDisk, "_unpack_loop", lambda self: None)
+        vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+        vd.write(7, b"q" * 300000)
+        ref[7:300007] = b"q" * 300000
+        vd.sync()
+        # The daemon dies: no close()
+    assert any(f.endswith(compress.PART_EXT) for f in files(tmp_path))
+
+    if resume == "mount":
+        vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+        try:
+            assert bytes(vd.read(0, SIZE)) == ref
+        finally:
+            vd.close()
+    else:
+        assert compress.finish_unpacks(str(tmp_path)) == 1
+    assert len(files(tmp_path)) == 2
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, read_only=True)
+    try:
+        assert bytes(vd.read(0, SIZE)) == ref
+    finally:
+        vd.close()
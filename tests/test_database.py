@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import pytest
+from core import database
+from core.database import DBManager, MIGRATIONS
+
+def user_version(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def tables(path):
+    with sqlite3.connect(path) as conn:
+        return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+def test_new_drive_runs_every_migration(tmp_path):
+    db = DBManager(str(tmp_path), "d")
+    db.initialize({"total_chunks": 1})
+    assert user_version(db.db_path) == len(MIGRATIONS)
+    assert {"metadata", "chunks", "blocks", "uploads", "snapshots", "pending_signatures"} <= tables(db.db_path)
+
+def test_drive_from_before_versioning_is_upgraded(tmp_path):
+    path = tmp_path / "d.db"
+    # The schema the first releases created, without user_version
+    with sqlite3.connect(path) as conn:
+        conn.executescript("""
+            CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE chunks (chunk_index INTEGER PRIMARY KEY, hash TEXT, filename TEXT, size INTEGER, mtime REAL);
+            CREATE TABLE dirty_ranges (chunk_index INTEGER, start INTEGER, end INTEGER);
+            INSERT INTO metadata VALUES ('total_chunks', '2');
+            INSERT INTO chunks VALUES (0, 'h0', 'd.0.h0.img', 10, 1.0);
+            INSERT INTO dirty_ranges VALUES (0, 0, 4096);
+        """)
+    assert user_version(path) == 0
+
+    db = DBManager(str(tmp_path), "d")
+    assert db.get_meta("total_chunks") == "2"
+    assert db.get_chunk(0)['filename'] == "d.0.h0.img"
+    assert db.get_dirty() == {0: [(0, 4096)]}
+    assert user_version(path) == len(MIGRATIONS)
+    assert "signatures" in tables(path)
+
+def test_partly_migrated_drive_runs_only_the_rest(tmp_path):
+    path = tmp_path / "d.db"
+    with sqlite3.connect(path) as conn:
+        for i, script in enumerate(MIGRATIONS[:5], start=1):
+            conn.executescript(f"BEGIN; {script} PRAGMA user_version = {i}; COMMIT;")
+        conn.execute("INSERT INTO uploads VALUES (0, 'k', 'u', 1, 1.0, 1)")
+    db = DBManager(str(tmp_path), "d")
+    assert db.get_uploads()[0]['key'] == "k"
+    assert user_version(path) == len(MIGRATIONS)
+    assert {"tier_units", "snapshot_chunks"} <= tables(path)
+
+def test_transaction_rolls_back_as_a_whole(tmp_path):
+    db = DBManager(str(tmp_path), "d")
+    db.initialize({"total_chunks": 2})
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.update_chunk(0, "h", "f", 1, 1.0)
+            raise RuntimeError("abort")
+    assert db.get_chunk(0) is None
+
+def test_replaced_file_gets_a_new_connection(tmp_path):
+    db = DBManager(str(tmp_path), "d")
+    db.initialize({"total_chunks": 2})
+    os.remove(db.db_path)
+    for ext in ("-wal", "-shm"):
+        if os.path.exists(db.db_path + ext):
+            os.remove(db.db_path + ext)
+    fresh = DBManager(str(tmp_path), "d")
+    assert fresh.get_meta("total_chunks") is None
+    assert user_version(fresh.db_path) == len(MIGRATIONS)
+    assert database.get_connection(fresh.db_path) is fresh._conn
@@ -0,0 +1,91 @@
+import io
+import os
+import random
+import zlib
+import pytest
+from core import compress, delta
+
+BLOCK = delta.DEFAULT_BLOCK_SIZE
+SIZE = 4 * 1024 * 1024
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+def round_trip(tmp_path, base, new, base_name="base.img"):
+    """Deltas new against base and applies it; returns (rebuilt bytes, DeltaStats)."""
+    (tmp_path / "remote").mkdir(exist_ok=True)
+    write(tmp_path / "remote" / base_name, base)
+    sig = delta.signature(str(tmp_path / "remote" / base_name))[1]
+    stats = delta.DeltaStats()
+    out = io.BytesIO()
+    delta.make(write(tmp_path / "new.img", new), out, "new.img", base_name, sig, stats=stats)
+    out.seek(0)
+    assert delta.apply(out, str(tmp_path / "remote"), str(tmp_path / "remote")) == "new.img"
+    with open(tmp_path / "remote" / "new.img", "rb") as f:
+        return f.read(), stats
+
+@pytest.mark.parametrize("n", [1, 7, 4096, BLOCK])
+def test_roll_matches_adler32(n):
+    rnd = random.Random(n)
+    data = rnd.randbytes(BLOCK + n)
+    weak = zlib.adler32(data[:BLOCK])
+    assert delta._roll(weak, BLOCK, data[:n], data[BLOCK : BLOCK + n]) == zlib.adler32(data[n : BLOCK + n])
+
+def test_edit_in_place_sends_only_the_changed_blocks(tmp_path):
+    rnd = random.Random(1)
+    base = bytearray(rnd.randbytes(SIZE))
+    new = bytearray(base)
+    new[100:200] = b"x" * 100
+    rebuilt, stats = round_trip(tmp_path, bytes(base), bytes(new))
+    assert rebuilt == new
+    assert stats.literal == BLOCK
+
+def test_data_shifted_by_a_device_block_is_found(tmp_path):
+    rnd = random.Random(2)
+    base = rnd.randbytes(SIZE)
+    new = base[:SIZE // 2] + rnd.randbytes(4096) + base[SIZE // 2 : SIZE - 4096]
+    rebuilt, stats = round_trip(tmp_path, base, new)
+    assert rebuilt == new
+    assert stats.literal < 4 * BLOCK
+
+def test_without_a_base_the_delta_is_the_whole_chunk(tmp_path):
+    data = random.Random(3).randbytes(SIZE // 4) + bytes(SIZE // 4)
+    out = io.BytesIO()
+    delta.make(write(tmp_path / "a.img", data), out, "b.img")
+    out.seek(0)
+    delta.apply(out, str(tmp_path), str(tmp_path))
+    with open(tmp_path / "b.img", "rb") as f:
+        assert f.read() == data
+    # The zero tail stays a hole
+    assert os.stat(tmp_path / "b.img").st_blocks * 512 < len(data)
+
+def test_packed_base(tmp_path):
+    rnd = random.Random(4)
+    base = rnd.randbytes(SIZE // 2) + bytes(SIZE // 2)
+    write(tmp_path / "base.img", base)
+    (tmp_path / "remote").mkdir()
+    compress.pack_file(str(tmp_path / "base.img"), str(tmp_path / "remote" / "base.pack"), "zlib")
+    sig = delta.signature(str(tmp_path / "remote" / "base.pack"))[1]
+    new = base[:-10] + b"0123456789"
+    out = io.BytesIO()
+    delta.make(write(tmp_path / "new.img", new), out, "new.img", "base.pack", sig)
+    out.seek(0)
+    delta.apply(out, str(tmp_path / "remote"), str(tmp_path / "remote"))
+    with open(tmp_path / "remote" / "new.img", "rb") as f:
+        assert f.read() == new
+
+def test_corrupt_delta_is_rejected(tmp_path):
+    rnd = random.Random(5)
+    base = rnd.randbytes(SIZE // 4)
+    write(tmp_path / "base.img", base)
+    sig = delta.signature(str(tmp_path / "base.img"))[1]
+    out = io.BytesIO()
+    delta.make(write(tmp_path / "new.img", rnd.randbytes(100) + base[100:]), out, "new.img", "base.img", sig)
+    raw = bytearray(out.getvalue())
+    raw[-3] ^= 1
+    (tmp_path / "out").mkdir()
+    with pytest.raises(IOError):
+        delta.apply(io.BytesIO(bytes(raw)), str(tmp_path), str(tmp_path / "out"))
+    assert not os.listdir(tmp_path / "out")
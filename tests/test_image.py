@@ -0,0 +1,132 @@
+import os
+import threading
+import pytest
+from core import chunker, hasher, image
+from core.io import VirtualDisk
+from core.database import DBManager
+
+NAME = "d"
+CHUNK_MB = 8
+CHUNKS = 4
+BLOCK = chunker.get_block_size_mb(CHUNK_MB) * 1024 * 1024
+CHUNK = CHUNK_MB * 1024 * 1024
+SIZE = CHUNKS * CHUNK
+MB = 1024 * 1024
+
+@pytest.fixture
+def drive(tmp_path):
+    path = tmp_path / NAME
+    path.mkdir()
+    db = DBManager(str(path), NAME)
+    db.initialize({"chunk_size_mb": CHUNK_MB, "total_chunks": CHUNKS, "block_size_mb": BLOCK // MB})
+    rows = []
+    for c in chunker.create_initial_chunks(str(path), NAME, CHUNKS, CHUNK_MB):
+        st = os.stat(path / c['filename'])
+        rows.append((c['index'], c['hash'], c['filename'], st.st_size, st.st_mtime))
+    db.update_chunks(rows)
+    return str(path), db
+
+def make_image(size):
+    img = bytearray(size)
+    for offset in (0, 3 * MB, 8 * MB + 3 * 4096, 17 * MB):
+        if offset < size:
+            img[offset : offset + 300000] = os.urandom(min(300000, size - offset))
+    return img
+
+def import_from_pipe(path, db, data):
+    """Runs an Importer over data streamed through a pipe, like `import -`."""
+    r, w = os.pipe()
+
+    def feed():
+        with open(w, "wb") as f:
+            f.write(data)
+
+    t = threading.Thread(target=feed)
+    t.start()
+    importer = image.Importer(path, NAME, db, workers=2)
+    with open(r, "rb", buffering=0) as src:
+        importer.run(src)
+    t.join()
+    return importer
+
+def read_drive(path, db):
+    vd = VirtualDisk(path, NAME, CHUNK_MB, CHUNKS, db=db, read_only=True)
+    try:
+        return bytes(vd.read(0, SIZE))
+    finally:
+        vd.close()
+
+def assert_checked(path, db):
+    """Rows as check_drive would leave them: roots, names, leaves, size and mtime."""
+    padding = chunker.get_padding(CHUNKS)
+    zero_leaf = chunker.get_zero_hash(BLOCK)
+    for c in db.get_chunks():
+        p = os.path.join(path, c['filename'])
+        leaves, _ = hasher.hash_blocks(p, BLOCK)
+        assert c['hash'] == chunker.get_root(leaves, CHUNK, BLOCK)
+        assert c['filename'] == chunker.format_name(NAME, c['chunk_index'], c['hash'], padding)
+        assert db.get_block_hashes(c['chunk_index']) == {b: h for b, h in leaves.items() if h != zero_leaf}
+        st = os.stat(p)
+        assert (st.st_size, st.st_mtime) == (c['size'], c['mtime'])
+    assert len([f for f in os.listdir(path) if f.endswith(".img")]) == CHUNKS
+    assert not db.get_dirty()
+
+def test_import_is_sparse_and_hashed(drive):
+    path, db = drive
+    img = make_image(20 * MB)
+    importer = import_from_pipe(path, db, bytes(img))
+    assert not importer.overflow
+    assert read_drive(path, db) == bytes(img).ljust(SIZE, b"\0")
+    assert_checked(path, db)
+    used = sum(os.stat(os.path.join(path, f)).st_blocks * 512 for f in os.listdir(path) if f.endswith(".img"))
+    assert used < 3 * MB
+
+def test_reimport_replaces_the_old_files(drive):
+    path, db = drive
+    import_from_pipe(path, db, bytes(make_image(20 * MB)))
+    small = bytearray(9 * MB)
+    small[8 * MB + 5 : 8 * MB + 50] = b"z" * 45
+    import_from_pipe(path, db, bytes(small))
+    assert read_drive(path, db) == bytes(small).ljust(SIZE, b"\0")
+    assert_checked(path, db)
+
+def test_input_past_the_end_is_flagged(drive):
+    path, db = drive
+    importer = import_from_pipe(path, db, bytes(SIZE) + b"x")
+    assert importer.overflow
+    assert read_drive(path, db) == bytes(SIZE)
+
+def test_export_to_file_and_pipe(drive, tmp_path):
+    path, db = drive
+    img = bytes(make_image(20 * MB)).ljust(SIZE, b"\0")
+    import_from_pipe(path, db, img)
+    vd = VirtualDisk(path, NAME, CHUNK_MB, CHUNKS, db=db, read_only=True)
+    try:
+        out = tmp_path / "out.raw"
+        fd = os.open(out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            stats = image.export(vd, fd, workers=2)
+        finally:
+            os.close(fd)
+        assert out.read_bytes() == img
+        assert stats.bytes == SIZE and stats.written < 3 * MB
+        # Holes were skipped, not written
+        assert os.stat(out).st_blocks * 512 < 3 * MB
+
+        r, w = os.pipe()
+        got = []
+
+        def drain():
+            with open(r, "rb") as f:
+                got.append(f.read())
+
+        t = threading.Thread(target=drain)
+        t.start()
+        try:
+            image.export(vd, w, workers=2)
+        finally:
+            os.close(w)
+            t.join()
+        assert got[0] == img
+    finally:
+        vd.close()
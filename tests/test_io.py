@@ -0,0 +1,136 @@
+import os
+import random
+import threading
+import pytest
+from core import chunker
+from core.io import VirtualDisk
+from core.database import DBManager
+from core.journal import DirtyJournal, merge_ranges
+
+NAME = "d"
+CHUNK_MB = 1
+CHUNKS = 4
+CHUNK = CHUNK_MB * 1024 * 1024
+SIZE = CHUNKS * CHUNK
+
+def make_drive(path, with_db=False):
+    """Fresh all-zero drive folder; with_db also records it in a drive DB."""
+    chunks = chunker.create_initial_chunks(str(path), NAME, CHUNKS, CHUNK_MB)
+    if not with_db:
+        return None
+    db = DBManager(str(path), NAME)
+    db.initialize({"chunk_size_mb": CHUNK_MB, "total_chunks": CHUNKS, "block_size_mb": chunker.get_block_size_mb(CHUNK_MB)})
+    rows = []
+    for c in chunks:
+        st = os.stat(os.path.join(path, c['filename']))
+        rows.append((c['index'], c['hash'], c['filename'], st.st_size, st.st_mtime))
+    db.update_chunks(rows)
+    return db
+
+def chunk_bytes(path, vdisk, chunk_idx):
+    with open(os.path.join(path, vdisk.chunk_map[chunk_idx]), "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("cache_mb", [0, 2])
+@pytest.mark.parametrize("readahead_mb", [0, 2])
+def test_write_read_trim_round_trip(tmp_path, cache_mb, readahead_mb):
+    make_drive(tmp_path)
+    rnd = random.Random(cache_mb * 10 + readahead_mb)
+    ref = bytearray(SIZE)
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, cache_mb=cache_mb, readahead_mb=readahead_mb)
+    try:
+        for _ in range(400):
+            offset = rnd.randrange(SIZE)
+            length = min(rnd.choice([1, 512, 4096, 70000, 300000]), SIZE - offset)
+            op = rnd.random()
+            if op < 0.5:
+                data = rnd.randbytes(length)
+                vd.write(offset, data)
+                ref[offset : offset + length] = data
+            elif op < 0.6:
+                vd.trim(offset, length)
+                ref[offset : offset + length] = bytes(length)
+            elif op < 0.65:
+                vd.sync()
+            else:
+                assert bytes(vd.read(offset, length)) == ref[offset : offset + length]
+        # Sequential pass, the pattern read-ahead serves
+        for offset in range(0, SIZE, 65536):
+            assert bytes(vd.read(offset, 65536)) == ref[offset : offset + 65536]
+    finally:
+        vd.close()
+
+    # Everything reached the chunk files
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+    try:
+        assert bytes(vd.read(0, SIZE)) == ref
+    finally:
+        vd.close()
+
+def test_flush_makes_cached_writes_and_journal_durable(tmp_path):
+    db = make_drive(tmp_path, with_db=True)
+    journal = DirtyJournal(db)
+    journal.open()
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, journal=journal, cache_mb=2, db=db)
+    try:
+        assert not db.journal_is_clean()
+        vd.write(4096, b"a" * 8192)
+        vd.write(CHUNK + 100, b"b" * 10)
+        vd.write(3 * CHUNK - 5, b"c" * 10)  # spans chunks 2 and 3
+        vd.sync()
+
+        # FLUSH wrote the cache back and recorded every range, before returning
+        assert not vd.cache.dirty_chunks()
+        assert chunk_bytes(tmp_path, vd, 0)[4096 : 4096 + 8192] == b"a" * 8192
+        assert chunk_bytes(tmp_path, vd, 1)[100:110] == b"b" * 10
+        assert chunk_bytes(tmp_path, vd, 2)[-5:] == b"c" * 5
+        assert chunk_bytes(tmp_path, vd, 3)[:5] == b"c" * 5
+        dirty = {idx: merge_ranges(spans) for idx, spans in db.get_dirty().items()}
+        assert dirty == {0: [(4096, 4096 + 8192)], 1: [(100, 110)], 2: [(CHUNK - 5, CHUNK)], 3: [(0, 5)]}
+
+        # FUA: the data is durable without a FLUSH; its range is recorded by the next flush or close
+        vd.write(2 * CHUNK, b"d" * 4, fua=True)
+        assert chunk_bytes(tmp_path, vd, 2)[:4] == b"d" * 4
+    finally:
+        vd.close()
+        journal.close()
+    assert db.journal_is_clean()
+    assert merge_ranges(db.get_dirty()[2]) == [(0, 4), (CHUNK - 5, CHUNK)]
+
+def test_concurrent_writers_on_one_chunk(tmp_path):
+    make_drive(tmp_path)
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS, cache_mb=1, readahead_mb=1)
+    writers = 8
+    # Interleaved, unaligned slices of chunk 1: neighbours share cache blocks
+    slice_len = 1500
+    rounds = 40
+    errors = []
+
+    def writer(k):
+        try:
+            rnd = random.Random(k)
+            for r in range(rounds):
+                offset = CHUNK + (r * writers + k) * slice_len
+                vd.write(offset, bytes([k + 1]) * slice_len)
+                if rnd.random() < 0.2:
+                    vd.sync()
+                got = bytes(vd.read(offset, slice_len))
+                if got != bytes([k + 1]) * slice_len:
+                    errors.append((k, r))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(k,)) for k in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    try:
+        assert not errors
+        vd.sync()
+        expected = b"".join(bytes([k + 1]) * slice_len for _ in range(rounds) for k in range(writers))
+        assert bytes(vd.read(CHUNK, len(expected))) == expected
+        assert chunk_bytes(tmp_path, vd, 1)[: len(expected)] == expected
+        assert chunk_bytes(tmp_path, vd, 0) == bytes(CHUNK)
+    finally:
+        vd.close()
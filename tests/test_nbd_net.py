@@ -0,0 +1,159 @@
+import socket
+import struct
+import threading
+import pytest
+from core import chunker, nbd_net as N, nbd_server as S
+from core.io import VirtualDisk
+
+NAME = "d"
+CHUNK_MB = 1
+CHUNKS = 4
+SIZE = CHUNKS * CHUNK_MB * 1024 * 1024
+
+def recv_exact(sock, n):
+    buf = b""
+    while len(buf) < n:
+        got = sock.recv(n - len(buf))
+        if not got:
+            raise EOFError
+        buf += got
+    return buf
+
+class Client:
+    """Just enough of a fixed newstyle NBD client to drive the server."""
+    def __init__(self, path):
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.s.settimeout(10)
+        self.s.connect(path)
+        assert recv_exact(self.s, 8) == b"NBDMAGIC"
+        magic, flags = struct.unpack(">QH", recv_exact(self.s, 10))
+        assert magic == N.NBD_OPTS_MAGIC and flags & 3 == 3
+        self.s.sendall(struct.pack(">L", 3))
+
+    def opt(self, opt, data=b""):
+        """Sends an option; returns its [(reply type, data)] up to the final reply."""
+        self.s.sendall(struct.pack(">QLL", N.NBD_OPTS_MAGIC, opt, len(data)) + data)
+        out = []
+        while True:
+            magic, o, t, n = struct.unpack(">QLLL", recv_exact(self.s, 20))
+            assert magic == N.NBD_REP_MAGIC and o == opt
+            out.append((t, recv_exact(self.s, n)))
+            if t == N.NBD_REP_ACK or t >= 1 << 31:
+                return out
+
+    def go(self, name=NAME, structured=True):
+        if structured:
+            assert self.opt(N.NBD_OPT_STRUCTURED_REPLY)[-1][0] == N.NBD_REP_ACK
+            query = b"base:allocation"
+            data = struct.pack(">L", len(name)) + name.encode() + struct.pack(">LL", 1, len(query)) + query
+            assert self.opt(N.NBD_OPT_SET_META_CONTEXT, data)[0][0] == N.NBD_REP_META_CONTEXT
+        replies = self.opt(N.NBD_OPT_GO, struct.pack(">L", len(name)) + name.encode() + struct.pack(">H", 0))
+        assert replies[-1][0] == N.NBD_REP_ACK
+        info = [d for t, d in replies if t == N.NBD_REP_INFO and struct.unpack(">H", d[:2])[0] == 0][0]
+        _, size, flags = struct.unpack(">HQH", info)
+        return size, flags
+
+    def request(self, cmd, handle, offset, length, data=b"", flags=0):
+        self.s.sendall(struct.pack(">LLQQL", S.NBD_REQUEST_MAGIC, cmd | flags << 16, handle, offset, length) + data)
+
+    def reply(self, read_length=0):
+        """Returns (handle, error, data, [(chunk type, payload)]) of a simple or structured reply."""
+        (magic,) = struct.unpack(">L", recv_exact(self.s, 4))
+        if magic == S.NBD_REPLY_MAGIC:
+            error, handle = struct.unpack(">LQ", recv_exact(self.s, 12))
+            return handle, error, recv_exact(self.s, read_length) if read_length and not error else b"", []
+        assert magic == N.NBD_STRUCTURED_REPLY_MAGIC
+        chunks, data, error = [], b"", 0
+        while True:
+            if chunks:
+                assert struct.unpack(">L", recv_exact(self.s, 4))[0] == N.NBD_STRUCTURED_REPLY_MAGIC
+            flags, kind, handle, n = struct.unpack(">HHQL", recv_exact(self.s, 16))
+            payload = recv_exact(self.s, n)
+            chunks.append((kind, payload))
+            if kind == N.NBD_REPLY_TYPE_OFFSET_DATA:
+                data += payload[8:]
+            elif kind == N.NBD_REPLY_TYPE_ERROR:
+                error = struct.unpack(">L", payload[:4])[0]
+            if flags & 1:
+                return handle, error, data, chunks
+
+    def close(self):
+        self.request(S.NBD_CMD_DISC, 0, 0, 0)
+        self.s.close()
+
+@pytest.fixture
+def server(tmp_path):
+    chunker.create_initial_chunks(str(tmp_path), NAME, CHUNKS, CHUNK_MB)
+    vd = VirtualDisk(str(tmp_path), NAME, CHUNK_MB, CHUNKS)
+    path = str(tmp_path / "nbd.sock")
+    srv = N.NetworkServer(path, vd, name=NAME)
+    ready = threading.Event()
+    t = threading.Thread(target=srv.start, args=(ready.set,))
+    t.start()
+    assert ready.wait(10)
+    try:
+        yield path
+    finally:
+        srv.stop()
+        t.join(10)
+        vd.close()
+
+def block_status(client, handle, offset, length):
+    client.request(N.NBD_CMD_BLOCK_STATUS, handle, offset, length)
+    _, error, _, chunks = client.reply()
+    assert error == 0 and chunks[0][0] == N.NBD_REPLY_TYPE_BLOCK_STATUS
+    payload = chunks[0][1]
+    assert struct.unpack(">L", payload[:4])[0] == N.BASE_ALLOCATION_ID
+    return [struct.unpack(">LL", payload[i : i + 8]) for i in range(4, len(payload), 8)]
+
+def test_handshake_lists_and_describes_the_export(server):
+    c = Client(server)
+    try:
+        assert c.opt(N.NBD_OPT_LIST)[0][1][4:] == NAME.encode()
+        unknown = struct.pack(">L", 3) + b"zzz" + struct.pack(">H", 0)
+        assert c.opt(N.NBD_OPT_GO, unknown)[-1][0] == N.NBD_REP_ERR_UNKNOWN
+        assert c.opt(99)[-1][0] == N.NBD_REP_ERR_UNSUP
+        size, flags = c.go()
+        assert size == SIZE
+        assert flags & N.NBD_FLAG_SEND_DF and flags & S.NBD_FLAG_CAN_MULTI_CONN
+        assert not flags & S.NBD_FLAG_READ_ONLY
+    finally:
+        c.close()
+
+def test_structured_reads_and_block_status(server):
+    c = Client(server)
+    try:
+        c.go()
+        c.request(S.NBD_CMD_WRITE, 1, 4096, 8192, b"A" * 8192)
+        assert c.reply()[1] == 0
+        c.request(S.NBD_CMD_READ, 2, 4086, 20)
+        handle, error, data, _ = c.reply()
+        assert (handle, error, data) == (2, 0, b"\0" * 10 + b"A" * 10)
+
+        # Written blocks are data, the rest of the fresh drive is holes
+        assert block_status(c, 3, 0, 16384) == [(4096, 3), (8192, 0), (4096, 3)]
+        extents = block_status(c, 4, 0, SIZE)
+        assert sum(n for n, _ in extents) == SIZE
+
+        c.request(S.NBD_CMD_TRIM, 5, 4096, 4096)
+        assert c.reply()[1] == 0
+        assert block_status(c, 6, 0, 16384) == [(8192, 3), (4096, 0), (4096, 3)]
+
+        c.request(S.NBD_CMD_READ, 7, SIZE, 10)
+        assert c.reply()[1] == 22
+    finally:
+        c.close()
+
+def test_simple_replies_without_structured_negotiation(server):
+    c = Client(server)
+    try:
+        c.go(structured=False)
+        c.request(S.NBD_CMD_WRITE, 1, 0, 4, b"abcd")
+        assert c.reply()[1] == 0
+        c.request(S.NBD_CMD_READ, 2, 0, 4)
+        assert c.reply(4)[2] == b"abcd"
+        # Block status needs structured replies
+        c.request(N.NBD_CMD_BLOCK_STATUS, 3, 0, 4096)
+        assert c.reply()[1] == 22
+    finally:
+        c.close()
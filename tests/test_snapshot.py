@@ -0,0 +1,121 @@
+import os
+import pytest
+from core import chunker, compress, snapshot
+from core.io import VirtualDisk
+from core.database import DBManager
+
+NAME = "d"
+CHUNK_MB = 1
+CHUNKS = 4
+CHUNK = CHUNK_MB * 1024 * 1024
+SIZE = CHUNKS * CHUNK
+
+def make_drive(path, name=NAME):
+    path.mkdir(exist_ok=True)
+    chunks = chunker.create_initial_chunks(str(path), name, CHUNKS, CHUNK_MB)
+    db = DBManager(str(path), name)
+    db.initialize({"chunk_size_mb": CHUNK_MB, "total_chunks": CHUNKS, "block_size_mb": chunker.get_block_size_mb(CHUNK_MB)})
+    rows = []
+    for c in chunks:
+        st = os.stat(path / c['filename'])
+        rows.append((c['index'], c['hash'], c['filename'], st.st_size, st.st_mtime))
+    db.update_chunks(rows)
+    return db
+
+def open_disk(path, name=NAME, **kwargs):
+    return VirtualDisk(str(path), name, CHUNK_MB, CHUNKS, **kwargs)
+
+def write(path, offset, data, **kwargs):
+    vd = open_disk(path, **kwargs)
+    try:
+        vd.write(offset, data)
+    finally:
+        vd.close()
+
+def read_all(path, name=NAME):
+    vd = open_disk(path, name, read_only=True)
+    try:
+        return bytes(vd.read(0, SIZE))
+    finally:
+        vd.close()
+
+def test_snapshot_keeps_its_data_after_writes(tmp_path):
+    drive = tmp_path / NAME
+    db = make_drive(drive)
+    write(drive, 0, b"a" * 10000)
+    write(drive, 2 * CHUNK, b"b" * 10)
+    before = read_all(drive)
+
+    snapshot.take(str(drive), db, "s1", snapshot.local_files(str(drive), db))
+    assert "s1" in db.get_snapshots()
+    with pytest.raises(ValueError):
+        snapshot.take(str(drive), db, "s1", snapshot.local_files(str(drive), db))
+
+    # The first write to a shared chunk gives the drive its own copy
+    write(drive, 5, b"new")
+    write(drive, 2 * CHUNK, b"c" * 10)
+    snap = snapshot.get_snapshot_path(str(drive), "s1")
+    assert read_all(snap) == before
+    after = read_all(drive)
+    assert after[5:8] == b"new" and after[2 * CHUNK : 2 * CHUNK + 10] == b"c" * 10
+
+    snapshot.delete(str(drive), db, "s1")
+    assert not os.path.exists(snap) and "s1" not in db.get_snapshots()
+    assert read_all(drive) == after
+
+def test_live_snapshot_of_a_served_drive(tmp_path):
+    drive = tmp_path / NAME
+    db = make_drive(drive)
+    vd = open_disk(drive, cache_mb=2, db=db)
+    try:
+        vd.write(100, b"x" * 5000)
+        snapshot.take_live(vd, db, "live")
+        # Written after the snapshot, cached and then flushed into the drive's own copy
+        vd.write(100, b"y" * 10)
+        vd.sync()
+    finally:
+        vd.close()
+    snap = read_all(snapshot.get_snapshot_path(str(drive), "live"))
+    assert snap[100:5100] == b"x" * 5000
+    assert read_all(drive)[100:110] == b"y" * 10
+
+def test_live_snapshot_finishes_pending_unpacks(tmp_path, monkeypatch):
+    drive = tmp_path / NAME
+    db = make_drive(drive)
+    write(drive, 0, os.urandom(SIZE))
+    ref = bytearray(read_all(drive))
+    compress.pack_many([str(drive / c['filename']) for c in db.get_chunks()], "zlib")
+    for c in db.get_chunks():
+        db.rename_chunk(c['chunk_index'], compress.packed_name(c['filename']))
+
+    monkeypatch.setattr(VirtualDisk, "_unpack_loop", lambda self: None)
+    vd = open_disk(drive, db=db)
+    try:
+        vd.write(10, b"zz")
+        ref[10:12] = b"zz"
+        snapshot.take_live(vd, db, "s")
+    finally:
+        vd.close()
+    snap = snapshot.get_snapshot_path(str(drive), "s")
+    assert not any(f.endswith(compress.PART_EXT) for f in os.listdir(snap))
+    assert read_all(snap) == ref
+
+def test_clone_shares_the_snapshot(tmp_path):
+    drive = tmp_path / NAME
+    db = make_drive(drive)
+    write(drive, CHUNK + 1, b"clone me")
+    snapshot.take(str(drive), db, "s1", snapshot.local_files(str(drive), db))
+    expected = read_all(drive)
+
+    copy = tmp_path / "e"
+    assert snapshot.clone(str(drive), NAME, "s1", str(copy), "e") == CHUNKS
+    assert read_all(copy, "e") == expected
+    assert DBManager(str(copy), "e").get_meta("origin") == snapshot.instance_name(NAME, "s1")
+
+    vd = open_disk(copy, "e")
+    try:
+        vd.write(CHUNK + 1, b"changed!")
+    finally:
+        vd.close()
+    assert read_all(snapshot.get_snapshot_path(str(drive), "s1")) == expected
+    assert read_all(drive) == expected
@@ -0,0 +1,77 @@
+import asyncio
+import os
+from core import chunker, remote, uploader
+from core.database import DBManager
+
+NAME = "d"
+CHUNKS = 3
+MB = 1024 * 1024
+
+class FailingBackend(remote.DirectoryBackend):
+    """Stores parts until `budget` runs out, then fails every upload_part."""
+    def __init__(self, root, budget=None):
+        super().__init__(root)
+        self.budget = budget
+        self.parts = 0
+
+    async def upload_part(self, upload_id, part_no, data):
+        if self.budget is not None and self.parts >= self.budget:
+            raise ConnectionError("connection lost")
+        self.parts += 1
+        return await super().upload_part(upload_id, part_no, data)
+
+def make_drive(path):
+    db = DBManager(str(path), NAME)
+    db.initialize({"total_chunks": CHUNKS})
+    padding = chunker.get_padding(CHUNKS)
+    for i in range(CHUNKS):
+        filename = chunker.format_name(NAME, i, f"h{i}", padding)
+        with open(path / filename, "wb") as f:
+            f.write(os.urandom(3 * MB + i))
+        st = os.stat(path / filename)
+        db.update_chunk(i, f"h{i}", filename, st.st_size, st.st_mtime)
+    return db
+
+def push(path, backend):
+    up = uploader.Uploader(str(path), NAME, backend, concurrency=2, part_size=MB, retries=0, log=lambda *_: None)
+    return asyncio.run(up.run())
+
+def test_interrupted_push_resumes_from_stored_parts(tmp_path):
+    drive, rem = tmp_path / "drive", tmp_path / "remote"
+    drive.mkdir()
+    db = make_drive(drive)
+
+    stats = push(drive, FailingBackend(str(rem), budget=5))
+    assert stats.failed and stats.parts == 5
+
+    backend = FailingBackend(str(rem))
+    stats = push(drive, backend)
+    assert stats.failed == 0 and stats.resumed_parts > 0
+    # 4 parts per chunk: only those of unfinished chunks not stored before go out again
+    assert backend.parts == CHUNKS * 4 - stats.resumed_parts - 4 * stats.skipped
+    for c in db.get_chunks():
+        with open(drive / c['filename'], "rb") as a, open(rem / c['filename'], "rb") as b:
+            assert a.read() == b.read()
+    assert all(up['done'] for up in db.get_uploads().values())
+
+    # Nothing left to send
+    backend = FailingBackend(str(rem), budget=0)
+    stats = push(drive, backend)
+    assert stats.skipped == CHUNKS and stats.failed == 0 and backend.parts == 0
+
+def test_changed_chunk_restarts_its_upload(tmp_path):
+    drive, rem = tmp_path / "drive", tmp_path / "remote"
+    drive.mkdir()
+    db = make_drive(drive)
+    push(drive, FailingBackend(str(rem), budget=2))
+
+    # The chunk changes (same name, new content) before the push resumes
+    c = db.get_chunks()[0]
+    with open(drive / c['filename'], "r+b") as f:
+        f.write(b"changed")
+    os.utime(drive / c['filename'], (1, 1))
+
+    stats = push(drive, FailingBackend(str(rem)))
+    assert stats.failed == 0
+    with open(drive / c['filename'], "rb") as a, open(rem / c['filename'], "rb") as b:
+        assert a.read() == b.read()